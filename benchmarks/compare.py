@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Compares two results files written by run.py, configuration by
+    configuration, and prints the change in throughput, p99, peak RSS and
+    threads.
+
+    Example:
+        python benchmarks/compare.py results/before.json results/after.json
+"""
+
+import json
+import sys
+
+METRICS = ('throughput', 'p99_ms', 'peak_rss_kb', 'peak_threads')
+
+
+def load(path):
+    source = open(path)
+    try:
+        report = json.load(source)
+    finally:
+        source.close()
+    return report, dict(((r['name'], r['pass']), r) for r in report['results'])
+
+
+def change(before, after):
+    if before is None or after is None:
+        return '-'
+    if not before:
+        return '%s' % after
+    return '%+.1f%%' % ((after - before) * 100.0 / before)
+
+
+def main():
+    if len(sys.argv) != 3:
+        print >> sys.stderr, "usage: %s BEFORE.json AFTER.json" % sys.argv[0]
+        sys.exit(2)
+
+    before_report, before = load(sys.argv[1])
+    after_report, after = load(sys.argv[2])
+    print "%s -> %s" % (before_report.get('commit'), after_report.get('commit'))
+    print '%-20s %-5s ' % ('config', 'pass') + ' '.join('%14s' % metric for metric in METRICS)
+
+    for key in sorted(set(before) & set(after)):
+        cells = [change(before[key].get(metric), after[key].get(metric)) for metric in METRICS]
+        print '%-20s %-5s ' % key + ' '.join('%14s' % cell for cell in cells)
+
+    for key in sorted(set(before) ^ set(after)):
+        print '%-20s %-5s only in %s' % (key + (key in before and 'before' or 'after',))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Benchmarks bullfrog against the local stand-in servers in servers.py, so
+    runs are reproducible and need no network.
+
+    Every configuration (protocol, threaded or async, batch size, latency,
+    body size, gzip, cache backend) runs in its own child process so peak
+    RSS and thread counts are not polluted by earlier runs. Cacheable
+    configurations run a cold pass followed by a warm pass over the same
+    URLs, in the same child so the warm pass finds the in-process cache
+    tier filled. Peak RSS is the child's peak so far, so a warm pass never
+    reports less than the cold pass before it. Results are printed as a
+    table and written as JSON, compare two runs with compare.py.
+
+    Example:
+        python benchmarks/run.py --quick
+        python benchmarks/run.py --batch-sizes 1000 --only async
+        python benchmarks/compare.py results/before.json results/after.json
+"""
+
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from optparse import OptionParser
+
+root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, root_path)
+
+from servers import HttpServer, FtpServer, MemcacheServer
+
+DEFAULT_BATCH_SIZES = (10, 100, 1000, 10000)
+QUICK_BATCH_SIZES = (10, 100)
+
+# Every FTP request logs in, lists and downloads, so large batches only
+# measure the stand-in server.
+MAX_FTP_BATCH = 100
+FTP_FILES = 10
+
+
+def build_configs(options):
+    """
+    Returns the list of configurations to run, one dictionary each.
+    """
+    base = {'protocol': 'http', 'mode': 'threaded', 'latency': options.latency,
+            'size': options.size, 'gzip': False, 'cache': 'memcache',
+            'workers': options.workers}
+    variants = [
+        ('http-threaded', {}),
+        ('http-async', {'mode': 'async'}),
+        ('http-gzip', {'gzip': True, 'size': options.size * 16}),
+        ('http-sqlite', {'cache': 'sqlite'}),
+        ('http-nocache', {'cache': 'none'}),
+        ('ftp', {'protocol': 'ftp', 'cache': 'none'}),
+    ]
+
+    configs = []
+    for batch_size in options.batch_sizes:
+        for label, overrides in variants:
+            config = dict(base, **overrides)
+            if config['protocol'] == 'ftp' and batch_size > MAX_FTP_BATCH:
+                continue
+            config['name'] = '%s-%d' % (label, batch_size)
+            config['requests'] = batch_size
+            config['passes'] = config['cache'] == 'none' and ['cold'] or ['cold', 'warm']
+            if options.only and not re.search(options.only, config['name']):
+                continue
+            configs.append(config)
+    return configs
+
+
+# Child process.
+
+class ThreadSampler(threading.Thread):
+    """
+    Records the highest number of live threads, not counting itself.
+    """
+
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.isSet():
+            self.peak = max(self.peak, threading.activeCount() - 1)
+            time.sleep(self.interval)
+
+    def stop(self):
+        # Short runs can finish before the sampler is first scheduled.
+        self.peak = max(self.peak, threading.activeCount() - 1)
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def peak_rss_kb():
+    """
+    Highest RSS of the process since it started, not of the last pass.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes.
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss
+
+
+def milliseconds(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1000, 3)
+
+
+def add_requests(client, config, scratch):
+    from bullfrog.client import Request
+
+    for i in xrange(config['requests']):
+        if config['protocol'] == 'ftp':
+            client.add_request(Request(
+                source='ftp://localhost:%d/' % config['ftp_port'],
+                username='anonymous',
+                password='',
+                ftp_file_pattern='^file%d.bin$' % (i % FTP_FILES),
+                ftp_output_dir=scratch,
+            ))
+        else:
+            params = {'size': config['size'], 'latency': config['latency']}
+            if config['gzip']:
+                params['gzip'] = 1
+            client.add_request(Request(source=config['http_url'] % (config['run_id'], i) + '?' +
+                '&'.join('%s=%s' % item for item in sorted(params.items()))))
+
+
+def run_pass(client, config, scratch, name):
+    from bullfrog.stats import Histogram
+
+    client.reset()
+    add_requests(client, config, scratch)
+
+    sampler = ThreadSampler()
+    sampler.start()
+    start = time.time()
+    if config['mode'] == 'async':
+        requests = client.execute_async()
+    else:
+        requests = client.execute()
+    wall_time = time.time() - start
+    peak_threads = sampler.stop()
+
+    # Cache hits report the response time of the original fetch, so
+    # latency percentiles only count requests that went to the server.
+    fetched = Histogram()
+    for request in requests:
+        response_time = getattr(request, 'response_time', None)
+        if not getattr(request, 'cache_hit', False) and isinstance(response_time, (int, long, float)):
+            fetched.add(response_time)
+
+    stats = client.get_stats()
+    return {
+        'pass': name,
+        'wall_time': round(wall_time, 4),
+        'throughput': round(len(requests) / wall_time, 1),
+        'p50_ms': milliseconds(fetched.percentile(50)),
+        'p95_ms': milliseconds(fetched.percentile(95)),
+        'p99_ms': milliseconds(fetched.percentile(99)),
+        'hit_ratio': stats.hit_ratio,
+        'errors': stats.errors,
+        'timeouts': stats.timeouts,
+        'bytes': stats.bytes,
+        'cache_read_ms': milliseconds(stats.timers.get('cache_read')),
+        'dns_ms': milliseconds(stats.timers.get('dns')),
+        'peak_threads': peak_threads,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def run_worker(config):
+    """
+    Runs every pass of one configuration, returns a list of results.
+    """
+    from bullfrog.client import ClientManager
+
+    scratch = tempfile.mkdtemp(prefix='bullfrog-bench-')
+    try:
+        # Without a cache the sqlite backend is still created, it keeps
+        # the run independent of the memcache client library.
+        cache_backend = config['cache'] == 'memcache' and 'memcache' or 'sqlite'
+        client = ClientManager(nocache=config['cache'] == 'none',
+                               max_workers=config['workers'],
+                               memcached_servers=[config['memcached']],
+                               cache_backend=cache_backend,
+                               cache_options=cache_backend == 'sqlite' and {
+                                   'path': os.path.join(scratch, 'cache.db')} or None)
+        try:
+            results = []
+            for name in config['passes']:
+                result = dict(config)
+                result.update(run_pass(client, config, scratch, name))
+                results.append(result)
+            return results
+        finally:
+            client.close()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+# Parent process.
+
+def spawn(config):
+    """
+    Runs config in a child process and returns its results.
+    """
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = child.communicate(json.dumps(config))[0]
+    if child.returncode != 0:
+        raise RuntimeError("Benchmark %s failed with exit code %d" % (config['name'], child.returncode))
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def describe_tree():
+    try:
+        return subprocess.Popen(['git', 'describe', '--always', '--dirty'], cwd=root_path,
+                                stdout=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+COLUMNS = (
+    ('name', '%-20s', 'config'),
+    ('pass', '%-5s', 'pass'),
+    ('throughput', '%9s', 'req/s'),
+    ('p50_ms', '%9s', 'p50 ms'),
+    ('p95_ms', '%9s', 'p95 ms'),
+    ('p99_ms', '%9s', 'p99 ms'),
+    ('hit_ratio', '%6s', 'hits'),
+    ('errors', '%6s', 'errors'),
+    ('peak_threads', '%8s', 'threads'),
+    ('peak_rss_kb', '%12s', 'max rss kb'),
+)
+
+
+def format_row(result):
+    cells = []
+    for key, width, title in COLUMNS:
+        value = result.get(key)
+        if value is None:
+            value = '-'
+        elif key == 'hit_ratio' and isinstance(value, float):
+            value = '%.2f' % value
+        cells.append(width % value)
+    return ' '.join(cells)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--batch-sizes', default=','.join(map(str, DEFAULT_BATCH_SIZES)),
+                      help='comma separated number of requests per batch')
+    parser.add_option('--quick', action='store_true',
+                      help='only batch sizes %s' % ', '.join(map(str, QUICK_BATCH_SIZES)))
+    parser.add_option('--only', help='regex, run configurations whose name matches')
+    parser.add_option('--latency', type='float', default=10,
+                      help='server latency in milliseconds [%default]')
+    parser.add_option('--size', type='int', default=4096, help='body size in bytes [%default]')
+    parser.add_option('--workers', type='int', default=10, help='ClientManager max_workers [%default]')
+    parser.add_option('--output', help='results file, defaults to results/<time>-<commit>.json')
+    parser.add_option('--worker', action='store_true', help='internal, run one configuration')
+    options, args = parser.parse_args()
+
+    if options.worker:
+        config = json.loads(sys.stdin.read())
+        results = run_worker(config)
+        sys.stdout.write('\n' + json.dumps(results) + '\n')
+        return
+
+    if options.quick:
+        options.batch_sizes = QUICK_BATCH_SIZES
+    else:
+        options.batch_sizes = [int(size) for size in options.batch_sizes.split(',')]
+    configs = build_configs(options)
+
+    try:
+        import memcache
+    except ImportError:
+        print >> sys.stderr, "No memcache client library, skipping memcache configurations"
+        configs = [config for config in configs if config['cache'] != 'memcache']
+
+    http = HttpServer().start()
+    ftp = FtpServer(count=FTP_FILES, size=options.size).start()
+    memcached = MemcacheServer().start()
+
+    print format_row(dict((key, title) for key, width, title in COLUMNS))
+    results = []
+    try:
+        for config in configs:
+            # A fresh URL prefix per configuration so earlier runs never
+            # warm the cache.
+            config.update({
+                'run_id': uuid.uuid4().hex[:8],
+                'http_url': 'http://localhost:%d/bench/%%s/%%d' % http.port,
+                'ftp_port': ftp.port,
+                'memcached': memcached.address(),
+            })
+            for result in spawn(config):
+                for key in ('run_id', 'http_url', 'ftp_port', 'memcached', 'passes'):
+                    result.pop(key, None)
+                results.append(result)
+                print format_row(result)
+                sys.stdout.flush()
+    finally:
+        http.stop()
+        ftp.stop()
+        memcached.stop()
+
+    commit = describe_tree()
+    output = options.output
+    if output is None:
+        output = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                              '%s-%s.json' % (time.strftime('%Y%m%d-%H%M%S'), commit or 'unknown'))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+
+    report = {
+        'commit': commit,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'results': results,
+    }
+    out = open(output, 'w')
+    try:
+        json.dump(report, out, indent=2, sort_keys=True)
+    finally:
+        out.close()
+    print "Results written to", output
+
+
+if __name__ == '__main__':
+    main()
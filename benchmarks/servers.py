@@ -0,0 +1,381 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Stand-in servers for the benchmarks: HTTP, FTP and memcache. Each runs
+    on a daemon thread bound to a free port on 127.0.0.1, so benchmarks need
+    nothing but the standard library (and a memcache client library for the
+    memcache runs).
+
+    Example:
+        http = HttpServer().start()
+        print http.url('/bench/1', size=4096, latency=10, gzip=1)
+"""
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import socket
+import threading
+import time
+import urllib
+from cStringIO import StringIO
+from urlparse import urlparse, parse_qs
+
+
+class ThreadedServer(object):
+    """
+    Base for the stand-ins: runs a SocketServer on a daemon thread.
+    """
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name=self.__class__.__name__)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # Async batches open hundreds of connections at once.
+    request_queue_size = 1024
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+# HTTP
+
+class HttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers any GET with a body shaped by the query string:
+
+        size    -- body size in bytes (default 1024)
+        latency -- milliseconds to wait before answering (default 0)
+        gzip    -- 1 to send the body gzip encoded
+        status  -- response code (default 200)
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    # Headers are written one by one, with Nagle's algorithm and delayed
+    # ACKs every keep-alive response would stall for ~40ms.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        size = int(query.get('size', ['1024'])[0])
+        latency = float(query.get('latency', ['0'])[0])
+        compressed = query.get('gzip', ['0'])[0] == '1'
+        status = int(query.get('status', ['200'])[0])
+
+        if latency:
+            time.sleep(latency / 1000.0)
+
+        body = self.server.body(size, compressed)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+
+class HttpServer(ThreadedServer):
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), HttpHandler)
+        self.server.body = self.body
+        self.bodies = {}
+        self.lock = threading.Lock()
+
+    def body(self, size, compressed):
+        """
+        Bodies are built once per (size, gzip) and reused.
+        """
+        self.lock.acquire()
+        try:
+            key = (size, compressed)
+            if key not in self.bodies:
+                line = 'bullfrog benchmark payload 0123456789 abcdefghijklmnopqrstuvwxyz\n'
+                body = (line * (size / len(line) + 1))[:size]
+                if compressed:
+                    buf = StringIO()
+                    gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+                    gzip_file.write(body)
+                    gzip_file.close()
+                    body = buf.getvalue()
+                self.bodies[key] = body
+            return self.bodies[key]
+        finally:
+            self.lock.release()
+
+    def url(self, path, **params):
+        url = 'http://localhost:%d%s' % (self.port, path)
+        if params:
+            url += '?' + urllib.urlencode(sorted(params.items()))
+        return url
+
+
+# FTP
+
+class FtpHandler(SocketServer.StreamRequestHandler):
+    """
+    Just enough of RFC 959 for ftplib: anonymous login, CWD, PASV, LIST and
+    RETR of the server's in-memory files.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def handle(self):
+        self.passive = None
+        self.reply('220 bullfrog benchmark ftp')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            parts = line.strip().split(' ', 1)
+            command = parts[0].upper()
+            argument = len(parts) > 1 and parts[1] or ''
+
+            handler = getattr(self, 'ftp_' + command.lower(), None)
+            if handler is None:
+                self.reply('502 Command not implemented')
+            elif handler(argument) is False:
+                break
+
+        if self.passive is not None:
+            self.passive.close()
+
+    def ftp_user(self, argument):
+        self.reply('331 Password required')
+
+    def ftp_pass(self, argument):
+        self.reply('230 Logged in')
+
+    def ftp_syst(self, argument):
+        self.reply('215 UNIX Type: L8')
+
+    def ftp_pwd(self, argument):
+        self.reply('257 "/"')
+
+    def ftp_cwd(self, argument):
+        self.reply('250 OK')
+
+    def ftp_type(self, argument):
+        self.reply('200 Type set')
+
+    def ftp_pasv(self, argument):
+        if self.passive is not None:
+            self.passive.close()
+        self.passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.passive.bind(('127.0.0.1', 0))
+        self.passive.listen(1)
+        port = self.passive.getsockname()[1]
+        self.reply('227 Entering Passive Mode (127,0,0,1,%d,%d)' % (port >> 8, port & 0xff))
+
+    def ftp_list(self, argument):
+        lines = []
+        for name, data in sorted(self.server.files.items()):
+            lines.append('-rw-r--r-- 1 owner group %d Jan 01 00:00 %s\r\n' % (len(data), name))
+        self.send_data(''.join(lines))
+
+    def ftp_retr(self, argument):
+        data = self.server.files.get(argument)
+        if data is None:
+            self.reply('550 No such file')
+            return
+        self.send_data(data)
+
+    def ftp_quit(self, argument):
+        self.reply('221 Bye')
+        return False
+
+    def send_data(self, data):
+        if self.passive is None:
+            self.reply('425 Use PASV first')
+            return
+        self.reply('150 Opening data connection')
+        conn, address = self.passive.accept()
+        try:
+            conn.sendall(data)
+        finally:
+            conn.close()
+            self.passive.close()
+            self.passive = None
+        self.reply('226 Transfer complete')
+
+
+class FtpServer(ThreadedServer):
+    """
+    Serves count files named file<n>.bin of size bytes each.
+    """
+
+    def __init__(self, count=10, size=65536):
+        self.server = ThreadingTCPServer(('127.0.0.1', 0), FtpHandler)
+        self.server.files = dict(('file%d.bin' % i, 'x' * size) for i in range(count))
+
+    def url(self):
+        return 'ftp://localhost:%d/' % self.port
+
+
+# Memcache
+
+class MemcacheHandler(SocketServer.StreamRequestHandler):
+    """
+    The memcache text protocol commands used by bullfrog: get/gets, set, add,
+    replace, append, prepend, delete, incr and decr.
+    """
+
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0]
+            if command in ('get', 'gets'):
+                self.get(parts[1:])
+            elif command in ('set', 'add', 'replace', 'append', 'prepend'):
+                self.store(command, parts[1:])
+            elif command == 'delete':
+                found = self.server.store.delete(parts[1])
+                self.wfile.write(found and 'DELETED\r\n' or 'NOT_FOUND\r\n')
+            elif command in ('incr', 'decr'):
+                delta = int(parts[2])
+                if command == 'decr':
+                    delta = -delta
+                value = self.server.store.incr(parts[1], delta)
+                self.wfile.write(value is None and 'NOT_FOUND\r\n' or '%d\r\n' % value)
+            elif command == 'version':
+                self.wfile.write('VERSION bullfrog-benchmark\r\n')
+            else:
+                self.wfile.write('ERROR\r\n')
+
+    def get(self, keys):
+        out = []
+        for key in keys:
+            item = self.server.store.get(key)
+            if item is not None:
+                flags, data = item
+                out.append('VALUE %s %s %d\r\n%s\r\n' % (key, flags, len(data), data))
+        out.append('END\r\n')
+        self.wfile.write(''.join(out))
+
+    def store(self, command, args):
+        key, flags, expires, length = args[0], args[1], int(args[2]), int(args[3])
+        noreply = len(args) > 4 and args[4] == 'noreply'
+        data = self.rfile.read(length + 2)[:-2]
+        stored = self.server.store.set(command, key, flags, data, expires)
+        if not noreply:
+            self.wfile.write(stored and 'STORED\r\n' or 'NOT_STORED\r\n')
+
+
+class MemcacheStore(object):
+    """
+    Thread safe dictionary with memcache's expiry and item size rules.
+    """
+
+    max_item_size = 1048576
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            flags, data, expires = item
+            if expires and expires <= time.time():
+                del self.items[key]
+                return None
+            return flags, data
+        finally:
+            self.lock.release()
+
+    def set(self, command, key, flags, data, expires):
+        if len(data) > self.max_item_size:
+            return False
+        # Like memcache, expiries over 30 days are unix timestamps.
+        if expires and expires <= 2592000:
+            expires += time.time()
+
+        self.lock.acquire()
+        try:
+            item = self.items.get(key)
+            exists = item is not None and not (item[2] and item[2] <= time.time())
+            if command == 'add' and exists or command in ('replace', 'append', 'prepend') and not exists:
+                return False
+            if command == 'append':
+                flags, data = self.items[key][0], self.items[key][1] + data
+            elif command == 'prepend':
+                flags, data = self.items[key][0], data + self.items[key][1]
+            self.items[key] = (flags, data, expires)
+            return True
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            return self.items.pop(key, None) is not None
+        finally:
+            self.lock.release()
+
+    def incr(self, key, delta):
+        self.lock.acquire()
+        try:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value = max(0, int(item[1]) + delta)
+            self.items[key] = (item[0], str(value), item[2])
+            return value
+        finally:
+            self.lock.release()
+
+
+class MemcacheServer(ThreadedServer):
+
+    def __init__(self):
+        self.server = ThreadingTCPServer(('127.0.0.1', 0), MemcacheHandler)
+        self.server.store = MemcacheStore()
+
+    def address(self):
+        return '127.0.0.1:%d' % self.port
@@ -33,12 +33,25 @@ import gzip
 import pprint
 import re
 
+from bullfrog.scheduler import DeadlineExceeded
+from bullfrog.retry import default_policy
+
+class CacheException(Exception):
+    """
+    Raised by cache plugins for values they refuse to store.
+    """
+
+
 class Backend(threading.Thread):
     """
      Backend class. All plugins inherit from this.
      Implements threading so that plugins are transparently multi-threaded.
     """
 
+    # Plugins that implement fetch_async(loop) can run on the event loop used
+    # by ClientManager.execute_async().
+    supports_async = False
+
     def __init__(self, request):
         
         self.request = request
@@ -49,6 +62,9 @@ class Backend(threading.Thread):
         self.recache = self.request.global_recache
         self.accept_compressed = self.request.global_accept_compressed
         self.cache_ttl = self.request.cache_ttl
+        self.stale_while_revalidate = getattr(self.request, 'global_stale_while_revalidate', False)
+        self.stampede_lock = getattr(self.request, 'global_stampede_lock', False)
+        self.retry_policy = getattr(self.request, 'global_retry_policy', None) or default_policy
         
         # Properties of Request override globals set at ClientManager level.
         if hasattr(self.request, "nocache") and self.request.nocache is not self.nocache:
@@ -57,6 +73,12 @@ class Backend(threading.Thread):
             self.recache = self.request.recache
         if hasattr(self.request, "accept_compressed") and self.request.accept_compressed is not self.accept_compressed:
             self.accept_compressed = self.request.accept_compressed
+        if hasattr(self.request, "stale_while_revalidate") and self.request.stale_while_revalidate is not self.stale_while_revalidate:
+            self.stale_while_revalidate = self.request.stale_while_revalidate
+        if hasattr(self.request, "stampede_lock") and self.request.stampede_lock is not self.stampede_lock:
+            self.stampede_lock = self.request.stampede_lock
+        if getattr(self.request, "retry_policy", None) is not None:
+            self.retry_policy = self.request.retry_policy
 
         if hasattr(self.request, "solr_root"):
             self.solr_root = self.request.solr_root
@@ -73,9 +95,116 @@ class Backend(threading.Thread):
         This is implemented by each of the Backend (sub-classes) plugins: Http, Ftp...etc
         """
 
+    def cache_key(self):
+        """
+        Cacheable plugins return the key fetch() would read from cache, or
+        None to skip the cache. ClientManager uses this to read the cache for
+        a whole batch in one round trip.
+        """
+        return None
+
+    def serve_cached(self, cache_tuple, cache_read_time):
+        """
+        Cacheable plugins are handed the result of the batched cache read
+        for cache_key() (None on a miss). Returns True if the request was
+        answered from cache and fetch() does not need to run.
+        """
+        return False
+
     def validate(self):
         """
         This will eventually be part of the interface plugins will need to
         implement. For now it is a no-op. This was originally on the request,
         but it makes more sense to have it on the "server-side".
         """
+
+    def deadline_passed(self):
+        """
+        True once the batch deadline, if there is one, has passed. Plugins
+        should stop working on the request when it has.
+        """
+        deadline = getattr(self.request, 'deadline', None)
+        return deadline is not None and deadline.expired()
+
+    def socket_timeout(self):
+        """
+        The request's timeout, cut down to the time left before the batch
+        deadline.
+        """
+        deadline = getattr(self.request, 'deadline', None)
+        if deadline is None:
+            return self.request.timeout
+        return deadline.clamp(self.request.timeout)
+
+    def settle(self):
+        """
+        Plugins call this before writing their result to the request. False
+        means the batch deadline has already been dealt with by expire()
+        and the result must be dropped.
+        """
+        deadline = getattr(self.request, 'deadline', None)
+        return deadline is None or deadline.settle(self.request)
+
+    def expire(self):
+        """
+        Called by ClientManager for a request that had not finished by the
+        batch deadline. Marks it as timed out; plugins can override this to
+        fall back on a cached copy.
+        """
+        self.request.deadline_exceeded = True
+        self.request.exception = DeadlineExceeded("Batch deadline exceeded")
+
+
+class CacheBackend(Backend):
+    """
+    Interface implemented by cache plugins. ClientManager gives every request
+    its own instance (request.cache), attached with connect() to a pool made
+    once per ClientManager by create_pool().
+
+    Values are stored as (value, cache_ttl, threshold, written) tuples built
+    by write(), see bullfrog.cacheformat. read() returns the tuple or None
+    on a miss.
+    """
+
+    @classmethod
+    def create_pool(cls, manager):
+        """
+        Returns the state shared by every request of a ClientManager, which
+        is handed to connect() and must have a disconnect_all() method.
+        Backend specific settings are in manager.cache_options.
+        """
+        raise NotImplementedError
+
+    def connect(self, pool=None, local=True, value_format='pickle', compress_threshold=None):
+        raise NotImplementedError
+
+    def read(self, key):
+        raise NotImplementedError
+
+    def read_multi(self, keys):
+        """
+        Returns a dictionary of key to cached tuple for the keys found.
+        Backends that can should read them in one round trip.
+        """
+        cached_tuples = {}
+        for key in keys:
+            cached_tuple = self.read(key)
+            if cached_tuple is not None:
+                cached_tuples[key] = cached_tuple
+        return cached_tuples
+
+    def write(self, key, value, cache_ttl=600, threshold=86400):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def acquire_lock(self, key, timeout=30):
+        """
+        Takes a lock on key shared by every process using the cache. Returns
+        a token for release_lock(), or None if the lock is held elsewhere.
+        """
+        raise NotImplementedError
+
+    def release_lock(self, key, token):
+        raise NotImplementedError
@@ -0,0 +1,187 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Serialization of cached tuples, (value, cache_ttl, threshold, written),
+where value is the backend's content tuple.
+
+Two formats are understood:
+
+    pickle  -- the tuple pickled as is. Works for any value.
+    compact -- for Http content tuples (content, headers, code,
+               response_time). A fixed header holds the code, times, TTLs
+               and body length, followed by the length prefixed headers and
+               the raw body, so reading an entry does not unpickle the body.
+               Version 1 values, without the body length, are still read.
+
+loads() tells the formats apart by the compact MAGIC prefix, which a pickle
+never starts with, so both can be read while writers are moved from one to
+the other. Values the compact format cannot hold are written pickled.
+
+Either format can be zlib compressed when larger than a threshold, marked by
+the ZLIB_MAGIC prefix.
+"""
+
+import struct
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+PICKLE = 'pickle'
+COMPACT = 'compact'
+FORMATS = (PICKLE, COMPACT)
+
+MAGIC = '\x00BF'
+ZLIB_MAGIC = '\x00BZ'
+VERSION = 2
+COMPRESS_LEVEL = 6
+
+# magic, version, flags, code, response_time, cache_ttl, threshold, written,
+# number of headers, body length.
+HEADER = struct.Struct('!3sBBhddddII')
+# Version 1 had no body length, so a truncated body went unnoticed.
+HEADER_V1 = struct.Struct('!3sBBhddddI')
+HEADERS = {1: HEADER_V1, 2: HEADER}
+VERSION_FIELD = struct.Struct('!B')
+FIELD = struct.Struct('!HI')
+ENCODING = struct.Struct('!H')
+
+# Flags.
+UNICODE_BODY = 1
+ENCODED_BODY = 2
+
+class CacheFormatError(Exception):
+    pass
+
+
+def dumps(cached_tuple, value_format=PICKLE, compress_threshold=None):
+    """
+    Serializes cached_tuple in value_format. Results larger than
+    compress_threshold bytes are zlib compressed when that makes them
+    smaller.
+    """
+    if value_format not in FORMATS:
+        raise CacheFormatError("Unknown cache value format: %s" % value_format)
+    if value_format == COMPACT and is_compactable(cached_tuple[0]):
+        data = dumps_compact(cached_tuple)
+    else:
+        data = pickle.dumps(cached_tuple)
+
+    if compress_threshold is not None and len(data) > compress_threshold:
+        compressed = ZLIB_MAGIC + zlib.compress(data, COMPRESS_LEVEL)
+        if len(compressed) < len(data):
+            return compressed
+    return data
+
+
+def loads(data):
+    """
+    Decodes a value written by dumps(). Raises CacheFormatError for values
+    that are corrupt or truncated, which cache plugins treat as a miss.
+    """
+    if data.startswith(ZLIB_MAGIC):
+        try:
+            data = zlib.decompress(data[len(ZLIB_MAGIC):])
+        except zlib.error as error:
+            raise CacheFormatError("Corrupt compressed cache value: %s" % error)
+    if data.startswith(MAGIC):
+        return loads_compact(data)
+    try:
+        return pickle.loads(data)
+    except Exception as error:
+        # A damaged pickle can fail in any number of ways, UnpicklingError,
+        # EOFError, ValueError, KeyError, ImportError...
+        raise CacheFormatError("Corrupt pickled cache value: %r" % error)
+
+
+def is_compactable(value):
+    # An optional fifth item is the Content-Encoding the body is still in.
+    if not isinstance(value, tuple) or len(value) not in (4, 5):
+        return False
+    if len(value) == 5 and not isinstance(value[4], str):
+        return False
+    content, headers, code, response_time = value[:4]
+    return (isinstance(content, basestring) and isinstance(headers, dict)
+        and isinstance(code, int) and isinstance(response_time, (int, long, float))
+        and all(isinstance(k, str) and isinstance(v, str) for k, v in headers.iteritems()))
+
+
+def dumps_compact(cached_tuple):
+    value, cache_ttl, threshold, written = cached_tuple
+    content, headers, code, response_time = value[:4]
+
+    flags = 0
+    if isinstance(content, unicode):
+        flags |= UNICODE_BODY
+        content = content.encode('utf-8')
+    if len(value) == 5:
+        flags |= ENCODED_BODY
+
+    parts = [HEADER.pack(MAGIC, VERSION, flags, code, response_time, cache_ttl,
+        threshold, written, len(headers), len(content))]
+    for name, header_value in headers.iteritems():
+        parts.append(FIELD.pack(len(name), len(header_value)))
+        parts.append(name)
+        parts.append(header_value)
+    if flags & ENCODED_BODY:
+        parts.append(ENCODING.pack(len(value[4])))
+        parts.append(value[4])
+    parts.append(content)
+    return ''.join(parts)
+
+
+def loads_compact(data):
+    try:
+        version, = VERSION_FIELD.unpack_from(data, len(MAGIC))
+        header = HEADERS.get(version)
+        if header is None:
+            raise CacheFormatError("Unsupported cache value version: %d" % version)
+        fields = header.unpack_from(data)
+        (magic, version, flags, code, response_time, cache_ttl, threshold, written,
+            header_count) = fields[:9]
+        body_length = fields[9] if version > 1 else None
+
+        offset = header.size
+        headers = {}
+        for i in xrange(header_count):
+            name_length, value_length = FIELD.unpack_from(data, offset)
+            offset += FIELD.size
+            name = data[offset:offset + name_length]
+            offset += name_length
+            headers[name] = data[offset:offset + value_length]
+            offset += value_length
+
+        if flags & ENCODED_BODY:
+            encoding_length, = ENCODING.unpack_from(data, offset)
+            offset += ENCODING.size
+            content_encoding = data[offset:offset + encoding_length]
+            offset += encoding_length
+    except struct.error as error:
+        raise CacheFormatError("Truncated cache value: %s" % error)
+
+    # The body is everything after the headers. Slicing copies it once,
+    # callers need a str.
+    content = data[offset:]
+    if body_length is not None and len(content) != body_length:
+        raise CacheFormatError("Truncated cache value: body is %d bytes, expected %d"
+            % (len(content), body_length))
+    if flags & UNICODE_BODY:
+        try:
+            content = content.decode('utf-8')
+        except UnicodeDecodeError as error:
+            raise CacheFormatError("Corrupt cache value body: %s" % error)
+    if flags & ENCODED_BODY:
+        return (content, headers, code, response_time, content_encoding), cache_ttl, threshold, written
+    return (content, headers, code, response_time), cache_ttl, threshold, written
@@ -13,6 +13,7 @@
 import os
 import sys
 import re
+import Queue
 from urlparse import urlparse
 from time import time
 from datetime import datetime
@@ -21,7 +22,17 @@ import logging
 import logging.handlers
 
 from pluginslib import Plugins
-from plugins import Memcache, DNS
+from scheduler import WorkerPool, Deadline
+from eventloop import EventLoop
+from stats import BatchStats
+import compression
+from plugins import Memcache, Sqlite, DNS
+
+# Cache backends selectable by name with ClientManager(cache_backend=...).
+CACHE_BACKENDS = {
+    'memcache': Memcache.Memcache,
+    'sqlite': Sqlite.Sqlite,
+}
 
 class ClientManager(object):
     """
@@ -34,6 +45,15 @@ class ClientManager(object):
     ClientManager is responsible for loading any plugins and setting up state.
 
     Settings: MEMCACHED_SERVERS, Debug Flag, (Bullfrog Log File)
+
+    Parallel requests are run on a pool of max_workers threads that is kept
+    for the life of the client manager. max_per_host caps how many requests
+    to the same host run at once and queue_size bounds the number of
+    requests waiting for a worker. Call close() to stop the workers.
+
+    retry_policy is the bullfrog.retry.RetryPolicy of requests that don't
+    set one. Every policy draws on a process wide retry budget, so retries
+    stay a fraction of the traffic when an upstream is failing.
     
     Example:
         r = ClientManager()
@@ -52,7 +72,20 @@ class ClientManager(object):
     def __init__(self, nocache=False, 
                        recache=False,
                        accept_compressed=True,
-                       global_overrides=False, ):
+                       global_overrides=False,
+                       max_workers=10,
+                       max_per_host=None,
+                       queue_size=None,
+                       max_connections=512,
+                       local_cache=True,
+                       stale_while_revalidate=False,
+                       stampede_lock=False,
+                       cache_format='pickle',
+                       cache_compress_threshold=None,
+                       memcached_servers=None,
+                       cache_backend='memcache',
+                       cache_options=None,
+                       retry_policy=None, ):
 
         # This should get passed around. Like the village bicycle.
         plugin_load_start = time()
@@ -64,7 +97,11 @@ class ClientManager(object):
         self.requests_by_key = {}
         
         self.threads = []
+        self.pool = None
+        self.cache_pool = None
         self.timers = {}
+        self.stats = None
+        self.deadline = None
         self.logging_data = {}        
        
         # Logging levels.
@@ -82,75 +119,432 @@ class ClientManager(object):
         self.recache = recache
         self.accept_compressed = accept_compressed
         self.global_overrides = global_overrides
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stampede_lock = stampede_lock
+
+        # Worker pool settings, the pool itself is created on first use.
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.queue_size = queue_size
+
+        # Cap on open sockets for execute_async().
+        self.max_connections = max_connections
+
+        # Use the in-process cache tier in front of memcache.
+        self.local_cache = local_cache
+
+        # Format new cache values are written in, 'pickle' or 'compact'.
+        # Both are always readable, see bullfrog.cacheformat.
+        self.cache_format = cache_format
+
+        # Cache values larger than this many bytes are stored compressed.
+        self.cache_compress_threshold = cache_compress_threshold
+
+        # List of "host:port" memcache servers, or a comma separated string.
+        # Falls back to the MEMCACHED_SERVERS environment variable. Keys are
+        # spread over several servers by consistent hashing.
+        if memcached_servers is None:
+            memcached_servers = os.environ.get('MEMCACHED_SERVERS', '127.0.0.1:11211')
+        if isinstance(memcached_servers, basestring):
+            memcached_servers = [s.strip() for s in memcached_servers.split(',') if s.strip()]
+        self.memcached_servers = memcached_servers
+
+        # Cache plugin, a name from CACHE_BACKENDS or a CacheBackend class.
+        # cache_options are passed to its pool, e.g. path and max_bytes for
+        # sqlite.
+        if isinstance(cache_backend, basestring):
+            if cache_backend not in CACHE_BACKENDS:
+                raise ValueError("Unknown cache backend: %s" % cache_backend)
+            cache_backend = CACHE_BACKENDS[cache_backend]
+        self.cache_backend = cache_backend
+        self.cache_options = cache_options or {}
+
+        # bullfrog.retry.RetryPolicy for requests that don't have their own,
+        # None for the default policy.
+        self.retry_policy = retry_policy
         
-    def execute(self, parallel=True):
-        total_runtime_start = time()
-        for request in self.requests:     
-
-                
-            # Backend via request needs to be aware of global vs request 
-            # overrides.
-            request.global_nocache = self.nocache
-            request.global_recache = self.recache
-            request.global_accept_compressed = self.accept_compressed
-            request.global_overrides = self.global_overrides
-
-
-            cache_setup_start = time()
-            request.cache = Memcache.Memcache(request)
-            request.cache.connect()
-            request.dns_cache = DNS.DNS()
-            cache_setup_stop = time()
-            self.timers['cache_setup'] = cache_setup_stop - cache_setup_start
-            
-            scheme = self.parse_scheme(request)
-            if scheme in self.plugins.scheme_to_plugin:
-                backend = self.plugins.scheme_to_plugin[scheme](request)
+    def execute(self, parallel=True, stream=False, deadline=None):
+        """
+        Runs the batch and returns the requests once they have all
+        finished. With stream True returns iter_completed() instead, which
+        yields each request as soon as it is done.
+
+        deadline is a number of seconds execute() returns within, however
+        long the requests take, see iter_completed().
+        """
+        if stream:
+            return self.iter_completed(parallel=parallel, deadline=deadline)
+        if deadline is not None:
+            for request in self.iter_completed(parallel=parallel, deadline=deadline):
+                pass
+            return self.requests
+
+        total_runtime_start = self.start_batch()
+        for backend in self.resolve_hosts(self.read_cache_batch(self.create_backends())):
+            # If running in parallel hand the backend to the worker pool
+            # which calls run() from one of its threads.
+            if parallel:
+                self.submit_backend(backend)
             else:
-                print >> sys.stderr, "No backend plugin found aborting: ", request.source
-                
-            # If running in parallel, call start which is method of Thread
-            # whith then internally delegates to run()
+                backend.run()
+
+        # Make sure all requests finish before returning.
+        if parallel:
+            self.get_pool().join()
+        
+        self.collect_results(total_runtime_start)
+        return self.requests
+
+    def iter_completed(self, callback=None, parallel=True, deadline=None):
+        """
+        Runs the batch like execute() but yields each request as soon as
+        its backend finishes, so callers can use fast results while slow
+        ones are still in flight. Requests answered from cache come first.
+        callback, if given, is called with each request before it is
+        yielded, on the caller's thread.
+
+        With deadline, in seconds, requests still unfinished when it passes
+        are yielded straight away. They are filled from the cache however
+        stale the copy, or marked timed out with deadline_exceeded set.
+        Their fetches give up at their next check of the deadline (every
+        attempt and chunk, socket timeouts are cut to the time left) and
+        can no longer change the request.
+
+        Batch statistics (get_stats()) are available once the iterator is
+        exhausted.
+
+        Example:
+            for request in client.iter_completed(deadline=0.5):
+                render(request.response_content)
+        """
+        total_runtime_start = self.start_batch(deadline)
+        fetching = self.resolve_hosts(self.read_cache_batch(self.create_backends()))
+
+        # Anything that didn't fall through to a fetch is already done.
+        pending = set(backend.request for backend in fetching)
+        finished = [request for request in self.requests if request not in pending]
+
+        completed = Queue.Queue()
+        if parallel:
+            for backend in fetching:
+                self.submit_backend(backend, callback=lambda request=backend.request: completed.put(request))
+
+        for request in finished:
+            yield self.completed_request(request, callback)
+
+        done = set()
+        for backend in fetching:
             if parallel:
-                self.threads.append(backend)
-                backend.start()
+                try:
+                    request = completed.get(True, self.time_left())
+                except Queue.Empty:
+                    break
             else:
+                if self.deadline is not None and self.deadline.expired():
+                    break
                 backend.run()
+                request = backend.request
+            done.add(request)
+            yield self.completed_request(request, callback)
+
+        if len(done) < len(fetching):
+            for request in self.expire_unfinished(fetching, done, completed):
+                yield self.completed_request(request, callback)
+
+        self.collect_results(total_runtime_start)
+
+    def start_batch(self, deadline=None):
+        """
+        Resets the per batch timers and starts the deadline, if any.
+        Returns the time the batch started.
+        """
+        self.timers = {'cache_setup': 0, 'cache_read': 0, 'dns': 0}
+        self.deadline = None
+        if deadline is not None:
+            self.deadline = Deadline(deadline)
+        return time()
+
+    def time_left(self):
+        """
+        Seconds left before the batch deadline, None without one.
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline.remaining()
+
+    def expire_unfinished(self, backends, done=(), completed=None):
+        """
+        Called once the batch deadline has passed. Expires the request of
+        every backend that has not finished and returns them. Backends
+        that settled their request as time ran out are waited for on the
+        completed queue, if given, and returned as well.
+        """
+        expired = []
+        finishing = set()
+        for backend in backends:
+            request = backend.request
+            if request in done:
+                continue
+            if self.deadline.settle(request):
+                backend.expire()
+                expired.append(request)
+            elif completed is not None:
+                finishing.add(request)
+
+        # These are only copying their result over by now.
+        while finishing:
+            request = completed.get()
+            if request in finishing:
+                finishing.discard(request)
+                expired.append(request)
+        return expired
+
+    def completed_request(self, request, callback=None):
+        self.describe_result(request)
+        if callback is not None:
+            callback(request)
+        return request
+
+    def submit_backend(self, backend, callback=None):
+        """
+        Hands a backend to the worker pool, which calls run() from one of
+        its threads and then callback, if given. Backends still queued at
+        the batch deadline are not run, their requests are expired instead.
+        """
+        self.get_pool().submit(backend.run, host=self.parse_host(backend.request),
+                               callback=callback, deadline=self.deadline,
+                               expired=lambda: self.expire_backend(backend))
+
+    def expire_backend(self, backend):
+        """
+        Expires the request of a backend that never ran, unless the client
+        manager already has.
+        """
+        if backend.settle():
+            backend.expire()
+
+    def execute_async(self, deadline=None):
+        """
+        Same as execute() but runs the batch on a single non-blocking event
+        loop instead of a thread per request, so one process can fan out to
+        thousands of endpoints. Requests and their result attributes are
+        the same as with execute(), deadline works the same way too.
+
+        Backends without async support (e.g. Ftp) run on the worker pool
+        alongside the loop.
+        """
+        total_runtime_start = self.start_batch(deadline)
+        loop = EventLoop(max_connections=self.max_connections)
+        on_loop = []
+        threaded = []
+        completed = Queue.Queue()
+
+        for backend in self.resolve_hosts(self.read_cache_batch(self.create_backends())):
+            if backend.supports_async:
+                on_loop.append(backend)
+                try:
+                    backend.fetch_async(loop)
+                except Exception as error:
+                    if backend.settle():
+                        backend.request.exception = error
+            else:
+                self.submit_backend(backend, callback=lambda request=backend.request: completed.put(request))
+                threaded.append(backend)
+
+        if self.deadline is None:
+            loop.run()
+            if threaded:
+                self.get_pool().join()
+        else:
+            # Exchanges still open at the deadline are dropped by the loop.
+            loop.run(until=self.deadline.expires)
+            done = set()
+            for backend in threaded:
+                try:
+                    done.add(completed.get(True, self.time_left()))
+                except Queue.Empty:
+                    break
+            self.expire_unfinished(on_loop)
+            self.expire_unfinished(threaded, done, completed)
+
+        self.collect_results(total_runtime_start)
+        return self.requests
+
+    def create_backends(self):
+        backends = []
+        for request in self.requests:
+            backend = self.create_backend(request)
+            if backend is not None:
+                backends.append(backend)
+        return backends
+
+    def read_cache_batch(self, backends):
+        """
+        Reads the cache for every cacheable request in a single get_multi
+        round trip. Requests answered from cache are filled in on the spot;
+        returns the backends that still need to fetch.
+        """
+        backends_by_key = {}
+        for backend in backends:
+            if backend.scheme in self.plugins.cacheable_plugins:
+                key = backend.cache_key()
+                if key is not None:
+                    backends_by_key.setdefault(key, []).append(backend)
+
+        if not backends_by_key:
+            return backends
+
+        # Every request's cache shares the same client pool, any will do.
+        cache = backends_by_key.values()[0][0].request.cache
+        cache_read_start = time()
+        cache_tuples = cache.read_multi(backends_by_key.keys())
+        cache_read_time = time() - cache_read_start
+        self.timers['cache_read'] = cache_read_time
 
-        # Make sure all threads finish before returning.
-        for t in self.threads:
-            t.join()        
+        served = set()
+        for key, key_backends in backends_by_key.items():
+            for backend in key_backends:
+                if backend.serve_cached(cache_tuples.get(key), cache_read_time):
+                    served.add(backend)
+
+        return [backend for backend in backends if backend not in served]
+
+    def resolve_hosts(self, backends):
+        """
+        Resolves the hostnames of every request that is going to the network
+        in parallel, so fetches find them in the DNS cache instead of
+        blocking on a lookup. Returns backends.
+        """
+        if backends:
+            dns_start = time()
+            hostnames = [self.parse_host(backend.request) for backend in backends]
+            DNS.DNS().resolve_all(hostnames, backends[0].request.cache, pool=self.get_pool(),
+                                  deadline=self.deadline)
+            self.timers['dns'] = time() - dns_start
+        return backends
+
+    def create_backend(self, request):
+        """
+        Sets up cache, DNS and global settings on a request and returns the
+        backend plugin that will fetch it, or None if there isn't one.
+        """
+        # Backend via request needs to be aware of global vs request 
+        # overrides.
+        request.global_nocache = self.nocache
+        request.global_recache = self.recache
+        request.global_accept_compressed = self.accept_compressed
+        request.global_overrides = self.global_overrides
+        request.global_stale_while_revalidate = self.stale_while_revalidate
+        request.global_stampede_lock = self.stampede_lock
+        request.global_retry_policy = self.retry_policy
+        request.deadline = self.deadline
+        request.deadline_exceeded = False
+
+        cache_setup_start = time()
+        request.cache = self.cache_backend(request)
+        request.cache.connect(pool=self.get_cache_pool(), local=self.local_cache,
+                              value_format=self.cache_format,
+                              compress_threshold=self.cache_compress_threshold)
+        request.dns_cache = DNS.DNS()
+        cache_setup_stop = time()
+        self.timers['cache_setup'] += cache_setup_stop - cache_setup_start
         
+        scheme = self.parse_scheme(request)
+        if scheme in self.plugins.scheme_to_plugin:
+            return self.plugins.scheme_to_plugin[scheme](request)
+
+        print >> sys.stderr, "No backend plugin found aborting: ", request.source
+        return None
+
+    def collect_results(self, total_runtime_start):
         total_runtime_stop = time()
         self.timers['total_runtime'] = total_runtime_stop - total_runtime_start
+        stats = BatchStats(self.timers)
 
         for request in self.requests:
-            # this totally breaks with FTP.
-            response_time = '-'
-            if hasattr(request, 'response_time'):
-                response_time = request.response_time
-            
-            exception_msg = ''
-            timed_out = 0
-            if hasattr(request, 'exception'):
-                if re.search("timed out", str(request.exception)):
-                    timed_out=1
-                exception_msg = request.exception
-                
-                if not exception_msg:
-                    exception_msg = ''
+            self.describe_result(request)
+            stats.add(request)
+
+        self.stats = stats
+
+    def describe_result(self, request):
+        """
+        Sets content_length and timed_out on a finished request and indexes
+        it by key.
+        """
+        # this totally breaks with FTP.
+        response_time = '-'
+        if hasattr(request, 'response_time'):
+            response_time = request.response_time
+        
+        exception_msg = ''
+        timed_out = 0
+        if getattr(request, 'deadline_exceeded', False):
+            timed_out = 1
+        elif hasattr(request, 'exception'):
+            if re.search("timed out", str(request.exception)):
+                timed_out=1
+            exception_msg = request.exception
             
-            content_length = 0
-            if request.response_content:
-                content_length = len(str(request.response_content))
+            if not exception_msg:
+                exception_msg = ''
+        
+        # A body still in its Content-Encoding is counted as received
+        # rather than inflated just to measure it.
+        content = request._response_content
+        if request._encoded_content is not None:
+            content = request._encoded_content[0]
+        content_length = getattr(request, 'streamed_bytes', 0)
+        if isinstance(content, basestring):
+            content_length = len(content)
+        elif content and not hasattr(content, 'next'):
+            content_length = len(str(content))
 
-            # Make it easy to get requests by name
-            if hasattr(request, 'key'):
-                self.requests_by_key[request.key] = request
+        request.content_length = content_length
+        request.timed_out = timed_out
 
-        self.cache.mc.disconnect_all()
-        return self.requests
+        # Make it easy to get requests by name
+        if hasattr(request, 'key'):
+            self.requests_by_key[request.key] = request
+
+    def get_stats(self):
+        """
+        Returns the BatchStats of the last execute(): response time and per
+        phase percentiles, hit ratio, bytes and error counts. None before
+        the first execute().
+        """
+        return self.stats
+
+    def get_pool(self):
+        """
+        Returns the worker pool, starting it on first use.
+        """
+        if self.pool is None:
+            self.pool = WorkerPool(max_workers=self.max_workers,
+                                   max_per_host=self.max_per_host,
+                                   queue_size=self.queue_size)
+        return self.pool
+
+    def get_cache_pool(self):
+        """
+        Returns the cache backend's pool shared by all requests, creating it
+        on first use.
+        """
+        if self.cache_pool is None:
+            self.cache_pool = self.cache_backend.create_pool(self)
+        return self.cache_pool
 
+    def close(self):
+        """
+        Stops the worker pool and disconnects the cache pool. The client
+        manager sets them up again if execute() is called again.
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.cache_pool is not None:
+            self.cache_pool.disconnect_all()
+            self.cache_pool = None
 
     def get_request_by_key(self, name):
         return self.requests_by_key.get(name, None)
@@ -185,6 +579,9 @@ class ClientManager(object):
         if match:
             scheme = match.group(0)
         return scheme
+
+    def parse_host(self, request):
+        return urlparse(request.source).hostname
         
 class Request(object):
     """
@@ -204,8 +601,13 @@ class Request(object):
             source
             nocache=False
             recache=False
+            stale_while_revalidate=False
+            stampede_lock=False
             cache_ttl=60
             timeout=5
+            retries=1 (retries after the first attempt)
+            retry_policy=bullfrog.retry.RetryPolicy (which errors are retried
+                and the backoff between attempts)
             username=None
             password=None
             name=None
@@ -216,6 +618,23 @@ class Request(object):
             body=string
             headers=dictionary
             encoding=string (e.g. "utf-8")
+            stream=True|False (response_content is an iterator of chunks)
+            sink=callable or file like object (receives each chunk)
+            chunk_size=int
+            stream_cache_limit=int (largest streamed body that is cached)
+            max_decompressed_size=int (bytes)
+            stampede_wait=float (seconds to wait for another process' refresh)
+            early_expiration_beta=float (0 disables)
+            race_connections=True|False (connect to two addresses, keep the first)
+            cache_compressed=True|False (cache compressed bodies as received,
+                response_content inflates them on first access)
+            hedge=True|False (send a GET again if it is slow to answer)
+            hedge_delay=float (seconds, defaults to the host's p95)
+            hedge_fallback_delay=float (seconds, until the p95 is known)
+
+        Set on the way back out when execute() was given a deadline
+            deadline_exceeded=True|False (unfinished at the deadline, see
+                ClientManager.iter_completed())
         
         FTP Backend Arguments
             cwd
@@ -258,6 +677,29 @@ class Request(object):
             self.source = value
         return property(**locals())
     
+    @apply
+    def response_content():
+        def fget(self):
+            # A body left in its Content-Encoding is inflated on first access.
+            encoded = self._encoded_content
+            if encoded is not None:
+                content, content_encoding, max_size = encoded
+                self._response_content = compression.decompress(content, content_encoding, max_size)
+                self._encoded_content = None
+            return self._response_content
+        def fset(self, value):
+            self._response_content = value
+            self._encoded_content = None
+        return property(**locals())
+
+    def set_encoded_content(self, content, content_encoding, max_size=None):
+        """
+        Sets response_content to a body still in content_encoding. It is only
+        decoded if response_content is read.
+        """
+        self._response_content = None
+        self._encoded_content = (content, content_encoding, max_size)
+
     @apply
     def body():
         def fget(self):
@@ -0,0 +1,144 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import zlib
+
+# First bytes of every gzip member.
+GZIP_MAGIC = '\x1f\x8b'
+
+class DecompressionError(Exception):
+    pass
+
+
+class Decompressor(object):
+    """
+    Incremental decoder for an HTTP Content-Encoding. Chunks are inflated as
+    they are fed in, so neither the whole compressed nor the whole inflated
+    body needs to be held to decode it.
+
+    Handles gzip, deflate (zlib wrapped or raw) and identity, including
+    stacked encodings such as "deflate, gzip". max_size bounds the size of
+    the decoded body and raises DecompressionError when exceeded, which
+    protects against decompression bombs.
+
+    Example:
+        decompressor = Decompressor('gzip', max_size=1048576)
+        for chunk in chunks:
+            out.write(decompressor.decompress(chunk))
+        out.write(decompressor.flush())
+    """
+
+    def __init__(self, content_encoding, max_size=None):
+        encodings = [e.strip().lower() for e in content_encoding.split(',') if e.strip()]
+
+        # Encodings are listed in the order they were applied, so they are
+        # undone in reverse.
+        self.stages = []
+        for encoding in reversed(encodings):
+            if encoding in ('gzip', 'x-gzip'):
+                self.stages.append(Inflater(16 + zlib.MAX_WBITS, max_size))
+            elif encoding == 'deflate':
+                self.stages.append(Inflater(zlib.MAX_WBITS, max_size, raw_fallback=True))
+            elif encoding != 'identity':
+                raise DecompressionError("Unsupported Content-Encoding: %s" % encoding)
+
+    def decompress(self, data):
+        for stage in self.stages:
+            if not data:
+                break
+            data = stage.decompress(data)
+        return data
+
+    def flush(self):
+        data = ''
+        for stage in self.stages:
+            if data:
+                data = stage.decompress(data)
+            data += stage.flush()
+        return data
+
+
+class Inflater(object):
+    """
+    One zlib decoding stage of a Decompressor.
+    """
+
+    def __init__(self, wbits, max_size=None, raw_fallback=False):
+        self.wbits = wbits
+        self.max_size = max_size
+        self.raw_fallback = raw_fallback
+        self.size = 0
+        self.started = False
+        self.trailing = False
+        self.inflater = zlib.decompressobj(wbits)
+
+    def decompress(self, data):
+        # Garbage after the last gzip member is ignored, as browsers do.
+        if self.trailing:
+            return ''
+        try:
+            output = self._decompress(data)
+        except zlib.error:
+            # Some servers send raw deflate data without the zlib wrapper.
+            if not self.raw_fallback or self.started:
+                raise
+            self.raw_fallback = False
+            self.wbits = -zlib.MAX_WBITS
+            self.inflater = zlib.decompressobj(self.wbits)
+            output = self._decompress(data)
+
+        self.started = True
+
+        # A gzip body can be made of several members back to back. Anything
+        # else after a member is trailing garbage. A lone first magic byte
+        # waits for the next chunk, the finished inflater keeps it in
+        # unused_data.
+        while self.inflater.unused_data and self.wbits > zlib.MAX_WBITS:
+            data = self.inflater.unused_data
+            if not GZIP_MAGIC.startswith(data[:2]):
+                self.trailing = True
+                break
+            if len(data) < len(GZIP_MAGIC):
+                break
+            self.inflater = zlib.decompressobj(self.wbits)
+            output += self._decompress(data)
+        return output
+
+    def flush(self):
+        output = self.inflater.flush()
+        self._count(output)
+        return output
+
+    def _decompress(self, data):
+        if self.max_size is None:
+            output = self.inflater.decompress(data)
+        else:
+            # Ask for one byte more than allowed, getting it (or leaving
+            # input unconsumed) means the limit would be exceeded.
+            output = self.inflater.decompress(data, self.max_size - self.size + 1)
+            if self.inflater.unconsumed_tail:
+                raise DecompressionError("Decompressed size exceeds %d bytes" % self.max_size)
+        self._count(output)
+        return output
+
+    def _count(self, output):
+        self.size += len(output)
+        if self.max_size is not None and self.size > self.max_size:
+            raise DecompressionError("Decompressed size exceeds %d bytes" % self.max_size)
+
+
+def decompress(data, content_encoding, max_size=None):
+    """
+    Decodes a complete body.
+    """
+    decompressor = Decompressor(content_encoding, max_size)
+    return decompressor.decompress(data) + decompressor.flush()
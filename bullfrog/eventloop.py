@@ -0,0 +1,209 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncore
+import heapq
+import itertools
+import select
+import socket
+import sys
+import threading
+from collections import deque
+from time import time, sleep
+
+class EventLoop(object):
+    """
+    Single threaded, non-blocking loop used by ClientManager.execute_async().
+    Backends that support it open Channels on the loop instead of blocking a
+    thread per request.
+
+    max_connections caps the number of sockets open at once; channels over
+    the cap wait their turn. call_later() schedules work on the loop, e.g.
+    a retry after a backoff, without blocking it.
+    """
+
+    def __init__(self, max_connections=512):
+        self.map = {}
+        self.max_connections = max_connections
+        self.waiting = deque()
+        self.active = 0
+
+        # Heap of (time, sequence, callback), see call_later().
+        self.timers = []
+        self.sequence = itertools.count()
+
+        # Outstanding work that completes outside the loop, see hold().
+        self.held = 0
+        self.lock = threading.Lock()
+
+        # poll() is not limited to FD_SETSIZE sockets like select() is.
+        self.use_poll = hasattr(select, 'poll')
+
+    def open(self, channel):
+        """
+        Starts the channel now, or once a connection slot frees up.
+        """
+        if self.active < self.max_connections:
+            self._start(channel)
+        else:
+            self.waiting.append(channel)
+
+    def hold(self):
+        """
+        Keeps the loop running until a matching release(), for work that is
+        completed by another thread. Safe to call from any thread.
+        """
+        self.lock.acquire()
+        self.held += 1
+        self.lock.release()
+
+    def release(self):
+        self.lock.acquire()
+        self.held -= 1
+        self.lock.release()
+
+    def call_later(self, delay, callback):
+        """
+        Calls callback() from the loop once delay seconds have passed.
+        The loop keeps running until it has been called. cancel() calls
+        pending callbacks straight away, they should check whether it is
+        too late to do anything.
+        """
+        heapq.heappush(self.timers, (time() + delay, next(self.sequence), callback))
+
+    def run(self, until=None):
+        """
+        Runs until every channel has finished, including channels opened
+        by callbacks while the loop is running, and every hold() has been
+        released, and every call_later() has been made. With until, a time()
+        value, channels still open or waiting at that point are failed with
+        a timeout, see cancel().
+        """
+        while self.map or self.waiting or self.held or self.timers:
+            if until is not None and time() >= until:
+                self.cancel(socket.timeout('timed out'))
+                return
+
+            now = time()
+            while self.timers and self.timers[0][0] <= now:
+                heapq.heappop(self.timers)[2]()
+
+            while self.waiting and self.active < self.max_connections:
+                self._start(self.waiting.popleft())
+
+            timeout = 0.05
+            if self.timers:
+                timeout = max(0, min(timeout, self.timers[0][0] - time()))
+            if until is not None:
+                timeout = max(0, min(timeout, until - time()))
+
+            if self.map:
+                asyncore.loop(timeout=timeout, use_poll=self.use_poll, map=self.map, count=1)
+            else:
+                sleep(min(timeout, 0.01))
+
+            now = time()
+            for channel in self.map.values():
+                if channel.deadline and now > channel.deadline:
+                    channel.fail(socket.timeout('timed out'))
+
+    def cancel(self, error):
+        """
+        Fails every open and waiting channel with error, then makes the
+        pending call_later() calls.
+        """
+        waiting = self.waiting
+        self.waiting = deque()
+        for channel in self.map.values() + list(waiting):
+            channel.fail(error)
+        while self.timers:
+            heapq.heappop(self.timers)[2]()
+
+    def _start(self, channel):
+        self.active += 1
+        channel.start()
+
+    def _closed(self, channel):
+        self.active -= 1
+
+
+class Channel(asyncore.dispatcher):
+    """
+    One request/response exchange: connects to address, writes data and
+    reads until the server closes the connection. callback is called exactly
+    once with (data, error).
+    """
+
+    def __init__(self, loop, address, data, timeout, callback):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.loop = loop
+        self.address = address
+        self.outgoing = data
+        self.incoming = []
+        self.timeout = timeout
+        self.callback = callback
+        self.deadline = None
+        self.done = False
+        self.started = None
+
+        # Seconds from start() to connecting and to the first byte of the
+        # response, None until they happen.
+        self.connect_time = None
+        self.first_byte_time = None
+
+    def start(self):
+        self.started = time()
+        self.deadline = self.started + self.timeout
+        try:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connect(self.address)
+        except socket.error as error:
+            self.fail(error)
+
+    def writable(self):
+        return not self.connected or bool(self.outgoing)
+
+    def handle_connect(self):
+        self.connect_time = time() - self.started
+
+    def handle_write(self):
+        sent = self.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            if self.first_byte_time is None:
+                self.first_byte_time = time() - self.started
+            self.incoming.append(data)
+            # Only a silent connection times out, not a slow one.
+            self.deadline = time() + self.timeout
+
+    def handle_close(self):
+        self._finish(''.join(self.incoming), None)
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def fail(self, error):
+        self._finish(None, error)
+
+    def _finish(self, data, error):
+        if self.done:
+            return
+        self.done = True
+        if self.socket is not None:
+            self.close()
+        # Channels failed while waiting for a slot never took one.
+        if self.started is not None:
+            self.loop._closed(self)
+        self.callback(data, error)
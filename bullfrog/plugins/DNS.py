@@ -12,38 +12,176 @@
 
 from bullfrog.backend import Backend
 from socket import gethostbyname_ex, gethostbyname
+import socket
 import random
+import threading
+import select
+import errno
+import os
+from time import time
 
 class DNS():
     """
     DNSCache handles caching the resolution of ips for hostnames to
     speed up common network fetches.
+
+    A records are kept in a process wide HostCache, backed by memcache
+    (dns_<host>) so other processes can share lookups. resolve_all() looks
+    up a batch of hostnames in parallel ahead of time so that fetches do not
+    block on DNS.
+
+    When a host has several addresses, resolve() prefers fast, healthy ones
+    using the connect latencies and failures recorded in host_health.
     """
     
     scheme = "dns"
     backend_type = "backend"
     enabled = True
 
-    """
-        Implement this to allow parallel dns resolutions similar to other backends.
-    """
     def fetch(self):
+        # Parallel resolution is done by resolve_all().
         pass
 
     def resolve(self, hostname, cache):
-        ip_address = None
-        ip_cache_tuple = cache.read("dns_"+hostname)
-        
-        if ip_cache_tuple and len(ip_cache_tuple) > 0:
-            ip_address = self.get_random_ip(ip_cache_tuple[0])
-       
-        # If ip is None there was a cache miss. Resolve and cache.
-        if not ip_address:
+        ips = host_health.choose(self.lookup(hostname, cache))
+        return ips[0] if ips else None
+
+    def candidates(self, hostname, cache, count=2):
+        """
+        Returns up to count different addresses for hostname, best first.
+        """
+        return host_health.choose(self.lookup(hostname, cache), count)
+
+    def lookup(self, hostname, cache=None):
+        """
+        Returns the A records for hostname from memory, memcache or, failing
+        both, a blocking lookup. A recent failed lookup is raised again
+        without going to the network.
+        """
+        arecord = host_cache.get(hostname)
+        if arecord:
+            return arecord
+
+        if cache is not None:
+            ip_cache_tuple = cache.read("dns_" + hostname)
+            if ip_cache_tuple and ip_cache_tuple[0]:
+                host_cache.put(hostname, ip_cache_tuple[0])
+                return ip_cache_tuple[0]
+
+        # Cache miss. Resolve and cache.
+        try:
             arecord = gethostbyname_ex(hostname)[2]
-            cache.write("dns_%s" % hostname, arecord, cache_ttl=3600)
-            ip_address = self.get_random_ip(arecord)
+        except socket.error as error:
+            host_cache.put_error(hostname, error)
+            raise
 
-        return ip_address
+        host_cache.put(hostname, arecord)
+        if cache is not None:
+            cache.write("dns_%s" % hostname, arecord, cache_ttl=host_cache.ttl)
+        return arecord
+
+    def resolve_all(self, hostnames, cache=None, pool=None, deadline=None):
+        """
+        Looks up every hostname not already in the HostCache, in parallel on
+        pool (a WorkerPool) when one is given. Failures are cached rather
+        than raised; they surface when the request itself resolves.
+
+        With a Deadline, waits no longer than the time left. Lookups still
+        queued then are dropped, and hostnames not resolved by then are
+        resolved by their requests when they fetch.
+        """
+        pending = [h for h in set(hostnames) if h and not host_cache.has(h)]
+        if pool is None:
+            for hostname in pending:
+                if deadline is not None and deadline.expired():
+                    break
+                self._prefetch(hostname, cache)
+            return
+
+        if not pending:
+            return
+        lock = threading.Lock()
+        done = threading.Event()
+        count = [len(pending)]
+
+        def finished():
+            lock.acquire()
+            try:
+                count[0] -= 1
+                if not count[0]:
+                    done.set()
+            finally:
+                lock.release()
+
+        for hostname in pending:
+            job = lambda hostname=hostname: self._prefetch(hostname, cache)
+            pool.submit(job, callback=finished, deadline=deadline)
+        if deadline is None:
+            done.wait()
+        else:
+            done.wait(deadline.remaining())
+
+    def _prefetch(self, hostname, cache):
+        try:
+            self.lookup(hostname, cache)
+        except socket.error:
+            pass
+
+    def connect_first(self, ip_list, port, timeout):
+        """
+        Connects to every address in ip_list at once and returns (ip, socket)
+        for the first to succeed. The others are closed. Raises socket.error
+        if none connect within timeout.
+        """
+        start = time()
+        pending = {}
+        error = None
+        for ip in ip_list:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            code = sock.connect_ex((ip, port))
+            if code in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                pending[sock] = ip
+            else:
+                sock.close()
+                host_health.record_failure(ip)
+                error = socket.error(code, os.strerror(code))
+
+        winner = None
+        try:
+            while pending and winner is None:
+                remaining = start + timeout - time()
+                if remaining <= 0:
+                    for ip in pending.values():
+                        host_health.record_failure(ip)
+                    error = socket.timeout('timed out')
+                    break
+
+                writable = select.select([], pending.keys(), [], remaining)[1]
+                for sock in writable:
+                    ip = pending.pop(sock)
+                    code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if code:
+                        sock.close()
+                        host_health.record_failure(ip)
+                        error = socket.error(code, os.strerror(code))
+                    elif winner is None:
+                        host_health.record_success(ip, time() - start)
+                        winner = (ip, sock)
+                    else:
+                        sock.close()
+        finally:
+            # Losers are only slower, not unhealthy.
+            for sock in pending:
+                sock.close()
+
+        if winner is None:
+            raise error or socket.timeout('timed out')
+
+        ip, sock = winner
+        sock.setblocking(1)
+        sock.settimeout(timeout)
+        return ip, sock
 
     def get_random_ip(self, ip_list):
         ip_address = None
@@ -52,3 +190,161 @@ class DNS():
             random_index = random.randrange(0, len(ip_list))
             ip_address = ip_list[random_index]
         return ip_address
+
+
+class HostCache(object):
+    """
+    Thread safe in-memory cache of hostname to A records. Entries live for
+    ttl seconds; failed lookups are remembered for negative_ttl seconds.
+    """
+
+    def __init__(self, ttl=3600, negative_ttl=30):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, hostname):
+        """
+        Returns the A records for hostname or None if unknown. Raises the
+        cached error for a recent failed lookup.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(hostname)
+            if entry is None:
+                return None
+            arecord, error, expires = entry
+            if expires <= time():
+                del self.entries[hostname]
+                return None
+        finally:
+            self.lock.release()
+
+        if error is not None:
+            raise error
+        return arecord
+
+    def has(self, hostname):
+        try:
+            return self.get(hostname) is not None
+        except socket.error:
+            return True
+
+    def put(self, hostname, arecord, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.lock.acquire()
+        try:
+            self.entries[hostname] = (arecord, None, time() + ttl)
+        finally:
+            self.lock.release()
+
+    def put_error(self, hostname, error):
+        self.lock.acquire()
+        try:
+            self.entries[hostname] = (None, error, time() + self.negative_ttl)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries = {}
+        finally:
+            self.lock.release()
+
+
+class HostHealth(object):
+    """
+    Thread safe record of connect latency and failures per IP address.
+
+    alpha        -- weight of the newest sample in the latency moving average.
+    max_failures -- consecutive failures before an address is ejected.
+    eject_time   -- seconds an ejected address is passed over. Once it is
+                    back one more failure ejects it again, a success
+                    restores it.
+    """
+
+    def __init__(self, alpha=0.3, max_failures=3, eject_time=30):
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.lock = threading.Lock()
+
+        # ip -> [latency, consecutive failures, ejected until]
+        self.stats = {}
+
+    def record_success(self, ip, latency):
+        self.lock.acquire()
+        try:
+            stats = self.stats.get(ip)
+            if stats is None or stats[0] is None:
+                self.stats[ip] = [latency, 0, 0]
+            else:
+                stats[0] += self.alpha * (latency - stats[0])
+                stats[1] = 0
+                stats[2] = 0
+        finally:
+            self.lock.release()
+
+    def record_failure(self, ip):
+        self.lock.acquire()
+        try:
+            stats = self.stats.setdefault(ip, [None, 0, 0])
+            stats[1] += 1
+            if stats[1] >= self.max_failures:
+                stats[2] = time() + self.eject_time
+        finally:
+            self.lock.release()
+
+    def choose(self, ip_list, count=1):
+        """
+        Returns up to count different addresses from ip_list. Ejected
+        addresses are skipped unless every address is ejected. Each pick
+        takes the faster of two random candidates, so traffic leans towards
+        fast addresses without piling onto one. Addresses not yet measured
+        count as fast so they get tried.
+        """
+        if not ip_list:
+            return []
+
+        now = time()
+        self.lock.acquire()
+        try:
+            latency = {}
+            healthy = []
+            for ip in ip_list:
+                stats = self.stats.get(ip)
+                if stats is not None and stats[2] > now:
+                    continue
+                healthy.append(ip)
+                latency[ip] = stats and stats[0] or 0
+        finally:
+            self.lock.release()
+
+        if not healthy:
+            healthy = list(ip_list)
+
+        chosen = []
+        while healthy and len(chosen) < count:
+            if len(healthy) == 1:
+                pick = healthy[0]
+            else:
+                first, second = random.sample(healthy, 2)
+                pick = first if latency.get(first, 0) <= latency.get(second, 0) else second
+            healthy.remove(pick)
+            chosen.append(pick)
+        return chosen
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.stats = {}
+        finally:
+            self.lock.release()
+
+
+# Shared by every DNS instance in the process.
+host_cache = HostCache()
+host_health = HostHealth()
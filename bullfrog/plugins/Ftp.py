@@ -11,6 +11,7 @@
 # limitations under the License. 
 
 import re
+from time import time
 
 from ftplib import FTP
 from urlparse import urlparse
@@ -30,18 +31,30 @@ class Ftp(Backend):
             
         """ Grok any arguments and suck down content """
         files = []
+        start = time()
 
-        ftp = FTP(self.request.hostname)
+        # Blocking without a timeout, unless there is a batch deadline.
+        options = {}
+        if getattr(self.request, 'deadline', None) is not None:
+            options['timeout'] = self.socket_timeout()
+
+        ftp = FTP()
+        ftp.connect(self.request.hostname, self.request.port or 21, **options)
         ftp.login(self.request.username, self.request.password)
         ftp.cwd(self.request.ftp_cwd)
             
         ftp.dir(files.append)
         for f in files:
+            # Out of time for the batch, leave the rest.
+            if self.deadline_passed():
+                break
             file_name = re.split('\s+', f)[8]
             if re.match(self.request.ftp_file_pattern, file_name):
                 self._get_binary(ftp, file_name)
 
         ftp.quit()
+        if self.settle():
+            self.request.response_time = time() - start
 
     def _get_binary(self, ftp, filename):
         out = self.request.ftp_output_dir + "/" + filename
@@ -10,250 +10,1229 @@
 # See the License for the specific language governing permissions and
 # limitations under the License. 
 
-from time import time
-import urllib2
+from time import time, sleep
 import httplib
-from urllib2 import URLError, HTTPError
+import urllib2
+from urllib2 import HTTPError
 import sys
+import threading
+import copy
+import Queue
+import math
+import random
+import errno
+import heapq
+import itertools
+from collections import deque
 
-from urlparse import urlparse
+from urlparse import urlparse, urljoin
 
 from cStringIO import StringIO
-import gzip
 
 import logging
 import re
 import socket
 
-from bullfrog.backend import Backend
+from bullfrog.backend import Backend, CacheException
+from bullfrog.eventloop import Channel
+from bullfrog.compression import Decompressor
+from bullfrog.scheduler import WorkerPool, DeadlineExceeded
+from bullfrog.plugins.DNS import host_health
+from bullfrog.stats import Histogram
+
+# Methods that are safe to send twice, see send().
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
 
 class Http(Backend):
 
     """
     As the name implies this backend plugin is responsible for HTTP requests.
+
+    Streaming: with stream=True on the Request, response_content is an
+    iterator over chunks of the body, read from the connection as the caller
+    consumes it. With sink=callable (or a file like object) each chunk is
+    handed to the sink during the fetch and response_content is None.
+    Decompression and regex validation run on the stream and the body is
+    only cached if it fits in stream_cache_limit bytes.
+
+    Stale-while-revalidate: with stale_while_revalidate set, an entry past
+    cache_ttl but inside its threshold is returned straight away with
+    cache_is_stale set, and the cache is refreshed in the background.
+
+    Concurrent GETs of the same source (and headers and cache flags) in the
+    process share a single fetch; the requests that waited on another have
+    coalesced set.
+
+    Stampede protection: with stampede_lock set, only one process at a time
+    refreshes an expired key, using a memcache add lock. early_expiration_beta
+    staggers refreshes by expiring entries early at random.
+
+    Hedging: with hedge set, a GET that has no response after hedge_delay
+    seconds (by default the host's recent p95 response time) is sent again,
+    to another address if the host has one. The first response is used and
+    the other attempt is closed. request.hedged tells if a second attempt
+    went out. Threaded fetches only.
+
+    Retries: failed attempts are retried according to the request's
+    retry_policy (see bullfrog.retry), only for network errors and 429/5xx
+    responses, after an exponential backoff with jitter and while the
+    process wide retry budget lasts. Async fetches wait out the backoff on
+    the event loop.
     """
     
     scheme = "http"
     backend_type = 'backend'
     enabled = True
 
+    cacheable = True
+
+    max_redirections = 2
+
+    # Streaming defaults, can be overridden on the Request.
+    chunk_size = 65536
+    stream_cache_limit = 1048576
+    stream_regex_window = 4096
+
+    # Decoded bodies larger than this are rejected.
+    max_decompressed_size = 67108864
+
+    # (cache_tuple, cache_read_time) from ClientManager's batched cache read.
+    prefetched = None
+
+    # Stampede protection, see take_refresh_lock() and early_expiration().
+    refresh_lock = None
+    stampede_wait = 1.0
+    early_expiration_beta = 0
+
+    # Connect to two addresses at once and keep the first, see choose_ip().
+    race_connections = False
+
+    # Cache compressed bodies as received, see keeps_encoding().
+    cache_compressed = False
+
+    # Hedged GETs, see hedge_delay(). The delay is the host's p95 response
+    # time once hedge_min_samples have been seen, hedge_fallback_delay
+    # before that, unless hedge_delay is set on the Request.
+    hedge = False
+    hedge_percentile = 95
+    hedge_min_samples = 20
+    hedge_fallback_delay = 0.1
+
+    @property
+    def supports_async(self):
+        # A streamed body is read after the fetch returns, which needs a
+        # blocking connection of its own.
+        return not self.is_streaming()
+
     def fetch(self):
         
         # For testing only.
         if self.request.fail_flag:
-            self.request.exception = Exception("Timeout")
+            if self.settle():
+                self.request.exception = Exception("Timeout")
+            return
+
+        if not self.join_flight():
             return
+        try:
+            self.do_fetch()
+        finally:
+            self.end_fetch()
 
+    def do_fetch(self):
         self.request_parser()
         
+        # IF cache miss, or recache flag is true fetch content and cache.
+        if self.read_cache() and self.take_refresh_lock():
+            self.build_request()
+            self.retry_policy.record_request()
+
+            while True:
+                try:
+                    if self.deadline_passed():
+                        raise DeadlineExceeded("Batch deadline exceeded")
+                    self.choose_ip()
+                    fetch_start = time()
+                    hedge_delay = self.hedge_delay()
+                    if hedge_delay is not None:
+                        http_response, http_body, final_url = self.open_hedged(hedge_delay)
+                        response_time = time() - fetch_start
+                        self.handle_response(http_response.status, http_response.msg, http_body, final_url, response_time)
+                        break
+
+                    http_response, stream, final_url = self.open(self.ip_source, self.request_headers, self.request.body, stream=True)
+                    if self.is_streaming() and http_response.status != 304:
+                        fetch_stop = time()
+                        self.handle_stream(http_response, stream, final_url, fetch_stop - fetch_start)
+                    else:
+                        download_start = time()
+                        http_body = self.read_body(stream, http_response.msg)
+                        fetch_stop = time()
+                        self.add_timing('download', fetch_stop - download_start - (self.decompression_time or 0))
+                        response_time = fetch_stop - fetch_start - (self.decompression_time or 0)
+                        self.handle_response(http_response.status, http_response.msg, http_body, final_url, response_time, decoded=True)
+                    break
+                except Exception as error:
+                    if not self.handle_error(error):
+                        break
+                    sleep(self.retry_delay)
+
+        self.finish()
+
+    def fetch_async(self, loop):
+        """
+        Non-blocking counterpart of fetch(). Opens the request on an
+        EventLoop and finishes from the loop's callbacks. Cache, DNS,
+        decompression and validation are the same as fetch().
+        """
+        if self.request.fail_flag:
+            if self.settle():
+                self.request.exception = Exception("Timeout")
+            return
+
+        if not self.join_flight(loop):
+            return
+        try:
+            self.request_parser()
+
+            if not self.read_cache() or not self.take_refresh_lock(in_loop=True):
+                self.finish()
+                self.end_fetch()
+                return
+
+            self.build_request()
+            self.retry_policy.record_request()
+            self.choose_ip(in_loop=True)
+            AsyncExchange(self, loop).start()
+        except Exception:
+            self.end_fetch()
+            raise
+
+    def flight_key(self):
+        """
+        Key under which concurrent identical fetches are coalesced, or None
+        if this request must not share its fetch.
+        """
+        if self.request.body is not None or self.is_streaming():
+            return None
+        if not getattr(self.request, 'coalesce', True):
+            return None
+        method = getattr(self.request, 'method', None)
+        if method and method.upper() != 'GET':
+            return None
+
+        parsed = urlparse(self.request.source)
+        netloc = (parsed.hostname or '').lower()
+        if parsed.port and parsed.port != httplib.HTTP_PORT:
+            netloc = '%s:%d' % (netloc, parsed.port)
+        url = '%s://%s%s' % (parsed.scheme.lower(), netloc, parsed.path or '/')
+        if parsed.query:
+            url = url + '?' + parsed.query
+
+        # Anything that changes what comes back, or how hard the fetch tries
+        # to get it and where it is cached, is part of the key. A follower
+        # must not be handed a result its own settings would not have given.
+        request = self.request
+        headers = sorted((k.lower(), v) for k, v in getattr(request, 'headers', {}).items())
+        self.apply_overrides()
+        cache = getattr(request, 'cache', None)
+        return (url, tuple(headers), self.nocache, self.recache,
+                tuple(getattr(request, 'regex_validators', ())),
+                request.timeout, request.retries, self.retry_policy,
+                getattr(request, 'max_decompressed_size', self.max_decompressed_size),
+                self.keeps_encoding(),
+                getattr(request, 'hedge', self.hedge), getattr(request, 'hedge_delay', None),
+                getattr(request, 'hedge_percentile', self.hedge_percentile),
+                getattr(request, 'hedge_min_samples', self.hedge_min_samples),
+                getattr(request, 'hedge_fallback_delay', self.hedge_fallback_delay),
+                cache.__class__, getattr(cache, 'pool', None), getattr(cache, 'local', None) is not None,
+                getattr(cache, 'value_format', None), getattr(cache, 'compress_threshold', None))
+
+    def join_flight(self, loop=None):
+        """
+        Joins the in-flight fetch for the same key if there is one. Returns
+        True if this backend leads and should fetch. Followers get the
+        leader's result copied over, blocking in a thread or from a loop
+        callback.
+        """
+        self.flight = None
+        self.request.coalesced = False
+        key = self.flight_key()
+        if key is None:
+            return True
+
+        flight, leader = single_flight.join(key)
+        if leader:
+            self.flight = flight
+            return True
+
+        if loop is None:
+            # Give up waiting at the batch deadline and expire the request
+            # ourselves, the client manager counts it as finished.
+            deadline = getattr(self.request, 'deadline', None)
+            if flight.wait(deadline and deadline.remaining()):
+                self.copy_result(flight.request)
+            elif self.settle():
+                self.expire()
+        else:
+            loop.hold()
+            def landed(request):
+                self.copy_result(request)
+                loop.release()
+            flight.add_callback(landed)
+        return False
+
+    def end_fetch(self):
+        """
+        Called once a fetch is over, however it ended.
+        """
+        if self.refresh_lock is not None:
+            self.request.cache.release_lock(self.request.source, self.refresh_lock)
+            self.refresh_lock = None
+        if self.flight is not None:
+            single_flight.land(self.flight, self.request)
+            self.flight = None
+
+    def copy_result(self, request):
+        if not self.settle():
+            return
+        for name in RESULT_ATTRIBUTES:
+            if hasattr(request, name):
+                setattr(self.request, name, getattr(request, name))
+        self.request.coalesced = True
+
+    def read_cache(self):
+        """
+        First half of a fetch. Sets up state and reads the cache. Returns
+        True if the network needs to be hit.
+        """
         # timers
-        cache_read_time = None
-        cache_write_time = None
+        self.cache_read_time = None
+        self.cache_write_time = None
+        self.decompression_time = None
+
+        # Seconds spent in each phase of the fetch, see add_timing().
+        self.timings = {}
+        self.request.timings = self.timings
         
         # Threshold stuff. Tuple returned from cache, and content is what
         # is ultimately returned to the user.
-        cache_is_fresh = False
-        content = None
-        
-        decompression_time = None
+        self.cache_is_fresh = False
+        self.content = None
+        self.content_encoding = None
+        self.response_headers = None
+        self.response_code = None
+        self.response_time = None
         
         self.request.resp_was_compressed = False
         self.request.is_redirected = False
+        self.request.revalidated = False
+        self.request.cache_is_stale = False
+        self.request.refresh_scheduled = False
+        self.request.hedged = False
+        self.revalidating = False
         
         # Note: both of these can be true when recache flag is true.
-        cache_hit = False # Was content pulled from a cache source or not.
-        cache_write = False # Did we write anything to cache?
+        self.cache_hit = False # Was content pulled from a cache source or not.
+        self.cache_write = False # Did we write anything to cache?
+        self.skip_cache_write = False
+        self.failed = False
+        self.error = None
+        self.deadline_exceeded = False
 
-        # handle / apply global overrides
-        if self.request.global_overrides:
-            self.nocache = self.request.global_nocache
-            self.recache = self.request.global_recache
-        
-        
-        # Log all redirects up to maximum. Array of Redirect Dictionaries
-        # Dictionary contains all header information.
-        # Pending rewrite to httplib.
-        # redirect_chain = []
+        # Retries made by this fetch and the backoff before the next one,
+        # see handle_error().
+        self.retry_count = 0
+        self.retry_delay = 0
+
+        self.apply_overrides()
 
         # Only skip cache read if nocache flag is true
         cache_tuple = None
-        content_tuple = None
+        self.content_tuple = None
         if not self.nocache:
-            cache_read_time_start = time()
-            cache_tuple = self.request.cache.read(self.request.source)
-            cache_read_time_stop = time() 
-            cache_read_time = cache_read_time_stop - cache_read_time_start
-            
+            if self.prefetched:
+                cache_tuple, self.cache_read_time = self.prefetched
+            else:
+                cache_read_time_start = time()
+                cache_tuple = self.request.cache.read(self.request.source)
+                cache_read_time_stop = time() 
+                self.cache_read_time = cache_read_time_stop - cache_read_time_start
             
             # Other half of cache threshold implementation.
             current_time = time()
-            backend_tuple = None
-            
 
-            # print >> sys.stderr, 'Cache Tuple: ', cache_tuple
             if cache_tuple:
-                content_tuple = cache_tuple[0]
-                if cache_tuple[1] + cache_tuple[3] > current_time:
-                    cache_is_fresh = True
-                else:
-                    cache_tuple = None
+                self.content_tuple = cache_tuple[0]
+                if cache_tuple[1] + cache_tuple[3] > current_time + self.early_expiration(cache_tuple):
+                    self.cache_is_fresh = True
            
             # Check threshold is within limit. If not, fetch.
-            if content_tuple and cache_is_fresh:
-                content = content_tuple[0]
-                response_headers = content_tuple[1]
-                response_code = content_tuple[2]
-                response_time = content_tuple[3]
-                cache_hit = True
-                
+            if self.content_tuple and self.cache_is_fresh:
+                self.use_content_tuple(self.content_tuple)
 
-            
-        # IF cache miss, or recache flag is true fetch content and cache.
-        if self.recache or not cache_tuple or not cache_is_fresh:
-            
-                # Use IP from DNS Cache lookup. I should add an off flag.
-                new_source = StringIO()
-                new_source.write('http://')
-                new_source.write(self.request.ip)
-                if self.request.port:
-                    new_source.write(':' + str(self.request.port))
-                new_source.write(self.request.path)
-                
-                if self.request.query:
-                    new_source.write('?')
-                    new_source.write(self.request.query)
-                
-                ip_source = new_source.getvalue()
-                request = urllib2.Request(ip_source)      
-
-                # Add Host header so that when using ip from DNS cache
-                # The correct VHOST is hit on the remote server.
-                request.add_unredirected_header('Host', self.request.hostname)
-                request.add_header('Accept', 'text/html, text/plain')
-                request.add_header('User-Agent', 'Bullfrog +http://github.com/yourabi/bullfrog')
-
-                
-                if hasattr(self.request, 'headers'):
-                    for header in self.request.headers:
-                        if header.lower() == "host":
-                            request.add_unredirected_header(header, self.request.headers[header])
-                        else:
-                            request.add_header(header, self.request.headers[header])
-                
-                # TODO: Is this really correct?
-                if hasattr(self.request, "accept_compressed") and self.request.accept_compressed or self.request.global_accept_compressed:
-                    request.add_header('Accept-Encoding', 'gzip,compress,deflate')
-               
-                http_response = None
-                while not http_response and self.request.retry_count <= self.request.retries:
-                    #print "LOOP OUTER"
-                    try:
-                        #print "TOP OF REQUEST LOOP"
-                        
-                        ### MEAT OF REQUEST
-                        opener = urllib2.build_opener(RedirectHandler)
-                        # opener = urllib2.build_opener(urllib2.HTTPHandler(debuglevel=1))
-                        fetch_start = time()
-                        if self.request.body is not None:
-                            if hasattr(self.request, "encoding"):
-                                self.request.body = self.request.body.encode(self.request.encoding)
-                        http_response = opener.open(request, self.request.body, self.request.timeout)
-
-                        http_body = http_response.read()
-                        fetch_stop = time()
-                       
-                        # Store redirect.
-                        if not http_response.geturl() == ip_source:
-                            self.request.is_redirected = True
-                            self.request.redirect_url = http_response.geturl()
-                            
-
-                        ### END MEAT OF REQUEST
-
-                        # Handle Compressed/Gzipped responses even if we didn't
-                        # send a gzipped request.
-                        if self.response_is_compressed(http_response):
-                            self.request.resp_was_compressed = True
-                            http_body, decompression_time = self.decompress(http_body)
-
-                        # VALIDATION/INVALIDATION, REALLY THINK THIS THROUGH FOOL
-                        if not self.regex_validate_response(body=http_body):
-                            # If we know the request is now invalid set nocache and set a flag.
-                            # self.nocache = True
-                            self.request.regex_invalidated = 1 
-                            http_response = None
-                            raise Exception('Regex Invalidated Response Body')
-
-                        content = http_body
-                        response_code = http_response.getcode()
-                        response_headers = http_response.headers.dict
-                        response_time = fetch_stop - fetch_start
-                
-                        # Handle recache with non 200 response
-                        if not skip_cache_write and not self.nocache and response_code == 200:
-                            cache_tuple = (content, response_headers, response_code, response_time)
-                            cache_write_time_start = time()
-                            self.request.cache.write(self.request.source, cache_tuple, self.request.cache_ttl)
-                            cache_write_time_stop = time()
-                            cache_write_time = cache_write_time_stop - cache_write_time_start
-                            cache_write = True
-
-
-                    # Move Exception stuff up in here.
-                    # This previously set a bunch of the expected attributes to None
-                    # However, I believe a more correct solution is to modify the
-                    # Request objects descriptor so that __get__ checks for exceptions
-                    # Double Check that this will cactch HTTP errors (500) as well as network timeout.
-                    except Exception as error:
-                        # Only retry hit if we don't have long-cache
-                        if content_tuple:
-                            content = content_tuple[0]
-                            response_headers = content_tuple[1]
-                            response_code = content_tuple[2]
-                            response_time = content_tuple[3]
-                            cache_hit = True
+            # Past cache_ttl but inside threshold: serve the stale copy now
+            # and refresh the cache in the background.
+            elif self.content_tuple and self.stale_while_revalidate and not self.recache:
+                if cache_tuple[1] + cache_tuple[2] + cache_tuple[3] > current_time:
+                    self.use_content_tuple(self.content_tuple)
+                    self.request.cache_is_stale = True
+                    self.request.refresh_scheduled = refresher.refresh(self.request.source, self.refresh)
+                    return False
+
+        return self.recache or not self.cache_is_fresh
+
+    def early_expiration(self, cache_tuple):
+        """
+        Probabilistic early expiration. With early_expiration_beta set, an
+        entry is treated as expired a random amount of time before it really
+        is, scaled by how long it took to fetch, so processes refresh a hot
+        key at staggered times instead of all at once.
+        """
+        beta = getattr(self.request, 'early_expiration_beta', self.early_expiration_beta)
+        if not beta:
+            return 0
+        return -cache_tuple[0][3] * beta * math.log(1.0 - random.random())
+
+    def take_refresh_lock(self, in_loop=False):
+        """
+        Cross-process stampede protection, on with stampede_lock. Only the
+        process holding the memcache refresh lock for a key goes to the
+        origin. Others serve the stale copy if there is one, or poll briefly
+        for the holder's result (not from the event loop). Returns True if
+        this fetch should go to the network.
+        """
+        if not self.stampede_lock or self.nocache or self.recache:
+            return True
+
+        lock_timeout = int(math.ceil(self.request.timeout * (self.request.retries + 1))) + 1
+        self.refresh_lock = self.request.cache.acquire_lock(self.request.source, lock_timeout)
+        if self.refresh_lock is not None:
+            return True
+
+        if self.content_tuple:
+            self.use_content_tuple(self.content_tuple)
+            self.request.cache_is_stale = True
+            return False
+
+        if not in_loop:
+            deadline = time() + getattr(self.request, 'stampede_wait', self.stampede_wait)
+            while time() < deadline and not self.deadline_passed():
+                sleep(0.05)
+                cache_tuple = self.request.cache.read(self.request.source)
+                if cache_tuple and cache_tuple[1] + cache_tuple[3] > time():
+                    self.content_tuple = cache_tuple[0]
+                    self.cache_is_fresh = True
+                    self.use_content_tuple(self.content_tuple)
+                    return False
+
+        # Nothing turned up in time, fetch it ourselves.
+        return True
+
+    def apply_overrides(self):
+        # handle / apply global overrides
+        if self.request.global_overrides:
+            self.nocache = self.request.global_nocache
+            self.recache = self.request.global_recache
+
+    def cache_key(self):
+        self.apply_overrides()
+        if self.nocache:
+            return None
+        return self.request.source
+
+    def serve_cached(self, cache_tuple, cache_read_time):
+        # Keep the tuple, fetch() uses it as the long-cache fallback if the
+        # request could not be answered here.
+        self.prefetched = (cache_tuple, cache_read_time)
+        if self.request.fail_flag:
+            return False
+
+        self.request_parser()
+        if self.read_cache():
+            return False
+        self.finish()
+        return True
+
+    def use_content_tuple(self, content_tuple):
+        self.content = content_tuple[0]
+        self.response_headers = content_tuple[1]
+        self.response_code = content_tuple[2]
+        self.response_time = content_tuple[3]
+        self.content_encoding = None
+        if len(content_tuple) > 4:
+            self.content_encoding = content_tuple[4]
+        self.cache_hit = True
+
+    def refresh(self):
+        """
+        Background stale-while-revalidate refresh. Fetches a copy of the
+        request the normal way, which revalidates or replaces the cached
+        entry.
+        """
+        request = copy.copy(self.request)
+        request.stale_while_revalidate = False
+        request.global_stale_while_revalidate = False
+        request.global_overrides = False
+        request.stream = False
+        request.sink = None
+        request.retry_count = 0
+        request.exception = None
+        request.deadline = None
+        # The fetch that scheduled the refresh may still be in flight with
+        # the same key, joining it would only hand back the stale copy.
+        request.coalesce = False
+        Http(request).fetch()
+
+    def build_request(self):
+        """
+        Works out the headers and body to send. The address is picked by
+        choose_ip() before each attempt.
+        """
+        # Add Host header so that when using ip from DNS cache
+        # The correct VHOST is hit on the remote server.
+        self.request_headers = {
+            'Host': self.request.hostname,
+            'Accept': 'text/html, text/plain',
+            'User-Agent': 'Bullfrog +http://github.com/yourabi/bullfrog',
+        }
+        
+        if hasattr(self.request, 'headers'):
+            for header in self.request.headers:
+                if header.lower() == "host":
+                    self.request_headers['Host'] = self.request.headers[header]
+                else:
+                    self.request_headers[header] = self.request.headers[header]
+        
+        # TODO: Is this really correct?
+        if hasattr(self.request, "accept_compressed") and self.request.accept_compressed or self.request.global_accept_compressed:
+            self.request_headers['Accept-Encoding'] = 'gzip,deflate'
+
+        if self.request.body is not None:
+            if hasattr(self.request, "encoding"):
+                self.request.body = self.request.body.encode(self.request.encoding)
+
+        # A stale copy can be revalidated instead of downloaded again.
+        if self.content_tuple and not self.cache_is_fresh and not self.recache:
+            self.add_validators(self.content_tuple[1])
+
+    def choose_ip(self, in_loop=False):
+        """
+        Picks the address to fetch from and builds the IP based url for it.
+        Called before every attempt so a retry can move off a failing
+        address. With race_connections (threaded fetches only) the two best
+        addresses are connected to at once; the first to answer wins and its
+        connection is parked in the pool for send() to use.
+        """
+        # DNS Resolution. Only needed once we know the network is hit.
+        dns_cache = self.request.dns_cache
+        hostname = self.request.hostname
+        port = self.request.port or httplib.HTTP_PORT
+        ip = None
+
+        dns_start = time()
+        if not in_loop and getattr(self.request, 'race_connections', self.race_connections):
+            ips = dns_cache.candidates(hostname, self.request.cache, 2)
+            self.add_timing('dns', time() - dns_start)
+            keys = [(candidate, port, self.request_headers['Host']) for candidate in ips]
+            if len(ips) > 1 and not [key for key in keys if connection_pool.has_idle(key)]:
+                connect_start = time()
+                timeout = self.socket_timeout()
+                ip, sock = dns_cache.connect_first(ips, port, timeout)
+                self.add_timing('connect', time() - connect_start)
+                conn = httplib.HTTPConnection(ip, port, timeout=timeout)
+                conn.sock = sock
+                connection_pool.release((ip, port, self.request_headers['Host']), conn)
+
+        if ip is None:
+            dns_start = time()
+            ip = dns_cache.resolve(hostname, self.request.cache)
+            self.add_timing('dns', time() - dns_start)
+        self.request.ip = ip
+        self.ip_source = self.ip_url(ip)
+
+    def ip_url(self, ip):
+        """
+        Returns the request's url with the host replaced by ip.
+        """
+        # Use IP from DNS Cache lookup. I should add an off flag.
+        new_source = StringIO()
+        new_source.write('http://')
+        new_source.write(ip)
+        if self.request.port:
+            new_source.write(':' + str(self.request.port))
+        new_source.write(self.request.path)
+        
+        if self.request.query:
+            new_source.write('?')
+            new_source.write(self.request.query)
+        
+        return new_source.getvalue()
+
+    def hedge_delay(self):
+        """
+        Returns how long to wait for a response before hedging, or None if
+        the request is not hedged. Only idempotent, non streamed GETs are.
+        """
+        if not getattr(self.request, 'hedge', self.hedge):
+            return None
+        if self.request.body is not None or self.is_streaming():
+            return None
+        method = getattr(self.request, 'method', None)
+        if method and method.upper() not in ('GET', 'HEAD'):
+            return None
+
+        delay = getattr(self.request, 'hedge_delay', None)
+        if delay is None:
+            delay = response_times.percentile(self.request.hostname,
+                getattr(self.request, 'hedge_percentile', self.hedge_percentile),
+                getattr(self.request, 'hedge_min_samples', self.hedge_min_samples))
+        if delay is None:
+            delay = getattr(self.request, 'hedge_fallback_delay', self.hedge_fallback_delay)
+        return delay
+
+    def open_hedged(self, delay):
+        """
+        open() that sends a second copy of the request if the first has not
+        answered within delay seconds, preferably to another address.
+        Returns the (response, body, final_url) of whichever answers first
+        and closes the other. Fails only if every attempt sent fails.
+
+        The first attempt runs on the calling thread. The second gets a
+        thread of its own only once the delay is up, and cuts the first
+        short if it answers first. Each attempt records its own timings,
+        those of the one whose outcome is returned are added to the fetch's.
+        """
+        finished = Queue.Queue()
+        first = HedgedAttempt(self, self.ip_source, finished)
+        attempts = [first]
+        lock = threading.Lock()
+
+        # Picked up front, send_hedge() runs on the shared timer thread
+        # and must not hold it up with a lookup.
+        dns_start = time()
+        hedge_ip = self.hedge_ip()
+        self.add_timing('dns', time() - dns_start)
+        hedge_url = self.ip_url(hedge_ip)
+
+        def send_hedge():
+            lock.acquire()
+            try:
+                if timer.cancelled:
+                    return
+                attempt = HedgedAttempt(self, hedge_url, finished, hedge_ip, rival=first)
+                attempts.append(attempt)
+                self.request.hedged = True
+            finally:
+                lock.release()
+            attempt.start()
+
+        lock.acquire()
+        try:
+            timer = hedge_timer.call_later(delay, send_hedge)
+        finally:
+            lock.release()
+        first.run()
+
+        # No hedge is sent after this.
+        lock.acquire()
+        try:
+            timer.cancel()
+            sent = list(attempts)
+        finally:
+            lock.release()
+
+        attempt = finished.get()
+        if attempt.error is not None and len(sent) > 1:
+            attempt = finished.get()
+
+        for other in sent:
+            if other is not attempt:
+                other.cancel()
+
+        for phase, seconds in attempt.timings.items():
+            self.add_timing(phase, seconds)
+        if attempt.error is not None:
+            raise attempt.error
+
+        # Redirect detection compares against ip_source.
+        if attempt.ip is not None:
+            self.request.ip = attempt.ip
+            self.ip_source = attempt.url
+        return attempt.result
+
+    def hedge_ip(self):
+        """
+        The address for the hedged attempt: the best one that isn't the
+        first attempt's, or the same one if the host has no other.
+        """
+        ips = self.request.dns_cache.candidates(self.request.hostname, self.request.cache, 2)
+        for ip in ips:
+            if ip != self.request.ip:
+                return ip
+        return self.request.ip
+
+    def add_validators(self, cached_headers):
+        """
+        Makes the request conditional on the cached copy's ETag and
+        Last-Modified headers. A 304 response then reuses the cached copy.
+        """
+        names = [h.lower() for h in self.request_headers]
+        if cached_headers.get('etag') and 'if-none-match' not in names:
+            self.request_headers['If-None-Match'] = cached_headers['etag']
+            self.revalidating = True
+        if cached_headers.get('last-modified') and 'if-modified-since' not in names:
+            self.request_headers['If-Modified-Since'] = cached_headers['last-modified']
+            self.revalidating = True
+
+    def handle_response(self, code, headers, http_body, final_url, response_time, decoded=False):
+        """
+        Second half of a successful fetch. Decompresses (unless already
+        decoded), validates and caches the body. Raises if the body fails
+        validation.
+        """
+        # Store redirect.
+        if not final_url == self.ip_source:
+            self.request.is_redirected = True
+            self.request.redirect_url = final_url
+
+        # Observed response times set the hedge delay for the host.
+        response_times.add(self.request.hostname, response_time)
+
+        if code == 304:
+            self.handle_not_modified(headers)
+            return
+
+        # Handle Compressed/Gzipped responses even if we didn't
+        # send a gzipped request.
+        content_encoding = None
+        if self.response_is_compressed(headers):
+            self.request.resp_was_compressed = True
+            if self.keeps_encoding():
+                content_encoding = headers.get('content-encoding')
+            elif not decoded:
+                http_body, self.decompression_time = self.decompress(http_body, headers)
+
+        # VALIDATION/INVALIDATION, REALLY THINK THIS THROUGH FOOL
+        if not self.regex_validate_response(body=http_body):
+            # If we know the request is now invalid set nocache and set a flag.
+            # self.nocache = True
+            self.request.regex_invalidated = 1 
+            raise Exception('Regex Invalidated Response Body')
+
+        self.content = http_body
+        self.content_encoding = content_encoding
+        self.response_code = code
+        self.response_headers = headers.dict
+        self.response_time = response_time
+        self.cache_hit = False
+
+        # Handle recache with non 200 response
+        if not self.skip_cache_write and not self.nocache and self.response_code == 200:
+            cache_tuple = (self.content, self.response_headers, self.response_code, self.response_time)
+            if self.content_encoding:
+                cache_tuple += (self.content_encoding,)
+            self.write_cache(cache_tuple)
+
+    def handle_not_modified(self, headers):
+        """
+        The server says the stale cached copy is still good. Serve it and
+        write it back to refresh its timestamp.
+        """
+        cached_headers = dict(self.content_tuple[1])
+        for name in ('etag', 'last-modified', 'expires', 'cache-control', 'date'):
+            if name in headers:
+                cached_headers[name] = headers[name]
+
+        self.content_tuple = (self.content_tuple[0], cached_headers) + tuple(self.content_tuple[2:])
+        self.use_content_tuple(self.content_tuple)
+        self.request.revalidated = True
+
+        if not self.skip_cache_write and not self.nocache:
+            self.write_cache(self.content_tuple)
+
+    def write_cache(self, cache_tuple):
+        cache_write_time_start = time()
+        try:
+            self.request.cache.write(self.request.source, cache_tuple, self.request.cache_ttl)
+        except CacheException:
+            # Too large to cache. The response is still served.
+            return
+        cache_write_time_stop = time()
+        self.cache_write_time = cache_write_time_stop - cache_write_time_start
+        self.cache_write = True
+
+    def add_timing(self, phase, seconds):
+        """
+        Adds to the time spent in a phase of the fetch: dns, connect, ttfb,
+        download, decompress, cache_read or cache_write. Phases repeated by
+        retries and redirects add up.
+        """
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def keeps_encoding(self):
+        """
+        True if a compressed body is kept, and cached, in its upstream
+        Content-Encoding and only inflated when response_content is read.
+        Bodies that are streamed or checked against regex_validators are
+        always decoded up front.
+        """
+        return (getattr(self.request, 'cache_compressed', self.cache_compressed)
+                and not self.is_streaming() and not hasattr(self.request, 'regex_validators'))
+
+    def is_streaming(self):
+        return getattr(self.request, 'stream', False) or getattr(self.request, 'sink', None) is not None
+
+    def handle_stream(self, response, stream, final_url, response_time):
+        """
+        Streaming counterpart of handle_response(). response_time is the
+        time to the response headers.
+        """
+        if not final_url == self.ip_source:
+            self.request.is_redirected = True
+            self.request.redirect_url = final_url
+
+        self.response_code = response.status
+        self.response_headers = response.msg.dict
+        self.response_time = response_time
+        self.cache_hit = False
+
+        body = self.iter_body(stream, response.msg)
+        if getattr(self.request, 'sink', None) is None:
+            self.content = body
+            return
+
+        # The sink has already seen part of the body if this fails, so it is
+        # reported rather than retried.
+        try:
+            self.deliver(body)
+        except Exception as error:
+            self.fail(error)
+
+    def iter_body(self, stream, headers):
+        """
+        Generator over the decoded body of a streamed response. Validation
+        failures are raised once the end of the body is reached and the body
+        is cached afterwards if it was small enough.
+        """
+        decompressor = None
+        if self.response_is_compressed(headers):
+            self.request.resp_was_compressed = True
+            decompressor = self.decompressor(headers)
+
+        validators = getattr(self.request, 'regex_validators', None)
+        window = getattr(self.request, 'stream_regex_window', self.stream_regex_window)
+        tail = ''
+        is_valid = not validators
+
+        cache_limit = getattr(self.request, 'stream_cache_limit', self.stream_cache_limit)
+        cacheable = not self.skip_cache_write and not self.nocache and self.response_code == 200
+        cache_chunks = []
+        cache_size = 0
+
+        self.request.streamed_bytes = 0
+        try:
+            for chunk in stream:
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                    if not chunk:
+                        continue
+
+                # Keep a window of the previous chunk so a match can
+                # straddle two chunks.
+                if not is_valid:
+                    searched = tail + chunk
+                    for regex in validators:
+                        if re.search(regex, searched):
+                            is_valid = True
                             break
-                        
-                        # We have no long cache, retry network hit.
-                        else:
-                            self.request.retry_count += 1
-                            if not self.request.retry_count <= self.request.retries:
-                                self.request.network_error = 1
-                                self.request.exception = error
-                                return
-                            else:
-                                continue
+                    tail = searched[-window:]
+
+                if cacheable:
+                    cache_size += len(chunk)
+                    if cache_size > cache_limit:
+                        cacheable = False
+                        cache_chunks = []
+                    else:
+                        cache_chunks.append(chunk)
+
+                self.request.streamed_bytes += len(chunk)
+                yield chunk
+
+            if decompressor is not None:
+                chunk = decompressor.flush()
+                if chunk:
+                    self.request.streamed_bytes += len(chunk)
+                    if cacheable:
+                        cache_chunks.append(chunk)
+                    yield chunk
+        finally:
+            stream.close()
+
+        if not is_valid:
+            self.request.regex_invalidated = 1
+            raise Exception('Regex Invalidated Response Body')
+
+        if cacheable:
+            self.write_cache((''.join(cache_chunks), self.response_headers, self.response_code, self.response_time))
+
+            # When iterating the fetch has already finished.
+            self.request.cache_write_time = self.cache_write_time
+            self.request.cache_write = True
+
+    def deliver(self, chunks):
+        """
+        Hands each chunk to the request's sink, a callable or an object
+        with a write() method.
+        """
+        sink = self.request.sink
+        if hasattr(sink, 'write'):
+            sink = sink.write
+        for chunk in chunks:
+            sink(chunk)
+
+    def handle_error(self, error):
+        """
+        Called when an attempt fails. Returns True if the request should be
+        retried after waiting retry_delay seconds, which the retry policy
+        decides from the error, the retries made so far and the process'
+        retry budget.
+        """
+        # Move Exception stuff up in here.
+        # This previously set a bunch of the expected attributes to None
+        # However, I believe a more correct solution is to modify the
+        # Request objects descriptor so that __get__ checks for exceptions
+        # Double Check that this will cactch HTTP errors (500) as well as network timeout.
+
+        # Only retry hit if we don't have long-cache
+        if self.content_tuple:
+            self.use_content_tuple(self.content_tuple)
+            self.deadline_exceeded = self.deadline_passed()
+            return False
+
+        # Out of time for the batch, there is no point in another attempt.
+        # A socket timeout cut down to the deadline can fire a moment before
+        # it, so one that leaves next to no time counts as the deadline too.
+        deadline = getattr(self.request, 'deadline', None)
+        if self.deadline_passed() or (isinstance(error, socket.timeout) and deadline is not None
+                                      and deadline.remaining() < 0.01):
+            if not isinstance(error, DeadlineExceeded):
+                error = DeadlineExceeded("Batch deadline exceeded: %s" % error)
+            self.deadline_exceeded = True
+            self.fail(error)
+            return False
+        
+        # We have no long cache, retry network hit if the policy allows it
+        # and the backoff ends before the deadline.
+        delay = self.retry_policy.next_delay(error, self.retry_count, self.request.retries)
+        if delay is None or deadline is not None and delay >= deadline.remaining():
+            self.fail(error)
+            return False
+        self.retry_count += 1
+        self.retry_delay = delay
+        return True
+
+    def fail(self, error):
+        """
+        Gives up on the request, error is reported by finish().
+        """
+        self.error = error
+        self.failed = True
+
+    def expire(self):
+        """
+        Past the batch deadline, falls back on the cached copy however old
+        it is, like a failed fetch does. Times out when there is none or
+        the request is streamed. Runs on the client manager's thread, the
+        fetch may still be running and its state is left alone.
+        """
+        content_tuple = getattr(self, 'content_tuple', None)
+        if content_tuple is None and self.prefetched and self.prefetched[0]:
+            content_tuple = self.prefetched[0][0]
+        if content_tuple is None or self.is_streaming():
+            Backend.expire(self)
+            return
+
+        self.set_content(content_tuple[0], len(content_tuple) > 4 and content_tuple[4] or None)
+        self.request.response_code = content_tuple[2]
+        self.request.response_headers = content_tuple[1]
+        self.request.response_time = content_tuple[3]
+        self.request.cache_hit = True
+        self.request.cache_is_fresh = False
+        self.request.cache_is_stale = True
+        self.request.deadline_exceeded = True
+        self.request.exception = None
+
+    def finish(self):
+        """
+        Copies the outcome onto the request, unless the client manager has
+        already given up on it at the batch deadline.
+        """
+        if not self.settle():
+            return
+
+        if self.decompression_time:
+            self.timings['decompress'] = self.decompression_time
+        if self.cache_read_time is not None:
+            self.timings['cache_read'] = self.cache_read_time
+        if self.cache_write_time is not None:
+            self.timings['cache_write'] = self.cache_write_time
+
+        self.request.retry_count = self.retry_count
+        if self.failed:
+            if self.error is not None:
+                self.request.network_error = 1
+                self.request.exception = self.error
+                self.request.deadline_exceeded = self.deadline_exceeded
+            return
 
         # Threshold check.
         # This is end of successful flow.
-        self.request.response_content = content
-        self.request.response_code = response_code
-        self.request.response_headers = response_headers
-        self.request.response_time = response_time
-        self.request.cache_hit = cache_hit
-        self.request.cache_is_fresh = cache_is_fresh
-        self.request.cache_write = cache_write
-        self.request.decompression_time = decompression_time        
-        self.request.cache_read_time = cache_read_time
-        self.request.cache_write_time = cache_write_time
+        content = self.set_content(self.content, self.content_encoding)
+        self.request.deadline_exceeded = self.deadline_exceeded
+        if self.deadline_exceeded:
+            self.request.cache_is_stale = True
+        self.request.response_code = self.response_code
+        self.request.response_headers = self.response_headers
+        self.request.response_time = self.response_time
+        self.request.cache_hit = self.cache_hit
+        self.request.cache_is_fresh = self.cache_is_fresh
+        self.request.cache_write = self.cache_write
+        self.request.decompression_time = self.decompression_time        
+        self.request.cache_read_time = self.cache_read_time
+        self.request.cache_write_time = self.cache_write_time
         self.request.exception = None # Another check clients can do.
-        
-        return
-    
-    def decompress(self, compressed_string):
+
+        # Content from cache is handed over the same way as a streamed body.
+        if self.is_streaming() and isinstance(content, str):
+            self.request.streamed_bytes = len(content)
+            if getattr(self.request, 'sink', None) is not None:
+                self.deliver([content])
+                self.request.response_content = None
+            else:
+                self.request.response_content = iter([content])
+
+    def set_content(self, content, content_encoding):
+        """
+        Hands the body over as response_content. Returns it as handed over,
+        decoded unless it is left for response_content to inflate.
+        """
+        if content_encoding and not self.is_streaming():
+            max_size = getattr(self.request, 'max_decompressed_size', self.max_decompressed_size)
+            self.request.set_encoded_content(content, content_encoding, max_size)
+        else:
+            if content_encoding:
+                content = self.decompress(content, {'content-encoding': content_encoding})[0]
+            self.request.response_content = content
+        return content
+
+    def open(self, url, headers, body=None, stream=False, attempt=None):
+        """
+        Sends the request over a pooled keep-alive connection, following
+        redirects up to max_redirections. Non 2xx responses raise HTTPError.
+
+        Returns a tuple of (response, body, final_url). The response body has
+        been read in full and the connection handed back to the pool, unless
+        stream is set in which case body is a ResponseStream.
+
+        attempt is the HedgedAttempt making the request, if any.
+        """
+        method, headers = self.request_method(headers, body)
+
+        redirects = 0
+        while True:
+            key, path = self.connection_key(url, headers)
+            response, response_body = self.send(key, method, path, headers, body, stream, attempt)
+
+            if stream and (self.is_redirect(response) or not self.is_success(response)):
+                response_body.drain()
+
+            if self.is_redirect(response):
+                redirects += 1
+                url, method, headers, body = self.redirect(url, response, redirects, method, headers, body)
+                continue
+
+            if not self.is_success(response):
+                raise HTTPError(url, response.status, response.reason, response.msg, None)
+
+            return response, response_body, url
+
+    def request_method(self, headers, body):
+        """
+        Returns the HTTP method and the headers to send it with.
+        """
+        method = getattr(self.request, 'method', None)
+        if method:
+            method = method.upper()
+        elif body is not None:
+            method = 'POST'
+        else:
+            method = 'GET'
+
+        if body is not None and 'content-type' not in [h.lower() for h in headers]:
+            headers = dict(headers)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return method, headers
+
+    def connection_key(self, url, headers):
+        """
+        Returns the (ip, port, Host) pool key and request path for url.
+        """
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = path + '?' + parsed.query
+        return (parsed.hostname, parsed.port or httplib.HTTP_PORT, headers['Host']), path
+
+    def is_success(self, response):
+        return 200 <= response.status < 300 or (response.status == 304 and self.revalidating)
+
+    def is_redirect(self, response):
+        return response.status in (301, 302, 303, 307) and response.getheader('location')
+
+    def redirect(self, url, response, redirects, method, headers, body):
+        """
+        Works out where a redirect response points. Returns the new
+        (url, method, headers, body).
+        """
+        if redirects > self.max_redirections:
+            raise HTTPError(url, response.status, "Maximum number of redirects exceeded", response.msg, None)
+
+        # Follow the same way urllib2 does. The Host header only
+        # survives a redirect that stays on the same host.
+        location = urlparse(urljoin(url, response.getheader('location')))
+        if location.scheme != 'http':
+            raise HTTPError(url, response.status, "Cannot follow redirect to %s" % location.geturl(), response.msg, None)
+        if location.hostname != urlparse(url).hostname:
+            headers = dict(headers)
+            headers['Host'] = location.hostname
+            ip = self.request.dns_cache.resolve(location.hostname, self.request.cache)
+            if location.port:
+                ip = '%s:%d' % (ip, location.port)
+            location = location._replace(netloc=ip)
+        if response.status == 303 or method not in ('GET', 'HEAD'):
+            method = 'GET'
+            body = None
+        return location.geturl(), method, headers, body
+
+    def send(self, key, method, path, headers, body=None, stream=False, attempt=None):
+        """
+        Makes a single request/response exchange on a pooled connection.
+        An idempotent request on a reused connection the server has since
+        closed is sent again on a fresh connection, see
+        is_stale_connection(). Other failures are left to the retry policy.
+        With stream set the body is left unread and
+        returned as a ResponseStream. A cancelled hedge attempt stops, and
+        its timings are recorded on the attempt rather than the backend.
+        """
+        timings = self
+        if attempt is not None:
+            timings = attempt
+        while True:
+            if attempt is not None and attempt.cancelled:
+                raise socket.error("Hedged attempt cancelled")
+            conn, reused = connection_pool.get(key, self.socket_timeout())
+            if attempt is not None:
+                attempt.connected(conn)
+            if not reused:
+                timings.add_timing('connect', conn.connect_time)
+            response = None
+            try:
+                request_start = time()
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                timings.add_timing('ttfb', time() - request_start)
+                if stream:
+                    # The caller reads the body after the batch, on the
+                    # request's own timeout.
+                    if conn.sock is not None:
+                        conn.sock.settimeout(self.request.timeout)
+                    chunk_size = getattr(self.request, 'chunk_size', self.chunk_size)
+                    return response, ResponseStream(response, key, conn, chunk_size)
+                if getattr(self.request, 'deadline', None) is None:
+                    response_body = response.read()
+                else:
+                    chunk_size = getattr(self.request, 'chunk_size', self.chunk_size)
+                    chunks = iter(lambda: response.read(chunk_size), '')
+                    response_body = ''.join(self.within_deadline(chunks))
+            except (httplib.HTTPException, socket.error, DeadlineExceeded) as error:
+                conn.close()
+                if reused and response is None and method in IDEMPOTENT_METHODS \
+                        and self.is_stale_connection(error):
+                    continue
+                raise
+
+            if response.will_close:
+                conn.close()
+            elif attempt is not None and not attempt.give_back(conn):
+                conn.close()
+            else:
+                connection_pool.release(key, conn)
+            return response, response_body
+
+    def is_stale_connection(self, error):
+        """
+        True if error is what a keep-alive connection closed by the server
+        looks like: no status line, a reset or a broken pipe. A timeout
+        means the server may still be working on the request.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+    def read_body(self, stream, headers):
+        """
+        Reads a whole response body. Compressed bodies are inflated chunk by
+        chunk as they arrive rather than buffered and then decompressed.
+        """
+        try:
+            if not self.response_is_compressed(headers) or self.keeps_encoding():
+                if getattr(self.request, 'deadline', None) is None:
+                    return stream.read()
+                return ''.join(self.within_deadline(stream))
+
+            self.request.resp_was_compressed = True
+            decompressor = self.decompressor(headers)
+            self.decompression_time = 0
+            body = []
+            for chunk in self.within_deadline(stream):
+                start_compress = time()
+                body.append(decompressor.decompress(chunk))
+                self.decompression_time += time() - start_compress
+
+            start_compress = time()
+            body.append(decompressor.flush())
+            self.decompression_time += time() - start_compress
+            return ''.join(body)
+        finally:
+            stream.close()
+
+    def within_deadline(self, chunks):
+        """
+        Passes chunks through, raising DeadlineExceeded once the batch
+        deadline has passed so a slow body stops holding a worker.
+        """
+        for chunk in chunks:
+            if self.deadline_passed():
+                raise DeadlineExceeded("Batch deadline exceeded")
+            yield chunk
+
+    def decompress(self, compressed_string, headers):
         start_compress = time()
-        compressed_stream = StringIO(compressed_string)
-        gzipper = gzip.GzipFile(fileobj=compressed_stream)
-        uncompressed_data = gzipper.read()
+        decompressor = self.decompressor(headers)
+        uncompressed_data = decompressor.decompress(compressed_string) + decompressor.flush()
         stop_compress = time()
         return (uncompressed_data, stop_compress - start_compress)
+
+    def decompressor(self, headers):
+        max_size = getattr(self.request, 'max_decompressed_size', self.max_decompressed_size)
+        return Decompressor(headers.get('content-encoding'), max_size)
     
-    # TODO: this seems flawed. Multiple content-encodings?
-    def response_is_compressed(self, response):
-        is_compressed = False        
-        if 'content-encoding' in response.headers:
-            is_compressed = True
-        return is_compressed
+    def response_is_compressed(self, headers):
+        content_encoding = headers.get('content-encoding', '').strip().lower()
+        return content_encoding not in ('', 'identity')
 
     def request_parser(self):
         parsed = urlparse(self.request.source)
@@ -261,9 +1240,6 @@ class Http(Backend):
         self.request.port = parsed.port
         self.request.scheme = parsed.scheme
         
-        # DNS Resolution
-        self.request.ip = self.request.dns_cache.resolve(self.request.hostname, self.request.cache)
-        
         self.request.path = parsed.path
         self.request.query = parsed.query
 
@@ -292,7 +1268,619 @@ class Http(Backend):
 
         return is_valid
     
-# Handle number of hops, tracking previous urls...etc
+class AsyncExchange(object):
+    """
+    Drives one Http backend on an EventLoop: sends the request, follows
+    redirects and retries, and hands the outcome back to the backend.
+    """
+
+    def __init__(self, backend, loop):
+        self.backend = backend
+        self.loop = loop
+        self.redirects = 0
+
+    def start(self):
+        backend = self.backend
+        self.url = backend.ip_source
+        self.method, self.headers = backend.request_method(backend.request_headers, backend.request.body)
+        self.body = backend.request.body
+        self.send()
+
+    def send(self):
+        (ip, port, host), path = self.backend.connection_key(self.url, self.headers)
+
+        # The event loop does not share the keep-alive pool, every exchange
+        # gets a connection of its own.
+        headers = dict(self.headers)
+        headers['Connection'] = 'close'
+        if self.body is not None:
+            headers['Content-Length'] = str(len(self.body))
+
+        lines = ['%s %s HTTP/1.1' % (self.method, path)]
+        for name in headers:
+            lines.append('%s: %s' % (name, headers[name]))
+        data = '\r\n'.join(lines) + '\r\n\r\n'
+        if self.body is not None:
+            data += self.body
+
+        self.fetch_start = time()
+        self.ip = ip
+        self.channel = Channel(self.loop, (ip, port), data, self.backend.socket_timeout(), self.received)
+        self.loop.open(self.channel)
+
+    def received(self, data, error):
+        backend = self.backend
+        channel = self.channel
+        if channel.connect_time is not None:
+            host_health.record_success(self.ip, channel.connect_time)
+            backend.add_timing('connect', channel.connect_time)
+            if channel.first_byte_time is not None:
+                backend.add_timing('ttfb', channel.first_byte_time - channel.connect_time)
+                backend.add_timing('download', time() - channel.started - channel.first_byte_time)
+        elif error is not None:
+            host_health.record_failure(self.ip)
+
+        try:
+            if error is not None:
+                raise error
+
+            response = httplib.HTTPResponse(BufferedSocket(data), method=self.method)
+            response.begin()
+            http_body = response.read()
+            response_time = time() - self.fetch_start
+
+            if backend.is_redirect(response):
+                self.redirects += 1
+                self.url, self.method, self.headers, self.body = backend.redirect(
+                    self.url, response, self.redirects, self.method, self.headers, self.body)
+                self.send()
+                return
+
+            if not backend.is_success(response):
+                raise HTTPError(self.url, response.status, response.reason, response.msg, None)
+
+            backend.handle_response(response.status, response.msg, http_body, self.url, response_time)
+        except Exception as error:
+            if backend.handle_error(error):
+                self.loop.call_later(backend.retry_delay, self.retry)
+                return
+
+        backend.finish()
+        backend.end_fetch()
+
+    def retry(self):
+        """
+        Starts the next attempt once the backoff is over, called by the
+        loop. The loop also calls it early when it is cancelled at the
+        batch deadline.
+        """
+        backend = self.backend
+        try:
+            if backend.deadline_passed():
+                raise DeadlineExceeded("Batch deadline exceeded")
+            self.redirects = 0
+            backend.choose_ip(in_loop=True)
+            self.start()
+            return
+        except Exception as error:
+            if backend.handle_error(error):
+                self.loop.call_later(backend.retry_delay, self.retry)
+                return
+
+        backend.finish()
+        backend.end_fetch()
+
+
+class HedgedAttempt(threading.Thread):
+    """
+    One copy of a hedged request. The first runs on the fetch's thread,
+    the hedge is started as a thread of its own. Puts itself on finished
+    when done, with result or error set. A hedge that succeeds cancels its
+    rival.
+
+    cancel() shuts down the connection the attempt is using to abandon it.
+    The attempt only owns a connection until it hands it back to the pool,
+    and a cancelled attempt discards its connection instead, so a pooled
+    socket that another fetch may be using is never shut down.
+
+    Connect and ttfb times go to the attempt's own timings, so a losing
+    attempt does not add to the fetch's.
+    """
+
+    def __init__(self, backend, url, finished, ip=None, rival=None):
+        threading.Thread.__init__(self, name='bullfrog-hedge')
+        self.setDaemon(True)
+        self.backend = backend
+        self.url = url
+        self.ip = ip
+        self.finished = finished
+        self.rival = rival
+        self.result = None
+        self.error = None
+        self.conn = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def run(self):
+        backend = self.backend
+        try:
+            self.result = backend.open(self.url, backend.request_headers, backend.request.body, attempt=self)
+        except Exception as error:
+            self.error = error
+        self.finished.put(self)
+        if self.error is None and self.rival is not None:
+            self.rival.cancel()
+
+    def add_timing(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def connected(self, conn):
+        self.lock.acquire()
+        try:
+            self.conn = conn
+            # Cancelled while connecting.
+            if self.cancelled:
+                self.shutdown()
+        finally:
+            self.lock.release()
+
+    def give_back(self, conn):
+        """
+        Called before conn goes back to the pool. Returns False if the
+        attempt was cancelled and conn must be closed instead.
+        """
+        self.lock.acquire()
+        try:
+            self.conn = None
+            return not self.cancelled
+        finally:
+            self.lock.release()
+
+    def cancel(self):
+        self.lock.acquire()
+        try:
+            self.cancelled = True
+            self.shutdown()
+        finally:
+            self.lock.release()
+
+    def shutdown(self):
+        # Unblocks the attempt's read, send() then closes the connection.
+        conn = self.conn
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class TimerThread(object):
+    """
+    Calls callbacks after a delay from one shared daemon thread, for
+    timers that are usually cancelled and too many to give a thread each.
+    The thread is started on first use.
+
+    Example:
+        timer = hedge_timer.call_later(0.1, send_hedge)
+        ...
+        timer.cancel()
+    """
+
+    def __init__(self):
+        self.timers = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def call_later(self, delay, callback):
+        timer = Timer(callback)
+        self.condition.acquire()
+        try:
+            heapq.heappush(self.timers, (time() + delay, next(self.sequence), timer))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='bullfrog-timer')
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return timer
+
+    def _run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.timers or self.timers[0][0] > time():
+                    if self.timers:
+                        self.condition.wait(self.timers[0][0] - time())
+                    else:
+                        self.condition.wait()
+                timer = heapq.heappop(self.timers)[2]
+            finally:
+                self.condition.release()
+
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback()
+            except Exception:
+                logging.exception("Timer callback failed")
+
+
+class Timer(object):
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ResponseTimes(object):
+    """
+    Recent response times per host, the last window fetches of each, used
+    to pick the hedge delay.
+    """
+
+    def __init__(self, window=200):
+        self.window = window
+        self.lock = threading.Lock()
+        self.times = {}
+
+    def add(self, host, response_time):
+        self.lock.acquire()
+        try:
+            times = self.times.get(host)
+            if times is None:
+                times = self.times[host] = deque(maxlen=self.window)
+            times.append(response_time)
+        finally:
+            self.lock.release()
+
+    def percentile(self, host, percent, min_samples=1):
+        """
+        Returns the percentile of host's recent response times, None with
+        fewer than min_samples of them.
+        """
+        self.lock.acquire()
+        try:
+            times = list(self.times.get(host, ()))
+        finally:
+            self.lock.release()
+
+        if len(times) < max(min_samples, 1):
+            return None
+        histogram = Histogram()
+        for response_time in times:
+            histogram.add(response_time)
+        return histogram.percentile(percent)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.times = {}
+        finally:
+            self.lock.release()
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent fetches of the same key within the process. The
+    first fetch leads; fetches that arrive while it is in flight wait for it
+    and share its result instead of hitting the cache and network again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def join(self, key):
+        """
+        Returns (flight, leader). leader is True if the caller started the
+        flight and must land() it.
+        """
+        self.lock.acquire()
+        try:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = Flight(key)
+            self.flights[key] = flight
+            return flight, True
+        finally:
+            self.lock.release()
+
+    def land(self, flight, request):
+        self.lock.acquire()
+        try:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+        finally:
+            self.lock.release()
+        flight.land(request)
+
+
+class Flight(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.request = None
+        self.landed = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def wait(self, timeout=None):
+        """
+        Returns True once the flight has landed, False if timeout seconds
+        passed first.
+        """
+        self.landed.wait(timeout)
+        return self.landed.isSet()
+
+    def add_callback(self, callback):
+        """
+        Calls callback(request) once the flight lands, straight away if it
+        already has.
+        """
+        self.lock.acquire()
+        try:
+            if not self.landed.isSet():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.lock.release()
+        callback(self.request)
+
+    def land(self, request):
+        self.lock.acquire()
+        try:
+            self.request = request
+            self.landed.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        finally:
+            self.lock.release()
+        for callback in callbacks:
+            callback(request)
+
+
+class BackgroundRefresher(object):
+    """
+    Runs stale-while-revalidate refreshes off the request path on a small
+    worker pool. Only one refresh per key runs at a time, and refreshes are
+    dropped rather than queued without bound when the pool is behind.
+    """
+
+    def __init__(self, max_workers=2, queue_size=100):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.pool = None
+
+    def refresh(self, key, job):
+        """
+        Schedules job for key. Returns False if a refresh for key is already
+        in flight or could not be queued.
+        """
+        self.lock.acquire()
+        try:
+            if key in self.in_flight:
+                return False
+            self.in_flight.add(key)
+            if self.pool is None:
+                self.pool = WorkerPool(self.max_workers, queue_size=self.queue_size)
+        finally:
+            self.lock.release()
+
+        try:
+            self.pool.submit(lambda: self._run(key, job), block=False)
+        except Queue.Full:
+            self._done(key)
+            return False
+        return True
+
+    def _run(self, key, job):
+        try:
+            job()
+        finally:
+            self._done(key)
+
+    def _done(self, key):
+        self.lock.acquire()
+        try:
+            self.in_flight.discard(key)
+        finally:
+            self.lock.release()
+
+
+class ResponseStream(object):
+    """
+    Iterates over the body of a response in chunks. The connection goes back
+    to the pool once the body has been read to the end.
+    """
+
+    def __init__(self, response, key, conn, chunk_size):
+        self.response = response
+        self.key = key
+        self.conn = conn
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        while True:
+            chunk = self.response.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self):
+        """
+        Reads the rest of the body in one go.
+        """
+        body = self.response.read()
+        self.close()
+        return body
+
+    def drain(self):
+        """
+        Reads and discards the rest of a (small) body so the connection can
+        be reused.
+        """
+        self.response.read()
+        self.close()
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            connection_pool.release(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+
+class BufferedSocket(object):
+    """
+    Lets httplib.HTTPResponse parse a response that has already been read.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, *args, **kwargs):
+        return StringIO(self.data)
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of idle keep-alive connections keyed by (ip, port, Host).
+    A single pool is shared by every Http backend in the process so that
+    requests to the same host reuse sockets across execute() calls.
+
+    max_per_host -- idle connections kept per key, extras are closed.
+    idle_timeout -- seconds an idle connection is kept before eviction.
+    """
+
+    def __init__(self, max_per_host=4, idle_timeout=30):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.last_sweep = time()
+
+    def get(self, key, timeout):
+        """
+        Returns a tuple of (connection, reused). Falls back to a new
+        connection when there is no usable idle one for key.
+        """
+        conn = None
+        expired = []
+        now = time()
+
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(key)
+            while connections:
+                candidate, last_used = connections.pop()
+                if now - last_used < self.idle_timeout:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+            if key in self.idle and not self.idle[key]:
+                del self.idle[key]
+        finally:
+            self.lock.release()
+
+        for candidate in expired:
+            candidate.close()
+
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+
+        # Connect here rather than on first use to time it for host_health.
+        ip, port, host = key
+        conn = httplib.HTTPConnection(ip, port, timeout=timeout)
+        connect_start = time()
+        try:
+            conn.connect()
+        except socket.error:
+            host_health.record_failure(ip)
+            raise
+        conn.connect_time = time() - connect_start
+        host_health.record_success(ip, conn.connect_time)
+        return conn, False
+
+    def has_idle(self, key):
+        self.lock.acquire()
+        try:
+            return bool(self.idle.get(key))
+        finally:
+            self.lock.release()
+
+    def release(self, key, conn):
+        """
+        Hands a connection back once its response has been fully read.
+        """
+        if conn.sock is None:
+            return
+
+        now = time()
+        expired = []
+        self.lock.acquire()
+        try:
+            if now - self.last_sweep > self.idle_timeout:
+                expired = self._sweep(now)
+
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_per_host:
+                connections.append((conn, now))
+                conn = None
+        finally:
+            self.lock.release()
+
+        for candidate in expired:
+            candidate.close()
+        if conn is not None:
+            conn.close()
+
+    def clear(self):
+        """
+        Closes every idle connection.
+        """
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+        for connections in idle.values():
+            for conn, last_used in connections:
+                conn.close()
+
+    def _sweep(self, now):
+        # Caller holds the lock.
+        self.last_sweep = now
+        expired = []
+        for key in self.idle.keys():
+            connections = self.idle[key]
+            keep = [(c, t) for (c, t) in connections if now - t < self.idle_timeout]
+            expired.extend([c for (c, t) in connections if now - t >= self.idle_timeout])
+            if keep:
+                self.idle[key] = keep
+            else:
+                del self.idle[key]
+        return expired
+
+
+# The urllib2 handlers Http used before it kept its own connections. Http
+# no longer uses them, they are kept for code that imports them from here.
+
 class RedirectHandler(urllib2.HTTPRedirectHandler):
 
     max_repeats = 2
@@ -300,7 +1888,7 @@ class RedirectHandler(urllib2.HTTPRedirectHandler):
     orig_info_msg = urllib2.HTTPRedirectHandler.inf_msg
 
     def set_max_repeats(self, repeats):
-        self.max_repeates = repeats
+        self.max_repeats = repeats
         self.inf_msg = "Custom Number of Redirects exceeded"
 
     def set_max_redirections(self, redirections):
@@ -311,4 +1899,21 @@ class RedirectHandler(urllib2.HTTPRedirectHandler):
 class HTTPErrorHandler(urllib2.HTTPDefaultErrorHandler):
     def http_error_default(self, req, fp, code, msg, headers):
         pass
-   
+
+
+# Shared by all Http backends in the process.
+connection_pool = ConnectionPool()
+refresher = BackgroundRefresher()
+single_flight = SingleFlight()
+response_times = ResponseTimes()
+hedge_timer = TimerThread()
+
+# Attributes a fetch leaves on its Request, copied to coalesced requests.
+RESULT_ATTRIBUTES = (
+    '_response_content', '_encoded_content', 'response_code', 'response_headers', 'response_time',
+    'cache_hit', 'cache_is_fresh', 'cache_is_stale', 'cache_write',
+    'refresh_scheduled', 'revalidated', 'decompression_time',
+    'cache_read_time', 'cache_write_time', 'resp_was_compressed', 'timings',
+    'is_redirected', 'redirect_url', 'hedged', 'regex_invalidated', 'network_error',
+    'deadline_exceeded', 'exception', 'hostname', 'port', 'scheme', 'ip', 'path', 'query',
+)
@@ -13,27 +13,324 @@
 
 from time import time
 import hashlib
+import os
+import random
+import threading
+import Queue
+import struct
+import zlib
+import bisect
 
-try:
-    import cPickle
-except ImportError:
-    import pickle
-
+from bullfrog.backend import CacheBackend, CacheException
+from bullfrog import cacheformat
 
-from bullfrog.backend import Backend
 
-
-# Optional MC library.
+# Optional MC library, only needed once a ClientPool is created.
 try:
     import cmemcache as memcache
 except ImportError:
     try:
         import memcache
     except ImportError:
-        raise Exception("No Memcache Python Libraries installed or available")
+        memcache = None
         
 
-class Memcache(Backend):
+class ClientPool(object):
+    """
+    Thread safe pool of memcache clients. A ClientManager owns one pool and
+    every request it runs borrows clients from it, so sockets are opened once
+    and reused across requests and execute() calls.
+
+    With more than one host, keys are spread over the hosts by a HashRing
+    shared by every client in the pool.
+    """
+
+    def __init__(self, hosts=['127.0.0.1:11211',], debug=0, size=10, dead_retry=30):
+        if memcache is None:
+            raise Exception("No Memcache Python Libraries installed or available")
+        self.hosts = hosts
+        self.debug = debug
+        self.size = max(1, size)
+        self.idle = Queue.Queue()
+        self.clients = []
+        self.lock = threading.Lock()
+        self.ring = None
+        if len(hosts) > 1:
+            self.ring = HashRing(hosts, dead_retry)
+
+    def acquire(self):
+        """
+        Returns an idle client, creating one if the pool is not full yet.
+        Blocks when every client is in use.
+        """
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+
+        self.lock.acquire()
+        try:
+            if len(self.clients) < self.size:
+                if self.ring is not None:
+                    client = RingClient(self.ring, self.debug)
+                else:
+                    client = memcache.Client(self.hosts, self.debug)
+                self.clients.append(client)
+                return client
+        finally:
+            self.lock.release()
+
+        return self.idle.get()
+
+    def release(self, client):
+        self.idle.put(client)
+
+    def disconnect_all(self):
+        """
+        Closes the sockets of every client. Clients reconnect on next use.
+        """
+        self.lock.acquire()
+        try:
+            for client in self.clients:
+                client.disconnect_all()
+        finally:
+            self.lock.release()
+
+
+class HashRing(object):
+    """
+    Ketama style consistent hash ring over memcache servers. Every server
+    owns points_per_server points on the ring and a key belongs to the
+    server owning the next point after the key's hash, so adding or removing
+    a server only moves the keys next to its points.
+
+    A server that fails is marked dead for dead_retry seconds. Its keys go
+    to the next live server on the ring in the meantime, so a down server
+    costs one failure rather than one per request.
+    """
+
+    points_per_server = 160
+
+    def __init__(self, servers, dead_retry=30):
+        self.servers = list(servers)
+        self.dead_retry = dead_retry
+        self.dead_until = {}
+
+        ring = []
+        for server in self.servers:
+            # Each md5 digest gives four points.
+            for i in xrange(self.points_per_server / 4):
+                digest = hashlib.md5("%s-%d" % (server, i)).digest()
+                for j in xrange(4):
+                    ring.append((struct.unpack_from('<I', digest, j * 4)[0], server))
+        ring.sort()
+        self.points = [point for (point, server) in ring]
+        self.owners = [server for (point, server) in ring]
+
+    def get_server(self, key):
+        """
+        Returns the live server key belongs to. If every server is marked
+        dead the key's own server is returned.
+        """
+        point = struct.unpack_from('<I', hashlib.md5(key).digest())[0]
+        index = bisect.bisect(self.points, point)
+        now = time()
+        tried = set()
+        for offset in xrange(len(self.owners)):
+            server = self.owners[(index + offset) % len(self.owners)]
+            if server in tried:
+                continue
+            if self.dead_until.get(server, 0) <= now:
+                return server
+            tried.add(server)
+            if len(tried) == len(self.servers):
+                break
+        return self.owners[index % len(self.owners)]
+
+    def mark_dead(self, server):
+        self.dead_until[server] = time() + self.dead_retry
+
+
+class RingClient(object):
+    """
+    Memcache client for a HashRing of servers. Keeps one single-server
+    client per server and sends each call to the server owning the key,
+    with the same interface as memcache.Client for the calls bullfrog makes.
+    """
+
+    def __init__(self, ring, debug=0):
+        self.ring = ring
+        self.clients = {}
+        for server in ring.servers:
+            self.clients[server] = memcache.Client([server], debug)
+
+    def get(self, key):
+        return self._call('get', key)
+
+    def set(self, key, value, time=0):
+        return self._call('set', key, value, time)
+
+    def add(self, key, value, time=0):
+        return self._call('add', key, value, time)
+
+    def delete(self, key):
+        return self._call('delete', key)
+
+    def append(self, key, value):
+        return self._call('append', key, value)
+
+    def incr(self, key, delta=1):
+        return self._call('incr', key, delta)
+
+    def decr(self, key, delta=1):
+        return self._call('decr', key, delta)
+
+    def get_multi(self, keys):
+        values = {}
+        for server, server_keys in self._group(keys).items():
+            values.update(self.clients[server].get_multi(server_keys))
+            self._check(server)
+        return values
+
+    def set_multi(self, mapping, time=0):
+        """
+        Returns the keys that failed to store, like memcache.Client.
+        """
+        failed = []
+        for server, server_keys in self._group(mapping.keys()).items():
+            server_mapping = dict((key, mapping[key]) for key in server_keys)
+            failed.extend(self.clients[server].set_multi(server_mapping, time))
+            self._check(server)
+        return failed
+
+    def disconnect_all(self):
+        for client in self.clients.values():
+            client.disconnect_all()
+
+    def _call(self, method, key, *args):
+        server = self.ring.get_server(key)
+        try:
+            return getattr(self.clients[server], method)(key, *args)
+        finally:
+            self._check(server)
+
+    def _group(self, keys):
+        grouped = {}
+        for key in keys:
+            grouped.setdefault(self.ring.get_server(key), []).append(key)
+        return grouped
+
+    def _check(self, server):
+        # The client marks a server it failed to reach as dead. Share that
+        # with the ring so other clients in the pool skip it too.
+        for host in getattr(self.clients[server], 'servers', []):
+            if getattr(host, 'deaduntil', 0) > time():
+                self.ring.mark_dead(server)
+
+
+# Stored under the key of a value too large for one memcache item. The value
+# itself is split over count chunk keys tagged with generation, a new one
+# for every write, so chunks of different writes never mix.
+# magic, generation, count, size, crc32.
+MANIFEST = struct.Struct('!3s8sIII')
+MANIFEST_MAGIC = '\x00BC'
+
+# LocalCache entry fields.
+PREV, NEXT, KEY, VALUE, SIZE, EXPIRES = range(6)
+
+class LocalCache(object):
+    """
+    In-process LRU tier in front of memcache. Holds the same unpickled
+    (value, cache_ttl, threshold, timestamp) tuples memcache does, bounded
+    by number of entries and total pickled size.
+
+    Memcache stays authoritative: writes and deletes go through to it and an
+    entry is only served locally while it is fresh (cache_ttl) and for at
+    most max_age seconds, so changes made by other processes show up.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, max_age=10):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.entries = {}
+        self.bytes = 0
+
+        # Circular doubly linked list, most recently used at head[NEXT].
+        self.head = [None, None, None, None, 0, 0]
+        self.head[PREV] = self.head[NEXT] = self.head
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[EXPIRES] <= time():
+                self._remove(entry)
+                return None
+            self._unlink(entry)
+            self._link(entry)
+            return entry[VALUE]
+        finally:
+            self.lock.release()
+
+    def put(self, key, cached_tuple, size):
+        expires = min(cached_tuple[1] + cached_tuple[3], time() + self.max_age)
+        if expires <= time() or size > self.max_bytes:
+            self.delete(key)
+            return
+
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+
+            entry = [None, None, key, cached_tuple, size, expires]
+            self.entries[key] = entry
+            self.bytes += size
+            self._link(entry)
+
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(self.head[PREV])
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+        finally:
+            self.lock.release()
+
+    # Callers of the following hold the lock.
+    def _link(self, entry):
+        entry[PREV] = self.head
+        entry[NEXT] = self.head[NEXT]
+        self.head[NEXT][PREV] = entry
+        self.head[NEXT] = entry
+
+    def _unlink(self, entry):
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self.entries[entry[KEY]]
+        self.bytes -= entry[SIZE]
+
+# Shared by every Memcache instance in the process.
+local_cache = LocalCache()
+
+
+class Memcache(CacheBackend):
     """
         Memcache 
     """
@@ -42,19 +339,44 @@ class Memcache(Backend):
     backend_type = "backend"
     enabled = True
 
+    # Values larger than chunk_size are split over several memcache items,
+    # values larger than max_value_size are not cached at all.
+    chunk_size = 1000000
+    max_value_size = 33554432
+
+    @classmethod
+    def create_pool(cls, manager):
+        # One client per worker is enough since a request only holds a
+        # client for the length of a cache call.
+        return ClientPool(manager.memcached_servers, size=manager.max_workers + 1, **manager.cache_options)
+
     # Should be configured to read fromn settings file instead of default
-    def connect(self, debug=0, hosts=['127.0.0.1:11211',]):
-        self.mc = memcache.Client(hosts, debug)
+    def connect(self, debug=0, hosts=['127.0.0.1:11211',], pool=None, local=True,
+                value_format=cacheformat.PICKLE, compress_threshold=None):
+        """
+        Attaches to a shared ClientPool, or to a private single client pool
+        when none is given. local turns the in-process LocalCache tier on.
+        value_format is the format new values are written in, see
+        bullfrog.cacheformat. Values in either format can be read.
+        Serialized values larger than compress_threshold bytes are stored
+        zlib compressed.
+        """
+        if value_format not in cacheformat.FORMATS:
+            raise cacheformat.CacheFormatError("Unknown cache value format: %s" % value_format)
+        self.value_format = value_format
+        self.compress_threshold = compress_threshold
+        if pool is None:
+            pool = ClientPool(hosts, debug, size=1)
+        self.pool = pool
+        self.local = None
+        if local:
+            self.local = local_cache
         self.is_cachable = False
     
     def fetch(self):
         pass
 
     def write(self, key, value, cache_ttl=600, threshold=86400):
-        if len(value) > 2097152:
-            raise CacheException("MemCache Cannot Cache greater than 2MB")
-        
-            
         if threshold > 86400:
             threshold = 86400
         
@@ -63,36 +385,193 @@ class Memcache(Backend):
         if total_timeout > 86400:
             total_timeout = 86400
             
-        key_version = "1" # TODO: read from settings.py to clear cache.
-        versioned_key = hashlib.md5(key_version + "_" + key).hexdigest()
+        versioned_key = self.versioned_key(key)
         
         tmp_tuple = (value, cache_ttl, threshold, time())
-        pickled_cache_data = cPickle.dumps(tmp_tuple)
+        pickled_cache_data = cacheformat.dumps(tmp_tuple, self.value_format, self.compress_threshold)
+        if len(pickled_cache_data) > self.max_value_size:
+            raise CacheException("MemCache Cannot Cache greater than %d bytes" % self.max_value_size)
                
-        self.mc.set(versioned_key, pickled_cache_data, total_timeout)
+        mc = self.pool.acquire()
+        try:
+            if len(pickled_cache_data) > self.chunk_size:
+                self.set_chunked(mc, versioned_key, pickled_cache_data, total_timeout)
+            else:
+                mc.set(versioned_key, pickled_cache_data, total_timeout)
+        finally:
+            self.pool.release(mc)
+
+        if self.local:
+            self.local.put(versioned_key, tmp_tuple, len(pickled_cache_data))
         
         # Return the generated cache key for reference. Might come in handy.
         return versioned_key
 
     def read(self, key):
-        key_version = "1" # TODO: read for settings.py
-        versioned_key = hashlib.md5(key_version + "_" + key).hexdigest()
-        pickled_cache_value = self.mc.get(versioned_key)
+        versioned_key = self.versioned_key(key)
+        if self.local:
+            cached_tuple = self.local.get(versioned_key)
+            if cached_tuple is not None:
+                return cached_tuple
+
+        mc = self.pool.acquire()
+        try:
+            pickled_cache_value = mc.get(versioned_key)
+            if pickled_cache_value and pickled_cache_value.startswith(MANIFEST_MAGIC):
+                pickled_cache_value = self.get_chunked(mc, {versioned_key: pickled_cache_value}).get(versioned_key)
+        finally:
+            self.pool.release(mc)
         
         # The cached tuple contains all info for cache_ttl vs threshold.
         if pickled_cache_value:
-            cached_tuple = cPickle.loads(pickled_cache_value)
-            return cached_tuple
+            return self.loads(versioned_key, pickled_cache_value)
         return None
-    
+
+    def read_multi(self, keys):
+        """
+        Reads many keys in a single round trip. Returns a dictionary of key
+        to cached tuple for the keys that were found.
+        """
+        cached_tuples = {}
+        versioned_keys = {}
+        for key in keys:
+            versioned_key = self.versioned_key(key)
+            if self.local:
+                cached_tuple = self.local.get(versioned_key)
+                if cached_tuple is not None:
+                    cached_tuples[key] = cached_tuple
+                    continue
+            versioned_keys[versioned_key] = key
+
+        if not versioned_keys:
+            return cached_tuples
+
+        mc = self.pool.acquire()
+        try:
+            pickled_cache_values = mc.get_multi(versioned_keys.keys())
+            manifests = dict((k, v) for (k, v) in pickled_cache_values.items()
+                             if v and v.startswith(MANIFEST_MAGIC))
+            if manifests:
+                for versioned_key in manifests:
+                    del pickled_cache_values[versioned_key]
+                pickled_cache_values.update(self.get_chunked(mc, manifests))
+        finally:
+            self.pool.release(mc)
+
+        for versioned_key, pickled_cache_value in pickled_cache_values.items():
+            if pickled_cache_value:
+                cached_tuple = self.loads(versioned_key, pickled_cache_value)
+                if cached_tuple is not None:
+                    cached_tuples[versioned_keys[versioned_key]] = cached_tuple
+        return cached_tuples
+
+    def loads(self, versioned_key, pickled_cache_value):
+        """
+        Decodes a stored value, in either format. A value that cannot be
+        decoded is treated as a miss.
+        """
+        try:
+            cached_tuple = cacheformat.loads(pickled_cache_value)
+        except cacheformat.CacheFormatError:
+            return None
+        if self.local:
+            self.local.put(versioned_key, cached_tuple, len(pickled_cache_value))
+        return cached_tuple
+
+    def set_chunked(self, mc, versioned_key, data, timeout):
+        """
+        Stores data over as many chunk items as needed, then the manifest
+        that points at them. Readers see the old value or the new one, a
+        manifest is never written for chunks that failed to store.
+        """
+        generation = '%08x' % random.getrandbits(32)
+        chunks = {}
+        for index, offset in enumerate(xrange(0, len(data), self.chunk_size)):
+            chunks[self.chunk_key(versioned_key, generation, index)] = data[offset:offset + self.chunk_size]
+
+        if mc.set_multi(chunks, timeout):
+            raise CacheException("MemCache failed to store chunks for %s" % versioned_key)
+
+        checksum = zlib.crc32(data) & 0xffffffff
+        mc.set(versioned_key, MANIFEST.pack(MANIFEST_MAGIC, generation, len(chunks), len(data), checksum), timeout)
+
+    def get_chunked(self, mc, manifests):
+        """
+        Reassembles chunked values in one get_multi. manifests maps versioned
+        keys to their manifest. Returns a dictionary of versioned key to value
+        for the values that are complete and intact; an evicted chunk or a
+        checksum mismatch makes that value a miss.
+        """
+        wanted = {}
+        chunk_keys = []
+        for versioned_key, manifest in manifests.items():
+            try:
+                magic, generation, count, size, checksum = MANIFEST.unpack(manifest)
+            except struct.error:
+                continue
+            keys = [self.chunk_key(versioned_key, generation, index) for index in xrange(count)]
+            wanted[versioned_key] = (keys, size, checksum)
+            chunk_keys.extend(keys)
+
+        chunks = {}
+        if chunk_keys:
+            chunks = mc.get_multi(chunk_keys)
+
+        values = {}
+        for versioned_key, (keys, size, checksum) in wanted.items():
+            if not all(key in chunks for key in keys):
+                continue
+            data = ''.join([chunks[key] for key in keys])
+            if len(data) == size and zlib.crc32(data) & 0xffffffff == checksum:
+                values[versioned_key] = data
+        return values
+
+    def chunk_key(self, versioned_key, generation, index):
+        return "%s_%s_%d" % (versioned_key, generation, index)
+
+    def versioned_key(self, key):
+        key_version = "1" # TODO: read from settings.py to clear cache.
+        return hashlib.md5(key_version + "_" + key).hexdigest()
+
+    def acquire_lock(self, key, timeout=30):
+        """
+        Takes a cross-process lock on key using memcache add, which only
+        succeeds if the lock key does not exist yet. Returns a token to
+        release the lock with, or None if another process holds it. The lock
+        expires after timeout seconds in case its holder goes away.
+        """
+        token = "%d-%d-%f" % (os.getpid(), random.getrandbits(32), time())
+        if self._call('add', self.versioned_key("lock_" + key), token, timeout):
+            return token
+        return None
+
+    def release_lock(self, key, token):
+        """
+        Releases a lock taken with acquire_lock, unless it has expired and
+        been taken by someone else in the meantime.
+        """
+        lock_key = self.versioned_key("lock_" + key)
+        if self._call('get', lock_key) == token:
+            self._call('delete', lock_key)
+
     def delete(self, key):
-        self.mc.delete(key)
+        versioned_key = self.versioned_key(key)
+        if self.local:
+            self.local.delete(versioned_key)
+        self._call('delete', versioned_key)
         
     def append(self, key, value):
-        self.mc.append(key, value)
+        self._call('append', key, value)
     
     def increment(self, key, delta=1):
-        self.mc.incr(key,delta)
+        self._call('incr', key, delta)
     
     def decrement(self, key, delta=1):
-        self.mc.decr(key, delta)
+        self._call('decr', key, delta)
+
+    def _call(self, method, *args):
+        mc = self.pool.acquire()
+        try:
+            return getattr(mc, method)(*args)
+        finally:
+            self.pool.release(mc)
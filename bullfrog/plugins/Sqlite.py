@@ -0,0 +1,310 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+
+from time import time
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import Queue
+
+from bullfrog.backend import CacheBackend, CacheException
+from bullfrog import cacheformat
+
+
+class Store(object):
+    """
+    Thread safe pool of connections to one sqlite cache file. Every process
+    on the host opening the same path shares its entries.
+
+    path      -- database file, created if missing.
+    max_bytes -- bound on the total size of stored values. Past it, expired
+                 and then least recently used entries are evicted.
+    size      -- connections kept open.
+    timeout   -- seconds to wait for another writer to finish.
+    """
+
+    # Writes between checks of the total size.
+    evict_interval = 100
+
+    # Last access times are only updated when older than this, so reads
+    # rarely write.
+    touch_interval = 60
+
+    # Largest number of keys in one query.
+    batch_size = 500
+
+    def __init__(self, path=None, max_bytes=268435456, size=4, timeout=5):
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), 'bullfrog-cache.db')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.idle = Queue.Queue()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.writes = 0
+
+        conn = self.acquire()
+        try:
+            # Write ahead logging lets readers carry on while one writes.
+            conn.execute("PRAGMA journal_mode=WAL").fetchall()
+            conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                         "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                         "expires REAL NOT NULL, accessed REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS locks ("
+                         "key TEXT PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL)")
+        finally:
+            self.release(conn)
+
+    def acquire(self):
+        """
+        Returns an idle connection, opening one if the pool is not full yet.
+        Blocks when every connection is in use.
+        """
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except Queue.Empty:
+                conn = self.open()
+                if conn is None:
+                    conn = self.idle.get()
+            # None is put on the queue when a slot frees up, see release().
+            if conn is not None:
+                return conn
+
+    def open(self):
+        """
+        Opens a connection if the pool is not full, otherwise returns None.
+        """
+        self.lock.acquire()
+        try:
+            if len(self.connections) < self.size:
+                # Autocommit, each statement is its own transaction.
+                conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                       isolation_level=None, check_same_thread=False)
+                conn.text_factory = str
+                self.connections.append(conn)
+                return conn
+            return None
+        finally:
+            self.lock.release()
+
+    def release(self, conn):
+        """
+        Returns conn to the pool. Connections opened before the last
+        disconnect_all() are closed instead, waking a thread waiting in
+        acquire() to open a new one.
+        """
+        self.lock.acquire()
+        try:
+            if conn in self.connections:
+                self.idle.put(conn)
+                return
+            self.idle.put(None)
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def disconnect_all(self):
+        """
+        Closes the idle connections. Connections in use are closed when they
+        are released. The pool reopens them on next use.
+        """
+        self.lock.acquire()
+        try:
+            self.connections = []
+            idle = []
+            while True:
+                try:
+                    idle.append(self.idle.get_nowait())
+                except Queue.Empty:
+                    break
+        finally:
+            self.lock.release()
+
+        for conn in idle:
+            if conn is not None:
+                conn.close()
+
+    def get(self, key):
+        return self.get_multi([key]).get(key)
+
+    def get_multi(self, keys):
+        """
+        Returns a dictionary of key to stored value for the keys present and
+        not expired.
+        """
+        values = {}
+        touched = []
+        now = time()
+        keys = list(keys)
+        conn = self.acquire()
+        try:
+            for start in xrange(0, len(keys), self.batch_size):
+                batch = keys[start:start + self.batch_size]
+                rows = conn.execute("SELECT key, value, expires, accessed FROM entries WHERE key IN (%s)"
+                                    % ','.join('?' * len(batch)), batch).fetchall()
+                for key, value, expires, accessed in rows:
+                    if expires <= now:
+                        continue
+                    values[key] = str(value)
+                    if accessed < now - self.touch_interval:
+                        touched.append((now, key))
+            if touched:
+                conn.executemany("UPDATE entries SET accessed = ? WHERE key = ?", touched)
+        finally:
+            self.release(conn)
+        return values
+
+    def set(self, key, value, timeout):
+        now = time()
+        conn = self.acquire()
+        try:
+            conn.execute("INSERT OR REPLACE INTO entries (key, value, size, expires, accessed) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         (key, sqlite3.Binary(value), len(value), now + timeout, now))
+
+            self.lock.acquire()
+            try:
+                self.writes += 1
+                evict = self.writes % self.evict_interval == 0
+            finally:
+                self.lock.release()
+            if evict:
+                self.evict(conn)
+        finally:
+            self.release(conn)
+
+    def delete(self, key):
+        conn = self.acquire()
+        try:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        finally:
+            self.release(conn)
+
+    def add_lock(self, key, token, timeout):
+        """
+        Takes the lock on key unless it is held and not expired. Returns True
+        if the lock was taken.
+        """
+        now = time()
+        conn = self.acquire()
+        try:
+            conn.execute("DELETE FROM locks WHERE key = ? AND expires <= ?", (key, now))
+            cursor = conn.execute("INSERT OR IGNORE INTO locks (key, token, expires) VALUES (?, ?, ?)",
+                                  (key, token, now + timeout))
+            return cursor.rowcount == 1
+        finally:
+            self.release(conn)
+
+    def delete_lock(self, key, token):
+        conn = self.acquire()
+        try:
+            conn.execute("DELETE FROM locks WHERE key = ? AND token = ?", (key, token))
+        finally:
+            self.release(conn)
+
+    def evict(self, conn):
+        """
+        Drops expired entries, then the least recently used ones until the
+        total size is back under 90% of max_bytes.
+        """
+        conn.execute("DELETE FROM entries WHERE expires <= ?", (time(),))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        excess = total - int(self.max_bytes * 0.9)
+        while excess > 0:
+            rows = conn.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT ?",
+                                (self.batch_size,)).fetchall()
+            if not rows:
+                break
+            victims = []
+            for key, size in rows:
+                victims.append(key)
+                excess -= size
+                if excess <= 0:
+                    break
+            conn.execute("DELETE FROM entries WHERE key IN (%s)" % ','.join('?' * len(victims)), victims)
+
+
+class Sqlite(CacheBackend):
+    """
+    Cache backend keeping entries in a local sqlite file, for hosts without
+    memcache. Reads do not leave the host, and the file is shared by every
+    process on it. Select it with ClientManager(cache_backend='sqlite'),
+    cache_options are passed to Store (path, max_bytes...).
+    """
+
+    scheme = "sqlite"
+    backend_type = "backend"
+    enabled = True
+
+    # Values larger than this are not cached.
+    max_value_size = 33554432
+
+    @classmethod
+    def create_pool(cls, manager):
+        return Store(**manager.cache_options)
+
+    def connect(self, pool=None, local=True, value_format=cacheformat.PICKLE, compress_threshold=None):
+        """
+        Attaches to a shared Store, or opens the default one. local is
+        accepted for compatibility with Memcache; entries are local already.
+        """
+        if value_format not in cacheformat.FORMATS:
+            raise cacheformat.CacheFormatError("Unknown cache value format: %s" % value_format)
+        if pool is None:
+            pool = Store(size=1)
+        self.pool = pool
+        self.value_format = value_format
+        self.compress_threshold = compress_threshold
+
+    def fetch(self):
+        pass
+
+    def write(self, key, value, cache_ttl=600, threshold=86400):
+        cached_tuple = (value, cache_ttl, threshold, time())
+        data = cacheformat.dumps(cached_tuple, self.value_format, self.compress_threshold)
+        if len(data) > self.max_value_size:
+            raise CacheException("Sqlite Cannot Cache greater than %d bytes" % self.max_value_size)
+        self.pool.set(key, data, cache_ttl + threshold)
+        return key
+
+    def read(self, key):
+        return self.read_multi([key]).get(key)
+
+    def read_multi(self, keys):
+        cached_tuples = {}
+        for key, data in self.pool.get_multi(keys).items():
+            try:
+                cached_tuples[key] = cacheformat.loads(data)
+            except cacheformat.CacheFormatError:
+                pass
+        return cached_tuples
+
+    def delete(self, key):
+        self.pool.delete(key)
+
+    def acquire_lock(self, key, timeout=30):
+        token = "%d-%d-%f" % (os.getpid(), random.getrandbits(32), time())
+        if self.pool.add_lock(key, token, timeout):
+            return token
+        return None
+
+    def release_lock(self, key, token):
+        self.pool.delete_lock(key, token)
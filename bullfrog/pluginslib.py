@@ -43,5 +43,7 @@ class Plugins(object):
                     real_plugin = module.__dict__[module.__name__]
                     self.scheme_to_plugin[real_plugin.scheme] = real_plugin
                     self.scheme_to_name[real_plugin.scheme] = real_plugin.__name__
+                    if getattr(real_plugin, 'cacheable', False):
+                        self.cacheable_plugins[real_plugin.scheme] = real_plugin
                     
                     self.library.append(real_plugin)
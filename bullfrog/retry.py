@@ -0,0 +1,170 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Retry decisions for failed fetches: which errors are worth another
+attempt, how long to back off before it and whether the process can
+afford it.
+
+Retries are paid for out of a RetryBudget shared by the whole process.
+Every request tops it up by a fraction of a retry and every retry spends
+one, so when an upstream is down retries stay a small share of the traffic
+instead of multiplying it.
+"""
+
+import httplib
+import random
+import socket
+import threading
+from time import time
+from urllib2 import HTTPError
+
+# Responses that are worth retrying, anything else 4xx/5xx is final.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class RetryBudget(object):
+    """
+    Token bucket of retries. Each request adds ratio tokens, each retry
+    takes one. min_per_second tokens are added over time regardless so a
+    quiet process can still retry. The bucket holds at most max_tokens.
+
+    Example:
+        budget = RetryBudget(ratio=0.1)
+        budget.deposit()            # a request went out
+        if budget.withdraw():       # may it be retried?
+            ...
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=10, max_tokens=100):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = float(max_tokens)
+        self.last_refill = time()
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        self.lock.acquire()
+        try:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+        finally:
+            self.lock.release()
+
+    def withdraw(self):
+        """
+        Takes a token for a retry. Returns False if there isn't one.
+        """
+        self.lock.acquire()
+        try:
+            now = time()
+            self.tokens = min(self.max_tokens,
+                              self.tokens + (now - self.last_refill) * self.min_per_second)
+            self.last_refill = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+        finally:
+            self.lock.release()
+
+
+class RetryPolicy(object):
+    """
+    Decides whether and when a failed attempt is retried.
+
+    max_retries   -- retries after the first attempt. None uses the
+                     Request's retries.
+    backoff       -- seconds before the first retry, multiplied by
+                     multiplier for each one after, up to max_backoff.
+    jitter        -- wait a random time between zero and the backoff
+                     ("full jitter") so clients don't retry in lockstep.
+    retry_statuses-- HTTP codes worth retrying. Socket errors, timeouts
+                     and broken responses always are; other errors, e.g.
+                     4xx responses or regex invalidation, are not.
+    budget        -- RetryBudget to spend from, the process wide one by
+                     default.
+
+    A Retry-After header on a 429 or 503 is honoured if it is no longer
+    than max_backoff, otherwise the request is not retried.
+
+    Example:
+        policy = RetryPolicy(max_retries=3, backoff=0.1)
+        client = ClientManager(retry_policy=policy)
+        client.add_request(source='http://cnn.com', retry_policy=RetryPolicy(max_retries=0))
+    """
+
+    def __init__(self, max_retries=None, backoff=0.05, multiplier=2, max_backoff=2.0,
+                 jitter=True, retry_statuses=RETRY_STATUSES, budget=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self.budget = budget or retry_budget
+
+    def record_request(self):
+        """
+        Called once for every request that goes to the network.
+        """
+        self.budget.deposit()
+
+    def is_retryable(self, error):
+        if isinstance(error, HTTPError):
+            return error.code in self.retry_statuses
+        return isinstance(error, (socket.error, httplib.HTTPException))
+
+    def next_delay(self, error, retries, default_max_retries=1):
+        """
+        Returns the seconds to wait before retrying after error, or None
+        if it should not be retried. retries is the number made so far.
+        Spends from the budget when the answer is a retry.
+        """
+        max_retries = self.max_retries
+        if max_retries is None:
+            max_retries = default_max_retries
+        if retries >= max_retries or not self.is_retryable(error):
+            return None
+
+        delay = min(self.max_backoff, self.backoff * self.multiplier ** retries)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            if retry_after > self.max_backoff:
+                return None
+            delay = max(delay, retry_after)
+
+        if not self.budget.withdraw():
+            return None
+        return delay
+
+    def retry_after(self, error):
+        """
+        Seconds from a Retry-After header, None if there isn't one in that
+        form.
+        """
+        headers = getattr(error, 'hdrs', None)
+        if headers is None:
+            return None
+        try:
+            return max(0, int(headers.get('retry-after', '')))
+        except ValueError:
+            return None
+
+
+# Shared by every RetryPolicy that isn't given a budget of its own.
+retry_budget = RetryBudget()
+
+# Used by requests without a retry_policy when the ClientManager has none.
+default_policy = RetryPolicy()
@@ -0,0 +1,256 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+import traceback
+import Queue
+from time import time
+
+class DeadlineExceeded(Exception):
+    """
+    Set as the exception of requests that did not finish before their
+    batch deadline.
+    """
+
+
+class Deadline(object):
+    """
+    Point in time a batch of requests has to be done by, shared by the
+    requests of one ClientManager.execute(deadline=...) call.
+
+    Whoever settles a request first, its backend when it finishes or the
+    client manager when time is up, is the only one to write its result,
+    so a fetch that finishes late cannot overwrite what the caller has
+    already been handed.
+
+    Example:
+        deadline = Deadline(0.5)
+        timeout = deadline.clamp(request.timeout)
+        if deadline.settle(request):
+            ... write the result ...
+    """
+
+    def __init__(self, seconds):
+        self.expires = time() + seconds
+        self.lock = threading.Lock()
+        self.settled = set()
+
+    def remaining(self):
+        return max(0.0, self.expires - time())
+
+    def expired(self):
+        return time() >= self.expires
+
+    def clamp(self, timeout):
+        """
+        Returns timeout cut down to the time left. Never zero, a zero socket
+        timeout means non-blocking.
+        """
+        return max(0.001, min(timeout, self.remaining()))
+
+    def settle(self, request):
+        """
+        Returns True if the caller is the first to settle request.
+        """
+        self.lock.acquire()
+        try:
+            if id(request) in self.settled:
+                return False
+            self.settled.add(id(request))
+            return True
+        finally:
+            self.lock.release()
+
+
+class WorkerPool(object):
+    """
+    Fixed size pool of worker threads fed from a bounded queue. Used by
+    ClientManager to run backend fetches so that the number of threads stays
+    flat no matter how many requests are in a batch.
+
+    max_workers  -- number of worker threads.
+    max_per_host -- optional cap on concurrent jobs for the same host. Jobs
+                    over the cap are parked and picked up by the worker that
+                    finishes the previous job for that host.
+    queue_size   -- bound on jobs waiting for a worker. submit() blocks
+                    when the queue is full.
+
+    Example:
+        pool = WorkerPool(max_workers=10, max_per_host=2)
+        pool.submit(backend.run, host='cnn.com')
+        pool.submit(other.run, callback=lambda: done.put(other))
+        pool.join()
+    """
+
+    def __init__(self, max_workers=10, max_per_host=None, queue_size=None):
+        self.max_workers = max(1, max_workers)
+        self.max_per_host = max_per_host
+        if queue_size is None:
+            queue_size = self.max_workers * 4
+
+        self.queue = Queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.all_done = threading.Condition(self.lock)
+
+        # Number of jobs submitted but not yet finished (queued, parked or
+        # running). join() waits for this to drop to zero.
+        self.outstanding = 0
+
+        # Per host bookkeeping for max_per_host.
+        self.host_active = {}
+        self.host_pending = {}
+
+        self.workers = []
+        self.closed = False
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._work, name="bullfrog-worker-%d" % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job, host=None, block=True, callback=None, deadline=None, expired=None):
+        """
+        Queue a callable to be run by a worker. Jobs that share a host are
+        subject to max_per_host. With block False, Queue.Full is raised
+        instead of waiting when the queue is full.
+
+        callback is called with no arguments on the worker thread once the
+        job has finished, whether or not it raised. Jobs still waiting for
+        a worker when their Deadline expires are dropped and expired, if
+        given, is called in their place. The callback is still called.
+        """
+        if self.closed:
+            raise RuntimeError("WorkerPool has been shut down")
+
+        if deadline is not None:
+            job = self._with_deadline(job, deadline, expired)
+        if callback is not None:
+            job = self._with_callback(job, callback)
+
+        self.lock.acquire()
+        try:
+            self.outstanding += 1
+        finally:
+            self.lock.release()
+
+        try:
+            self.queue.put((job, host), block)
+        except Queue.Full:
+            self._next_for_host(None)
+            raise
+
+    def join(self):
+        """
+        Block until every submitted job has finished.
+        """
+        self.all_done.acquire()
+        try:
+            while self.outstanding:
+                self.all_done.wait()
+        finally:
+            self.all_done.release()
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers once the queue has drained.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for worker in self.workers:
+            self.queue.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            job, host = item
+            if not self._claim_host(job, host):
+                # Parked until a job for the same host finishes.
+                continue
+
+            while job is not None:
+                self._run(job)
+                job = self._next_for_host(host)
+
+    def _claim_host(self, job, host):
+        if host is None or not self.max_per_host:
+            return True
+
+        self.lock.acquire()
+        try:
+            active = self.host_active.get(host, 0)
+            if active >= self.max_per_host:
+                self.host_pending.setdefault(host, []).append(job)
+                return False
+            self.host_active[host] = active + 1
+            return True
+        finally:
+            self.lock.release()
+
+    def _next_for_host(self, host):
+        """
+        Called when a job finishes. Hands back a parked job for the same
+        host (keeping the host slot) or releases the slot.
+        """
+        self.lock.acquire()
+        try:
+            self.outstanding -= 1
+            if not self.outstanding:
+                self.all_done.notifyAll()
+
+            if host is None or not self.max_per_host:
+                return None
+
+            pending = self.host_pending.get(host)
+            if pending:
+                job = pending.pop(0)
+                if not pending:
+                    del self.host_pending[host]
+                return job
+
+            self.host_active[host] -= 1
+            if not self.host_active[host]:
+                del self.host_active[host]
+            return None
+        finally:
+            self.lock.release()
+
+    def _with_deadline(self, job, deadline, expired=None):
+        def run_job():
+            if not deadline.expired():
+                job()
+            elif expired is not None:
+                expired()
+        return run_job
+
+    def _with_callback(self, job, callback):
+        def run_job():
+            try:
+                job()
+            finally:
+                callback()
+        return run_job
+
+    def _run(self, job):
+        try:
+            job()
+        except Exception:
+            # Backends record their own failures on the request. Anything
+            # escaping is a bug, report it but keep the worker alive.
+            traceback.print_exc(file=sys.stderr)
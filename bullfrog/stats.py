@@ -0,0 +1,157 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+# Upper bounds in seconds of the buckets reported by Histogram.buckets().
+DEFAULT_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Per request phases recorded in request.timings.
+PHASES = ('dns', 'connect', 'ttfb', 'download', 'decompress', 'cache_read', 'cache_write')
+
+class Histogram(object):
+    """
+    Distribution of durations in seconds. Keeps every sample, a batch is at
+    most a few thousand requests, so percentiles are exact. buckets() gives
+    cumulative counts for exporting to metrics systems that take histograms.
+    """
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.samples = []
+        self.sorted = True
+
+    def add(self, value):
+        if self.samples and value < self.samples[-1]:
+            self.sorted = False
+        self.samples.append(value)
+
+    @property
+    def count(self):
+        return len(self.samples)
+
+    @property
+    def total(self):
+        return sum(self.samples)
+
+    def percentile(self, percent):
+        """
+        Nearest rank percentile, None when there are no samples.
+        """
+        if not self.samples:
+            return None
+        if not self.sorted:
+            self.samples.sort()
+            self.sorted = True
+        rank = int(math.ceil(percent / 100.0 * len(self.samples)))
+        return self.samples[max(rank, 1) - 1]
+
+    def buckets(self):
+        """
+        Returns a list of (upper bound, samples <= bound) ending with
+        ('+Inf', count).
+        """
+        counts = []
+        for bound in self.bounds:
+            counts.append((bound, len([s for s in self.samples if s <= bound])))
+        counts.append(('+Inf', len(self.samples)))
+        return counts
+
+    def summary(self):
+        summary = {'count': self.count, 'sum': self.total}
+        if self.samples:
+            summary.update({
+                'min': min(self.samples),
+                'max': max(self.samples),
+                'mean': self.total / len(self.samples),
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+            })
+        return summary
+
+
+class BatchStats(object):
+    """
+    Aggregates the requests of one ClientManager.execute() call: response
+    time and per phase histograms, cache hits, bytes and errors.
+
+    Example:
+        client.execute()
+        stats = client.get_stats()
+        print stats.response_time.percentile(99), stats.hit_ratio
+        send_to_metrics(stats.as_dict())
+    """
+
+    def __init__(self, timers=None):
+        self.timers = dict(timers or {})
+        self.response_time = Histogram()
+        self.phases = dict((phase, Histogram()) for phase in PHASES)
+        self.requests = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.bytes = 0
+
+    def add(self, request):
+        """
+        Counts a finished request. Expects content_length and timed_out to
+        have been set by ClientManager.collect_results().
+        """
+        self.requests += 1
+        if getattr(request, 'cache_hit', False):
+            self.cache_hits += 1
+        if getattr(request, 'coalesced', False):
+            self.coalesced += 1
+        if getattr(request, 'exception', None):
+            self.errors += 1
+        if getattr(request, 'timed_out', 0):
+            self.timeouts += 1
+        self.bytes += getattr(request, 'content_length', 0)
+
+        response_time = getattr(request, 'response_time', None)
+        if isinstance(response_time, (int, long, float)):
+            self.response_time.add(response_time)
+        for phase, seconds in (getattr(request, 'timings', None) or {}).items():
+            if phase in self.phases:
+                self.phases[phase].add(seconds)
+
+    @property
+    def hit_ratio(self):
+        if not self.requests:
+            return None
+        return float(self.cache_hits) / self.requests
+
+    def as_dict(self):
+        """
+        Flat dictionary of every figure, e.g. 'response_time.p99' or
+        'phase.connect.mean', ready to hand to a metrics client.
+        """
+        stats = {
+            'requests': self.requests,
+            'cache_hits': self.cache_hits,
+            'hit_ratio': self.hit_ratio,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'bytes': self.bytes,
+        }
+        for name, value in self.timers.items():
+            stats['timers.%s' % name] = value
+        for name, value in self.response_time.summary().items():
+            stats['response_time.%s' % name] = value
+        for phase, histogram in self.phases.items():
+            for name, value in histogram.summary().items():
+                stats['phase.%s.%s' % (phase, name)] = value
+        return stats
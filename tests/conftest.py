@@ -0,0 +1,294 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Shared fixtures: a local HTTP server, a ClientManager to fetch from it
+    with and an in-process stand-in for memcache, so the tests need neither
+    network nor a memcache server.
+
+    Run with:
+        python -m pytest tests
+"""
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from cStringIO import StringIO
+from urlparse import urlparse, parse_qs
+
+import pytest
+
+root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, root_path)
+
+# ClientManager loads the plugins as top level modules, import them the same
+# way so the tests see the same module level pools.
+sys.path.insert(0, os.path.join(root_path, 'bullfrog', 'plugins'))
+
+
+def gzipped(data):
+    buf = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+    gzip_file.write(data)
+    gzip_file.close()
+    return buf.getvalue()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers with a body shaped by the query string:
+
+        latency -- milliseconds to wait before answering
+        first   -- milliseconds to wait on the path's first request only
+        status  -- response code (default 200)
+        body    -- response body (default "hello")
+        chunks  -- send the body that many times over, chunked
+        pause   -- milliseconds to wait before each chunk
+        gzip    -- gzip the body (each chunk is a gzip member of its own)
+        etag    -- send this ETag, answer 304 to a request that has it
+        drop    -- close the connection after answering without saying so,
+                   like a server whose keep-alive timeout ran out
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        hits = self.server.record(url.path, self.command)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        latency = float(query.get('latency', ['0'])[0])
+        if hits == 1:
+            latency += float(query.get('first', ['0'])[0])
+        if latency:
+            time.sleep(latency / 1000.0)
+
+        etag = query.get('etag', [None])[0]
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        body = query.get('body', ['hello'])[0]
+        chunks = int(query.get('chunks', ['0'])[0])
+        if 'gzip' in query:
+            body = gzipped(body)
+        self.send_response(int(query.get('status', ['200'])[0]))
+        if 'gzip' in query:
+            self.send_header('Content-Encoding', 'gzip')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if chunks:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            if chunks:
+                pause = float(query.get('pause', ['0'])[0])
+                for i in range(chunks):
+                    if pause:
+                        time.sleep(pause / 1000.0)
+                    self.wfile.write('%x\r\n%s\r\n' % (len(body), body))
+                self.wfile.write('0\r\n\r\n')
+            else:
+                self.wfile.write(body)
+        if 'drop' in query:
+            self.close_connection = 1
+
+    do_POST = do_HEAD = do_GET
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.hits = defaultdict(int)
+        self.methods = defaultdict(list)
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        self.lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self.lock.release()
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def record(self, path, method):
+        self.lock.acquire()
+        try:
+            self.hits[path] += 1
+            self.methods[path].append(method)
+            return self.hits[path]
+        finally:
+            self.lock.release()
+
+    def url(self, path, **params):
+        url = 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+        if params:
+            url += '?' + '&'.join('%s=%s' % item for item in sorted(params.items()))
+        return url
+
+
+class FakeMemcache(object):
+    """
+    Stands in for the memcache module. Every Client it makes reads and
+    writes the same dictionary, like clients of a single server, and each
+    call is recorded in calls as (method, args).
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.calls = []
+        self.clients = []
+        self.lock = threading.Lock()
+
+    def Client(self, servers, debug=0):
+        client = FakeClient(self, servers)
+        self.clients.append(client)
+        return client
+
+    def record(self, method, *args):
+        self.lock.acquire()
+        try:
+            self.calls.append((method, args))
+        finally:
+            self.lock.release()
+
+    def count(self, method):
+        return len([call for call in self.calls if call[0] == method])
+
+
+class FakeClient(object):
+
+    def __init__(self, memcache, servers):
+        self.memcache = memcache
+        self.servers = servers
+
+    def get(self, key):
+        self.memcache.record('get', key)
+        return self.memcache.data.get(key)
+
+    def get_multi(self, keys):
+        self.memcache.record('get_multi', keys)
+        data = self.memcache.data
+        return dict((key, data[key]) for key in keys if key in data)
+
+    def set(self, key, value, time=0):
+        self.memcache.record('set', key)
+        self.memcache.data[key] = value
+        return True
+
+    def set_multi(self, mapping, time=0):
+        self.memcache.record('set_multi', mapping.keys())
+        self.memcache.data.update(mapping)
+        return []
+
+    def add(self, key, value, time=0):
+        self.memcache.record('add', key)
+        self.memcache.lock.acquire()
+        try:
+            if key in self.memcache.data:
+                return False
+            self.memcache.data[key] = value
+            return True
+        finally:
+            self.memcache.lock.release()
+
+    def delete(self, key):
+        self.memcache.record('delete', key)
+        self.memcache.data.pop(key, None)
+        return 1
+
+    def disconnect_all(self):
+        self.memcache.record('disconnect_all')
+
+
+@pytest.fixture
+def fake_memcache(monkeypatch):
+    """
+    Makes the Memcache plugin use a FakeMemcache, returned for inspection.
+    """
+    from bullfrog.plugins import Memcache
+
+    fake = FakeMemcache()
+    monkeypatch.setattr(Memcache, 'memcache', fake)
+    Memcache.local_cache.clear()
+    yield fake
+    Memcache.local_cache.clear()
+
+
+@pytest.fixture
+def cached_client(fake_memcache):
+    """
+    A ClientManager that caches in fake_memcache.
+    """
+    from bullfrog.client import ClientManager
+
+    client = ClientManager()
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def http_server():
+    server = Server()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.setDaemon(True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(tmpdir):
+    from bullfrog.client import ClientManager
+
+    client = ClientManager(nocache=True, cache_backend='sqlite',
+                           cache_options={'path': str(tmpdir.join('cache.db'))})
+    yield client
+    client.close()
+
+
+@pytest.fixture(autouse=True)
+def clean_pools():
+    """
+    Idle keep-alive connections and response time samples must not leak
+    from one test into the next.
+    """
+    import Http
+
+    Http.connection_pool.clear()
+    Http.response_times.clear()
+    yield
+    Http.connection_pool.clear()
+    Http.response_times.clear()
@@ -0,0 +1,36 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from urllib2 import HTTPError
+
+from bullfrog.client import Request
+
+
+def test_execute_async_runs_requests_concurrently(client, http_server):
+    for i in range(10):
+        client.add_request(Request(source=http_server.url('/a%d' % i, latency=100)))
+    start = time.time()
+    requests = client.execute_async()
+    elapsed = time.time() - start
+
+    assert [r.response_content for r in requests] == ['hello'] * 10
+    assert [r.response_code for r in requests] == [200] * 10
+    assert elapsed < 0.5
+
+
+def test_execute_async_reports_errors_like_execute(client, http_server):
+    client.add_request(Request(source=http_server.url('/missing', status=404), retries=0))
+    request = client.execute_async()[0]
+
+    assert isinstance(request.exception, HTTPError)
+    assert request.exception.code == 404
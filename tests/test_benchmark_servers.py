@@ -0,0 +1,91 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import httplib
+import os
+import sys
+import time
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+
+from servers import HttpServer, MemcacheStore
+
+
+def test_http_server_serves_the_requested_size():
+    server = HttpServer().start()
+    try:
+        conn = httplib.HTTPConnection('127.0.0.1', server.port)
+        conn.request('GET', '/bench?size=4096')
+        plain = conn.getresponse().read()
+        conn.request('GET', '/bench?size=4096&gzip=1')
+        response = conn.getresponse()
+        compressed = response.read()
+        conn.close()
+    finally:
+        server.stop()
+
+    assert len(plain) == 4096
+    assert response.getheader('Content-Encoding') == 'gzip'
+    assert gzip.GzipFile(fileobj=StringIO(compressed)).read() == plain
+
+
+def test_memcache_store_follows_memcache_rules(monkeypatch):
+    store = MemcacheStore()
+    now = time.time()
+
+    assert not store.set('set', 'big', '0', 'x' * (store.max_item_size + 1), 0)
+    assert not store.set('append', 'key', '0', 'b', 0)
+    assert store.set('set', 'key', '0', 'a', 0)
+    assert store.set('append', 'key', '0', 'b', 0)
+    assert store.get('key') == ('0', 'ab')
+
+    assert store.set('set', 'count', '0', '1', 0)
+    assert store.incr('count', 2) == 3
+    assert store.incr('count', -5) == 0
+
+    assert store.set('set', 'temp', '0', 'a', 10)
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert store.get('temp') is None
+    assert store.get('key') == ('0', 'ab')
+    assert store.get('count') == ('0', '0')
+
+
+def test_keep_alive_responses_are_not_delayed():
+    server = HttpServer().start()
+    try:
+        conn = httplib.HTTPConnection('127.0.0.1', server.port)
+        times = []
+        for i in range(5):
+            start = time.time()
+            conn.request('GET', '/bench?size=4096')
+            response = conn.getresponse()
+            assert len(response.read()) == 4096
+            times.append(time.time() - start)
+        conn.close()
+    finally:
+        server.stop()
+
+    # Nagle's algorithm and delayed ACKs add ~40ms per reused connection.
+    assert max(times[1:]) < 0.02
+
+
+def test_memcache_add_replaces_an_expired_key(monkeypatch):
+    store = MemcacheStore()
+    now = time.time()
+    assert store.set('set', 'key', '0', 'old', 10)
+    assert not store.set('add', 'key', '0', 'new', 0)
+
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert store.set('add', 'key', '0', 'new', 0)
+    assert store.get('key') == ('0', 'new')
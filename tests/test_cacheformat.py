@@ -0,0 +1,134 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+
+from bullfrog import cacheformat
+from bullfrog.cacheformat import CacheFormatError, dumps, loads
+from bullfrog.client import ClientManager, Request
+
+CACHED = (('<html>body</html>', {'content-type': 'text/html'}, 200, 0.25), 60, 86400, 1300000000.0)
+UNICODE = ((u'caf\xe9', {}, 200, 0.1), 60, 86400, 1300000000.0)
+ENCODED = (('\x1f\x8bgzip', {}, 200, 0.1, 'gzip'), 60, 86400, 1300000000.0)
+OTHER = ((['not', 'http'], 1), 60, 86400, 1300000000.0)
+
+
+@pytest.mark.parametrize('value_format', cacheformat.FORMATS)
+@pytest.mark.parametrize('cached_tuple', [CACHED, UNICODE, ENCODED, OTHER])
+@pytest.mark.parametrize('compress_threshold', [None, 0])
+def test_round_trip(value_format, cached_tuple, compress_threshold):
+    data = dumps(cached_tuple, value_format, compress_threshold)
+    assert loads(data) == cached_tuple
+
+
+def test_compact_format_is_used_for_http_tuples():
+    assert dumps(CACHED, cacheformat.COMPACT).startswith(cacheformat.MAGIC)
+    assert not dumps(OTHER, cacheformat.COMPACT).startswith(cacheformat.MAGIC)
+
+
+@pytest.mark.parametrize('value_format', cacheformat.FORMATS)
+def test_values_over_the_threshold_are_compressed(value_format):
+    large = (('x' * 1000, {}, 200, 0.1), 60, 86400, 1300000000.0)
+    data = dumps(large, value_format, compress_threshold=100)
+
+    assert data.startswith(cacheformat.ZLIB_MAGIC)
+    assert len(data) < 1000
+    assert loads(data) == large
+    assert not dumps(large, value_format, compress_threshold=2000).startswith(cacheformat.ZLIB_MAGIC)
+
+
+def test_incompressible_values_are_stored_plain():
+    noise = ((os.urandom(1000), {}, 200, 0.1), 60, 86400, 1300000000.0)
+    data = dumps(noise, cacheformat.COMPACT, compress_threshold=0)
+
+    assert data.startswith(cacheformat.MAGIC)
+    assert loads(data) == noise
+
+
+@pytest.mark.parametrize('value_format', cacheformat.FORMATS)
+def test_truncated_values_raise_cache_format_error(value_format):
+    data = dumps(CACHED, value_format)
+    for length in (1, 5, len(data) / 2):
+        with pytest.raises(CacheFormatError):
+            loads(data[:length])
+
+
+def test_truncated_compact_header_raises_cache_format_error():
+    data = dumps(CACHED, cacheformat.COMPACT)
+    for length in (5, cacheformat.HEADER.size - 1, cacheformat.HEADER.size + 3):
+        with pytest.raises(CacheFormatError):
+            loads(data[:length])
+
+
+@pytest.mark.parametrize('change', [lambda data: data[:-1], lambda data: data + 'x'])
+def test_compact_body_of_the_wrong_length_raises_cache_format_error(change):
+    with pytest.raises(CacheFormatError):
+        loads(change(dumps(CACHED, cacheformat.COMPACT)))
+
+
+def test_version_1_compact_values_are_still_read():
+    (content, headers, code, response_time), cache_ttl, threshold, written = CACHED
+    parts = [cacheformat.HEADER_V1.pack(cacheformat.MAGIC, 1, 0, code, response_time, cache_ttl,
+                                        threshold, written, len(headers))]
+    for name, value in headers.items():
+        parts.extend([cacheformat.FIELD.pack(len(name), len(value)), name, value])
+    parts.append(content)
+
+    assert loads(''.join(parts)) == CACHED
+
+
+@pytest.mark.parametrize('data', [
+    'garbage',
+    '\x80\x02garbage',
+    cacheformat.ZLIB_MAGIC + 'not zlib',
+    dumps(UNICODE, cacheformat.COMPACT)[:-1],
+])
+def test_corrupt_values_raise_cache_format_error(data):
+    with pytest.raises(CacheFormatError):
+        loads(data)
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(CacheFormatError):
+        dumps(CACHED, 'json')
+
+
+@pytest.mark.parametrize('cache_format', cacheformat.FORMATS)
+def test_client_reads_what_it_wrote(fake_memcache, http_server, cache_format):
+    url = http_server.url('/format')
+    for i in range(2):
+        client = ClientManager(cache_format=cache_format, local_cache=False)
+        client.add_request(Request(source=url))
+        request = client.execute()[0]
+        client.close()
+
+    assert request.cache_hit
+    assert request.response_content == 'hello'
+    assert http_server.hits['/format'] == 1
+    stored = [value for value in fake_memcache.data.values() if 'hello' in value]
+    assert stored[0].startswith(cacheformat.MAGIC) == (cache_format == cacheformat.COMPACT)
+
+
+def test_client_compresses_large_values(fake_memcache, http_server):
+    url = http_server.url('/large', body='x' * 1000)
+    for i in range(2):
+        client = ClientManager(cache_compress_threshold=100, local_cache=False)
+        client.add_request(Request(source=url))
+        request = client.execute()[0]
+        client.close()
+
+    assert request.cache_hit
+    assert request.response_content == 'x' * 1000
+    stored = [value for value in fake_memcache.data.values() if value.startswith(cacheformat.ZLIB_MAGIC)]
+    assert len(stored) == 1
@@ -0,0 +1,94 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from urllib2 import HTTPError
+
+import pytest
+
+from bullfrog.client import ClientManager, Request
+
+
+def fetch_together(client, engine='execute', count=5, **kwargs):
+    for i in range(count):
+        client.add_request(Request(**kwargs))
+    return getattr(client, engine)()
+
+
+@pytest.mark.parametrize('engine', ['execute', 'execute_async'])
+def test_concurrent_gets_share_one_fetch(client, http_server, engine):
+    requests = fetch_together(client, engine, source=http_server.url('/shared', latency=200))
+
+    assert http_server.hits['/shared'] == 1
+    assert [r.response_content for r in requests] == ['hello'] * 5
+    assert sorted(r.coalesced for r in requests) == [False] + [True] * 4
+
+
+def test_followers_get_the_leaders_failure(client, http_server):
+    requests = fetch_together(client, source=http_server.url('/down', latency=200, status=503),
+                              retries=0)
+
+    assert http_server.hits['/down'] == 1
+    assert all(isinstance(r.exception, HTTPError) for r in requests)
+    assert all(r.exception.code == 503 for r in requests)
+
+
+def test_posts_are_not_coalesced(client, http_server):
+    fetch_together(client, source=http_server.url('/post', latency=200), method='post', body='x=1')
+
+    assert http_server.methods['/post'] == ['POST'] * 5
+
+
+def test_streamed_requests_are_not_coalesced(client, http_server):
+    requests = fetch_together(client, source=http_server.url('/stream', latency=200), stream=True)
+
+    assert [''.join(r.response_content) for r in requests] == ['hello'] * 5
+    assert http_server.hits['/stream'] == 5
+    assert not any(r.coalesced for r in requests)
+
+
+@pytest.mark.parametrize('settings', [
+    {'timeout': 2},
+    {'retries': 0},
+    {'max_decompressed_size': 1000},
+    {'cache_compressed': True},
+    {'hedge': True, 'hedge_delay': 1},
+])
+def test_requests_with_other_settings_do_not_join(client, http_server, settings):
+    url = http_server.url('/settings', latency=200)
+    client.add_request(Request(source=url))
+    client.add_request(Request(source=url, **settings))
+    requests = client.execute()
+
+    assert http_server.hits['/settings'] == 2
+    assert not any(r.coalesced for r in requests)
+
+
+def test_managers_with_other_caches_do_not_join(tmpdir, http_server):
+    url = http_server.url('/caches', latency=200)
+    clients = [ClientManager(cache_backend='sqlite', cache_options={'path': str(tmpdir.join('%d.db' % i))})
+               for i in range(2)]
+    threads = []
+    for client in clients:
+        client.add_request(Request(source=url))
+        threads.append(threading.Thread(target=client.execute))
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for client in clients:
+            client.close()
+
+    assert http_server.hits['/caches'] == 2
+    assert not any(client.requests[0].coalesced for client in clients)
@@ -0,0 +1,114 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import zlib
+from cStringIO import StringIO
+
+import pytest
+
+from bullfrog.client import Request
+from bullfrog.compression import Decompressor, DecompressionError, decompress
+
+
+def gzipped(data):
+    buf = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+    gzip_file.write(data)
+    gzip_file.close()
+    return buf.getvalue()
+
+
+def feed(data, content_encoding, chunk_size):
+    decompressor = Decompressor(content_encoding)
+    out = [decompressor.decompress(data[i:i + chunk_size]) for i in range(0, len(data), chunk_size)]
+    return ''.join(out) + decompressor.flush()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 65536])
+def test_gzip_members_back_to_back(chunk_size):
+    data = gzipped('hello ') + gzipped('world')
+    assert feed(data, 'gzip', chunk_size) == 'hello world'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 65536])
+def test_trailing_garbage_after_gzip_is_ignored(chunk_size):
+    data = gzipped('hello') + '\x00\x00garbage\n'
+    assert feed(data, 'gzip', chunk_size) == 'hello'
+
+
+def test_garbage_starting_like_a_member_is_ignored():
+    assert feed(gzipped('hello') + '\x1f', 'gzip', 1) == 'hello'
+
+
+def test_raw_deflate_falls_back():
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress('hello') + compressor.flush()
+    assert decompress(data, 'deflate') == 'hello'
+
+
+def test_max_size_is_enforced():
+    with pytest.raises(DecompressionError):
+        decompress(gzipped('x' * 1000), 'gzip', max_size=100)
+
+
+def test_stacked_encodings_are_undone_in_reverse():
+    data = zlib.compress(gzipped('hello'))
+    assert feed(data, 'gzip, deflate', 3) == 'hello'
+
+
+def test_unsupported_encoding_is_rejected():
+    with pytest.raises(DecompressionError):
+        Decompressor('br')
+
+
+def test_gzipped_response_is_decoded(client, http_server):
+    client.add_request(Request(source=http_server.url('/gzip', body='hello', gzip=1)))
+    request = client.execute()[0]
+
+    assert request.resp_was_compressed
+    assert request.response_content == 'hello'
+
+
+def test_gzipped_stream_is_decoded_as_it_is_read(client, http_server):
+    client.add_request(Request(source=http_server.url('/gzip', body='hello', gzip=1, chunks=20),
+                               stream=True, chunk_size=10))
+    request = client.execute()[0]
+
+    assert ''.join(request.response_content) == 'hello' * 20
+
+
+def test_cache_compressed_keeps_the_gzip_bytes_until_read(cached_client, http_server):
+    url = http_server.url('/lazy', body='hello', gzip=1)
+    cached_client.add_request(Request(source=url, cache_compressed=True))
+    request = cached_client.execute()[0]
+
+    assert request.resp_was_compressed
+    assert request._encoded_content[1] == 'gzip'
+    assert request.response_content == 'hello'
+    assert request._encoded_content is None
+
+    content_tuple = request.cache.read(url)[0]
+    assert content_tuple[4] == 'gzip'
+    assert decompress(content_tuple[0], 'gzip') == 'hello'
+
+
+def test_cache_compressed_entry_is_decoded_lazily_on_a_hit(cached_client, http_server):
+    url = http_server.url('/lazy', body='hello', gzip=1)
+    cached_client.add_request(Request(source=url, cache_compressed=True))
+    cached_client.execute()
+    request = cached_client.execute()[0]
+
+    assert request.cache_hit
+    assert request._encoded_content is not None
+    assert request.response_content == 'hello'
+    assert http_server.hits['/lazy'] == 1
@@ -0,0 +1,118 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import pytest
+
+from bullfrog.client import ClientManager, Request
+from bullfrog.scheduler import Deadline, DeadlineExceeded, WorkerPool
+
+
+@pytest.fixture
+def single_worker(tmpdir):
+    client = ClientManager(nocache=True, max_workers=1, cache_backend='sqlite',
+                           cache_options={'path': str(tmpdir.join('cache.db'))})
+    yield client
+    client.close()
+
+
+def add_requests(client, http_server, count, latency):
+    for i in range(count):
+        client.add_request(Request(source=http_server.url('/u%d' % i, latency=latency)))
+
+
+def assert_settled(requests):
+    """
+    Every request has either content or DeadlineExceeded.
+    """
+    for request in requests:
+        if request.exception is None:
+            assert request.response_content == 'hello'
+            assert not request.deadline_exceeded
+        else:
+            assert isinstance(request.exception, DeadlineExceeded)
+            assert request.deadline_exceeded
+            assert request.timed_out == 1
+
+
+@pytest.mark.parametrize('count', [20, 100])
+def test_requests_dropped_from_the_queue_are_expired(single_worker, http_server, count):
+    add_requests(single_worker, http_server, count, 20)
+    start = time.time()
+    requests = single_worker.execute(deadline=0.1)
+    elapsed = time.time() - start
+
+    assert elapsed < 0.3
+    assert_settled(requests)
+    unfetched = [r for i, r in enumerate(requests) if '/u%d' % i not in http_server.hits]
+    assert unfetched
+    assert all(r.deadline_exceeded for r in unfetched)
+
+
+def test_iter_completed_yields_every_request_once(single_worker, http_server):
+    add_requests(single_worker, http_server, 20, 20)
+    requests = list(single_worker.iter_completed(deadline=0.1))
+
+    assert len(requests) == 20
+    assert len(set(map(id, requests))) == 20
+    assert_settled(requests)
+
+
+def test_execute_returns_at_the_deadline(client, http_server):
+    client.add_request(Request(source=http_server.url('/fast')))
+    client.add_request(Request(source=http_server.url('/slow', latency=500)))
+    start = time.time()
+    fast, slow = client.execute(deadline=0.15)
+
+    assert time.time() - start < 0.3
+    assert fast.response_content == 'hello'
+    assert not fast.deadline_exceeded
+    assert isinstance(slow.exception, DeadlineExceeded)
+    assert slow.deadline_exceeded
+    assert client.get_stats().timeouts == 1
+
+
+def test_late_fetch_does_not_overwrite_an_expired_request(client, http_server):
+    client.add_request(Request(source=http_server.url('/slow', latency=300)))
+    request = client.execute(deadline=0.1)[0]
+    time.sleep(0.4)
+
+    assert isinstance(request.exception, DeadlineExceeded)
+    assert getattr(request, 'response_code', None) is None
+
+
+def test_async_deadline(client, http_server):
+    client.add_request(Request(source=http_server.url('/fast')))
+    client.add_request(Request(source=http_server.url('/slow', latency=500)))
+    start = time.time()
+    fast, slow = client.execute_async(deadline=0.15)
+
+    assert time.time() - start < 0.3
+    assert fast.response_content == 'hello'
+    assert isinstance(slow.exception, DeadlineExceeded)
+
+
+def test_worker_pool_calls_expired_for_dropped_jobs():
+    pool = WorkerPool(max_workers=1)
+    ran, dropped = [], []
+    deadline = Deadline(0.05)
+    try:
+        for i in range(5):
+            pool.submit(lambda i=i: (ran.append(i), time.sleep(0.03)), deadline=deadline,
+                        expired=lambda i=i: dropped.append(i))
+        pool.join()
+    finally:
+        pool.shutdown()
+
+    assert ran and dropped
+    assert sorted(ran + dropped) == range(5)
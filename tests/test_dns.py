@@ -0,0 +1,242 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import time
+import uuid
+
+import pytest
+
+import Http
+from bullfrog.client import Request
+from bullfrog.plugins import DNS
+from bullfrog.scheduler import Deadline, WorkerPool
+
+
+def slow_lookup(hostname):
+    time.sleep(0.5)
+    return hostname, [], ['127.0.0.1']
+
+
+class CountingLookup(object):
+
+    def __init__(self, error=None):
+        self.error = error
+        self.hostnames = []
+
+    def __call__(self, hostname):
+        self.hostnames.append(hostname)
+        if self.error is not None:
+            raise self.error
+        return hostname, [], ['10.0.0.1', '10.0.0.2']
+
+
+class DictCache(object):
+    """
+    Just enough of a cache backend for DNS.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def read(self, key):
+        return self.data.get(key)
+
+    def write(self, key, value, cache_ttl=600):
+        self.data[key] = (value, cache_ttl, 0, time.time())
+
+
+def new_hostname():
+    return '%s.example' % uuid.uuid4().hex
+
+
+def test_resolve_all_looks_up_in_parallel(monkeypatch):
+    monkeypatch.setattr(DNS, 'gethostbyname_ex', slow_lookup)
+    hostnames = [new_hostname() for i in range(4)]
+    pool = WorkerPool(max_workers=4)
+    try:
+        start = time.time()
+        DNS.DNS().resolve_all(hostnames, pool=pool)
+        elapsed = time.time() - start
+    finally:
+        pool.shutdown(wait=False)
+
+    assert elapsed < 1.0
+    assert all(DNS.host_cache.has(hostname) for hostname in hostnames)
+
+
+def test_resolve_all_stops_waiting_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(DNS, 'gethostbyname_ex', slow_lookup)
+    hostname = new_hostname()
+    pool = WorkerPool(max_workers=2)
+    try:
+        start = time.time()
+        DNS.DNS().resolve_all([hostname], pool=pool, deadline=Deadline(0.1))
+        elapsed = time.time() - start
+        assert elapsed < 0.3
+        assert not DNS.host_cache.has(hostname)
+    finally:
+        pool.shutdown(wait=False)
+
+
+def test_lookups_queued_at_the_deadline_are_dropped(monkeypatch):
+    looked_up = []
+
+    def lookup(hostname):
+        looked_up.append(hostname)
+        return slow_lookup(hostname)
+
+    monkeypatch.setattr(DNS, 'gethostbyname_ex', lookup)
+    hostnames = [new_hostname() for i in range(3)]
+    pool = WorkerPool(max_workers=1)
+    try:
+        DNS.DNS().resolve_all(hostnames, pool=pool, deadline=Deadline(0.1))
+        pool.join()
+    finally:
+        pool.shutdown()
+
+    # The first lookup was running at the deadline, the others never ran.
+    assert len(looked_up) == 1
+    assert pool.outstanding == 0
+
+
+def test_lookups_are_cached_in_process(monkeypatch):
+    lookup = CountingLookup()
+    monkeypatch.setattr(DNS, 'gethostbyname_ex', lookup)
+    hostname = new_hostname()
+
+    assert DNS.DNS().lookup(hostname) == ['10.0.0.1', '10.0.0.2']
+    assert DNS.DNS().resolve(hostname, None) in ('10.0.0.1', '10.0.0.2')
+    assert lookup.hostnames == [hostname]
+
+
+def test_lookups_are_shared_through_the_cache(monkeypatch):
+    lookup = CountingLookup()
+    monkeypatch.setattr(DNS, 'gethostbyname_ex', lookup)
+    hostname = new_hostname()
+    cache = DictCache()
+
+    DNS.DNS().lookup(hostname, cache)
+    # Another process has an empty HostCache but the same memcache.
+    DNS.host_cache.clear()
+    assert DNS.DNS().lookup(hostname, cache) == ['10.0.0.1', '10.0.0.2']
+    assert lookup.hostnames == [hostname]
+
+
+def test_failed_lookups_are_cached(monkeypatch):
+    lookup = CountingLookup(socket.gaierror(-2, 'Name or service not known'))
+    monkeypatch.setattr(DNS, 'gethostbyname_ex', lookup)
+    hostname = new_hostname()
+
+    DNS.DNS().resolve_all([hostname])
+    with pytest.raises(socket.gaierror):
+        DNS.DNS().lookup(hostname)
+    assert lookup.hostnames == [hostname]
+
+
+@pytest.fixture
+def health():
+    DNS.host_health.clear()
+    yield DNS.host_health
+    DNS.host_health.clear()
+
+
+def test_choose_never_picks_the_slowest_of_three_first(health):
+    health.record_success('10.0.0.1', 0.01)
+    health.record_success('10.0.0.2', 0.1)
+    health.record_success('10.0.0.3', 1.0)
+    picks = [health.choose(['10.0.0.1', '10.0.0.2', '10.0.0.3'])[0] for i in range(100)]
+
+    assert '10.0.0.3' not in picks
+    assert picks.count('10.0.0.1') > picks.count('10.0.0.2')
+
+
+def test_choose_returns_distinct_addresses_best_first(health):
+    health.record_success('10.0.0.1', 1.0)
+    health.record_success('10.0.0.2', 0.01)
+
+    assert health.choose(['10.0.0.1', '10.0.0.2'], 2) == ['10.0.0.2', '10.0.0.1']
+    assert health.choose(['10.0.0.1', '10.0.0.2'], 5) == ['10.0.0.2', '10.0.0.1']
+
+
+def test_unmeasured_addresses_count_as_fast(health):
+    health.record_success('10.0.0.1', 0.5)
+    assert health.choose(['10.0.0.1', '10.0.0.2']) == ['10.0.0.2']
+
+
+def test_failing_address_is_ejected_until_it_succeeds(health):
+    for i in range(health.max_failures):
+        health.record_failure('10.0.0.1')
+    assert health.choose(['10.0.0.1', '10.0.0.2'], 2) == ['10.0.0.2']
+
+    # With every address ejected they are all tried anyway.
+    assert health.choose(['10.0.0.1']) == ['10.0.0.1']
+
+    health.record_success('10.0.0.1', 0.01)
+    assert sorted(health.choose(['10.0.0.1', '10.0.0.2'], 2)) == ['10.0.0.1', '10.0.0.2']
+
+
+@pytest.fixture
+def listener():
+    """
+    A socket listening on 127.0.0.1 only, so 127.0.0.2 (also loopback)
+    refuses connections on its port.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    yield sock.getsockname()[1]
+    sock.close()
+
+
+def test_connect_first_returns_the_address_that_connects(health, listener):
+    ip, sock = DNS.DNS().connect_first(['127.0.0.2', '127.0.0.1'], listener, 1.0)
+    sock.close()
+
+    assert ip == '127.0.0.1'
+    assert health.stats['127.0.0.2'][1] == 1
+    assert health.stats['127.0.0.1'][0] is not None
+
+
+def test_connect_first_raises_when_nothing_connects(health, listener):
+    with pytest.raises(socket.error):
+        DNS.DNS().connect_first(['127.0.0.2', '127.0.0.3'], listener, 1.0)
+
+
+def test_race_connections_fetches_from_the_address_that_connects(client, http_server, health,
+                                                                 monkeypatch):
+    monkeypatch.setattr(DNS, 'gethostbyname_ex', lambda hostname: (hostname, [], ['127.0.0.2', '127.0.0.1']))
+    url = 'http://%s:%d/race' % (new_hostname(), http_server.server_address[1])
+    client.add_request(Request(source=url, race_connections=True, retries=0))
+    request = client.execute()[0]
+
+    assert request.exception is None
+    assert request.response_content == 'hello'
+    assert request.ip == '127.0.0.1'
+
+
+def test_raced_connection_gets_the_deadline_timeout(client, http_server, health, monkeypatch):
+    monkeypatch.setattr(DNS, 'gethostbyname_ex', lambda hostname: (hostname, [], ['127.0.0.2', '127.0.0.1']))
+    parked = []
+    release = Http.connection_pool.release
+
+    def park(key, conn):
+        parked.append(conn.timeout)
+        release(key, conn)
+
+    monkeypatch.setattr(Http.connection_pool, 'release', park)
+    url = 'http://%s:%d/race' % (new_hostname(), http_server.server_address[1])
+    client.add_request(Request(source=url, race_connections=True, retries=0, timeout=5))
+    request = client.execute(deadline=0.5)[0]
+
+    assert request.response_content == 'hello'
+    assert parked[0] <= 0.5
@@ -0,0 +1,109 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from bullfrog.plugins import Memcache
+from bullfrog.plugins.Memcache import ClientPool, HashRing, RingClient
+
+SERVERS = ['10.0.0.1:11211', '10.0.0.2:11211', '10.0.0.3:11211']
+KEYS = ['key%d' % i for i in range(3000)]
+
+
+def owners(ring):
+    return dict((key, ring.get_server(key)) for key in KEYS)
+
+
+def test_keys_are_spread_evenly():
+    placed = owners(HashRing(SERVERS)).values()
+    for server in SERVERS:
+        assert 0.25 < placed.count(server) / float(len(KEYS)) < 0.42
+
+
+def test_placement_does_not_depend_on_server_order():
+    assert owners(HashRing(SERVERS)) == owners(HashRing(list(reversed(SERVERS))))
+
+
+def test_adding_a_server_only_moves_keys_to_it():
+    before = owners(HashRing(SERVERS))
+    after = owners(HashRing(SERVERS + ['10.0.0.4:11211']))
+    moved = [key for key in KEYS if before[key] != after[key]]
+
+    assert all(after[key] == '10.0.0.4:11211' for key in moved)
+    assert 0.15 < len(moved) / float(len(KEYS)) < 0.35
+
+
+def test_removing_a_server_only_moves_its_keys():
+    before = owners(HashRing(SERVERS))
+    after = owners(HashRing(SERVERS[:2]))
+    moved = [key for key in KEYS if before[key] != after[key]]
+
+    assert sorted(moved) == sorted(key for key in KEYS if before[key] == SERVERS[2])
+
+
+def test_dead_server_fails_over_to_the_next_point(monkeypatch):
+    now = [1300000000.0]
+    monkeypatch.setattr(Memcache, 'time', lambda: now[0])
+    ring = HashRing(SERVERS, dead_retry=30)
+    before = owners(ring)
+    ring.mark_dead(SERVERS[0])
+    during = owners(ring)
+
+    for key in KEYS:
+        if before[key] == SERVERS[0]:
+            assert during[key] != SERVERS[0]
+        else:
+            assert during[key] == before[key]
+
+    # Its keys end up where they would live without it.
+    without = owners(HashRing(SERVERS[1:]))
+    assert during == without
+
+    now[0] += 30
+    assert owners(ring) == before
+
+
+def test_every_server_dead_falls_back_to_the_keys_own():
+    ring = HashRing(SERVERS)
+    before = owners(ring)
+    for server in SERVERS:
+        ring.mark_dead(server)
+    assert owners(ring) == before
+
+
+class DeadHost(object):
+    """
+    Looks like a memcache.Client host that failed to connect.
+    """
+
+    deaduntil = time.time() + 30
+
+
+def test_ring_client_groups_multi_calls_by_server(fake_memcache):
+    client = ClientPool(SERVERS).acquire()
+    assert isinstance(client, RingClient)
+
+    keys = KEYS[:30]
+    assert client.set_multi(dict((key, key.upper()) for key in keys)) == []
+    assert fake_memcache.count('set_multi') == 3
+    assert client.get_multi(keys) == dict((key, key.upper()) for key in keys)
+    assert fake_memcache.count('get_multi') == 3
+
+
+def test_ring_client_shares_a_failed_server_with_the_ring(fake_memcache):
+    ring = HashRing(SERVERS)
+    client = RingClient(ring)
+    key = [key for key in KEYS if ring.get_server(key) == SERVERS[0]][0]
+    client.clients[SERVERS[0]].servers = [DeadHost()]
+
+    client.get(key)
+    assert ring.get_server(key) != SERVERS[0]
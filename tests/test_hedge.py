@@ -0,0 +1,184 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import Queue
+import threading
+import time
+
+import Http
+from bullfrog.client import Request
+
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class FakeSocket(object):
+
+    def __init__(self):
+        self.shut_down = False
+
+    def shutdown(self, how):
+        self.shut_down = True
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.sock = FakeSocket()
+
+
+def attempt():
+    return Http.HedgedAttempt(None, 'http://127.0.0.1/', Queue.Queue())
+
+
+def test_cancel_shuts_down_the_connection_in_use():
+    hedged = attempt()
+    conn = FakeConnection()
+    hedged.connected(conn)
+    hedged.cancel()
+    assert conn.sock.shut_down
+
+
+def test_cancel_leaves_a_connection_given_back_to_the_pool_alone():
+    hedged = attempt()
+    conn = FakeConnection()
+    hedged.connected(conn)
+    assert hedged.give_back(conn)
+    hedged.cancel()
+    assert not conn.sock.shut_down
+
+
+def test_cancelled_attempt_does_not_give_its_connection_back():
+    hedged = attempt()
+    conn = FakeConnection()
+    hedged.connected(conn)
+    hedged.cancel()
+    assert not hedged.give_back(conn)
+
+
+def test_connection_made_after_cancel_is_shut_down():
+    hedged = attempt()
+    hedged.cancel()
+    conn = FakeConnection()
+    hedged.connected(conn)
+    assert conn.sock.shut_down
+
+
+def test_no_hedge_when_the_first_attempt_is_fast(client, http_server, monkeypatch):
+    started = []
+    monkeypatch.setattr(Http.HedgedAttempt, 'start', lambda self: started.append(self))
+    client.add_request(Request(source=http_server.url('/fast'), hedge=True, hedge_delay=0.2))
+    request = client.execute()[0]
+    time.sleep(0.3)
+
+    assert request.response_content == 'hello'
+    assert not request.hedged
+    assert started == []
+    assert http_server.hits['/fast'] == 1
+
+
+def test_hedge_answers_for_a_slow_first_attempt(client, http_server):
+    # The first request for the path is slow, the hedge is not.
+    client.add_request(Request(source=http_server.url('/slow', first=1000), hedge=True, hedge_delay=0.05))
+    start = time.time()
+    request = client.execute()[0]
+    elapsed = time.time() - start
+
+    assert request.response_content == 'hello'
+    assert request.hedged
+    assert elapsed < 0.5
+    assert http_server.hits['/slow'] == 2
+
+
+def test_post_is_not_hedged(client, http_server):
+    client.add_request(Request(source=http_server.url('/post', first=200), body='data',
+                               hedge=True, hedge_delay=0.05))
+    request = client.execute()[0]
+
+    assert request.response_content == 'hello'
+    assert not request.hedged
+    assert http_server.methods['/post'] == ['POST']
+
+
+def test_hedge_delay_follows_the_hosts_response_times(client, http_server):
+    for i in range(Http.Http.hedge_min_samples):
+        Http.response_times.add('127.0.0.1', 0.02)
+    client.add_request(Request(source=http_server.url('/p95', first=1000), hedge=True,
+                               hedge_fallback_delay=5))
+    start = time.time()
+    request = client.execute()[0]
+
+    assert request.hedged
+    assert time.time() - start < 0.5
+
+
+def test_connections_stay_usable_after_hedged_fetches(client, http_server):
+    for i in range(5):
+        client.add_request(Request(source=http_server.url('/h%d' % i), hedge=True, hedge_delay=0.001))
+    client.execute()
+
+    client.reset()
+    for i in range(20):
+        client.add_request(Request(source=http_server.url('/after%d' % i), retries=0))
+    requests = client.execute()
+
+    assert [r.exception for r in requests] == [None] * 20
+    assert all(r.response_content == 'hello' for r in requests)
+
+
+def test_hedge_address_is_picked_before_the_timer_fires(client, http_server, monkeypatch):
+    threads = []
+    hedge_ip = Http.Http.hedge_ip
+
+    def record_thread(self):
+        threads.append(threading.current_thread().name)
+        return hedge_ip(self)
+
+    monkeypatch.setattr(Http.Http, 'hedge_ip', record_thread)
+    client.add_request(Request(source=http_server.url('/slow', first=1000), hedge=True, hedge_delay=0.05))
+    request = client.execute()[0]
+
+    assert request.hedged
+    assert threads and 'bullfrog-timer' not in threads
+
+
+def test_fetch_keeps_the_timings_of_the_winning_attempt(client, http_server, monkeypatch):
+    attempts = []
+    init = Http.HedgedAttempt.__init__
+
+    def record_attempt(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        attempts.append(self)
+
+    monkeypatch.setattr(Http.HedgedAttempt, '__init__', record_attempt)
+    client.add_request(Request(source=http_server.url('/slow', first=1000), hedge=True, hedge_delay=0.05))
+    request = client.execute()[0]
+
+    first, hedge = attempts
+    assert request.hedged
+    assert request.timings['ttfb'] == hedge.timings['ttfb']
+    assert request.timings['connect'] == hedge.timings['connect']
+    assert 'ttfb' not in first.timings
+
+
+def test_hedged_body_stops_at_the_deadline(client, http_server):
+    client.add_request(Request(source=http_server.url('/body', body='x' * 100, chunks=20, pause=50),
+                               chunk_size=100, hedge=True, hedge_delay=5))
+    request = client.execute(deadline=0.3)[0]
+
+    assert request.deadline_exceeded
+    # The worker gave up on the body instead of reading it to the end.
+    assert wait_for(lambda: client.pool.outstanding == 0, 0.3)
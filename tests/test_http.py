@@ -0,0 +1,162 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import time
+import urllib2
+
+import Http
+from bullfrog.client import Request
+
+
+def fetch(client, *requests):
+    client.reset()
+    for request in requests:
+        client.add_request(request)
+    return client.execute()
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_keep_alive_connection_is_reused(client, http_server):
+    fetch(client, Request(source=http_server.url('/a')))
+    request = fetch(client, Request(source=http_server.url('/a')))[0]
+
+    assert request.response_content == 'hello'
+    assert http_server.hits['/a'] == 2
+    assert http_server.connections == 1
+
+
+def test_pooled_socket_is_reused_across_batches(client, http_server):
+    fetch(client, Request(source=http_server.url('/a')))
+    [(conn, last_used)] = sum(Http.connection_pool.idle.values(), [])
+    sock = conn.sock
+
+    request = fetch(client, Request(source=http_server.url('/b')))[0]
+
+    assert request.response_content == 'hello'
+    [(reused, last_used)] = sum(Http.connection_pool.idle.values(), [])
+    assert reused is conn
+    assert reused.sock is sock
+    assert http_server.connections == 1
+
+
+def test_urllib2_handlers_are_still_available():
+    redirects = Http.RedirectHandler()
+    redirects.set_max_redirections(5)
+    opener = urllib2.build_opener(redirects, Http.HTTPErrorHandler())
+
+    assert redirects in opener.handlers
+    assert redirects.max_redirections == 5
+
+
+def test_stale_keep_alive_connection_is_retried_for_get(client, http_server):
+    fetch(client, Request(source=http_server.url('/stale', drop=1)))
+    request = fetch(client, Request(source=http_server.url('/stale'), retries=0))[0]
+
+    assert request.exception is None
+    assert request.response_content == 'hello'
+    assert http_server.hits['/stale'] == 2
+    assert http_server.connections == 2
+
+
+def test_stale_keep_alive_connection_is_not_resent_for_post(client, http_server):
+    fetch(client, Request(source=http_server.url('/post', drop=1)))
+    request = fetch(client, Request(source=http_server.url('/post'), method='post',
+                                    body='x=1', retries=0))[0]
+
+    assert request.exception is not None
+    assert http_server.methods['/post'] == ['GET']
+
+
+def test_timeout_on_reused_connection_is_not_resent(client, http_server):
+    fetch(client, Request(source=http_server.url('/slow')))
+    start = time.time()
+    request = fetch(client, Request(source=http_server.url('/slow', latency=600),
+                                    timeout=0.3, retries=0))[0]
+    elapsed = time.time() - start
+
+    assert isinstance(request.exception, socket.timeout)
+    assert elapsed < 0.55
+    time.sleep(0.4)
+    assert http_server.hits['/slow'] == 2
+
+
+def test_stale_entry_is_revalidated_with_its_etag(cached_client, http_server):
+    url = http_server.url('/etag', etag='v1')
+    first = fetch(cached_client, Request(source=url, cache_ttl=0))[0]
+    cached_at = first.cache.read(url)[3]
+
+    request = fetch(cached_client, Request(source=url, cache_ttl=0))[0]
+
+    assert http_server.hits['/etag'] == 2
+    assert request.revalidated
+    assert request.cache_hit
+    assert request.response_code == 200
+    assert request.response_content == 'hello'
+    assert request.response_headers['etag'] == 'v1'
+
+    # Written back with a new timestamp, so its TTL starts over.
+    assert request.cache_write
+    assert request.cache.read(url)[3] > cached_at
+
+
+def test_stale_entry_is_served_while_it_is_refreshed(cached_client, http_server):
+    url = http_server.url('/swr', latency=200)
+    fetch(cached_client, Request(source=url, cache_ttl=1))
+    time.sleep(1.1)
+
+    start = time.time()
+    requests = fetch(cached_client, *[Request(source=url, cache_ttl=1, stale_while_revalidate=True)
+                                      for i in range(3)])
+    elapsed = time.time() - start
+
+    assert elapsed < 0.15
+    assert [r.response_content for r in requests] == ['hello'] * 3
+    assert all(r.cache_is_stale for r in requests)
+    assert [r.refresh_scheduled for r in requests].count(True) == 1
+
+    # One refresh reaches the origin and replaces the entry.
+    assert wait_for(lambda: http_server.hits['/swr'] == 2 and not Http.refresher.in_flight)
+    request = fetch(cached_client, Request(source=url, cache_ttl=1, stale_while_revalidate=True))[0]
+
+    assert request.cache_hit
+    assert request.cache_is_fresh
+    assert not request.cache_is_stale
+    assert http_server.hits['/swr'] == 2
+
+
+def test_only_the_lock_holder_refreshes_a_missing_entry(cached_client, http_server):
+    # coalesce=False keeps the two fetches apart like two processes.
+    url = http_server.url('/stampede', latency=300)
+    requests = fetch(cached_client, *[Request(source=url, stampede_lock=True, coalesce=False)
+                                      for i in range(2)])
+
+    assert http_server.hits['/stampede'] == 1
+    assert [r.response_content for r in requests] == ['hello'] * 2
+    assert sorted(r.cache_hit for r in requests) == [False, True]
+
+
+def test_stale_copy_is_served_while_another_process_refreshes(cached_client, http_server):
+    url = http_server.url('/stampede', latency=300)
+    fetch(cached_client, Request(source=url, cache_ttl=0))
+    requests = fetch(cached_client, *[Request(source=url, cache_ttl=0, stampede_lock=True,
+                                              coalesce=False) for i in range(2)])
+
+    assert http_server.hits['/stampede'] == 2
+    assert [r.response_content for r in requests] == ['hello'] * 2
+    assert [r.cache_is_stale for r in requests].count(True) == 1
@@ -0,0 +1,278 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import zlib
+
+import pytest
+
+from bullfrog.client import ClientManager, Request
+from bullfrog.plugins import Memcache
+from bullfrog.plugins.Memcache import ClientPool, LocalCache
+
+
+def test_pool_hands_out_idle_clients_before_creating_more(fake_memcache):
+    pool = ClientPool(size=2)
+    first = pool.acquire()
+    pool.release(first)
+
+    assert pool.acquire() is first
+    second = pool.acquire()
+    assert second is not first
+    assert len(fake_memcache.clients) == 2
+
+
+def test_pool_blocks_until_a_client_is_released(fake_memcache):
+    pool = ClientPool(size=1)
+    client = pool.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.setDaemon(True)
+    waiter.start()
+
+    waiter.join(0.1)
+    assert got == []
+    pool.release(client)
+    waiter.join(2)
+    assert got == [client]
+
+
+def test_requests_borrow_clients_from_the_managers_pool(fake_memcache, http_server):
+    client = ClientManager(max_workers=2)
+    try:
+        for batch in range(3):
+            client.reset()
+            for i in range(10):
+                client.add_request(Request(source=http_server.url('/p%d' % i)))
+            requests = client.execute()
+            assert [r.response_content for r in requests] == ['hello'] * 10
+    finally:
+        client.close()
+
+    assert len(fake_memcache.clients) <= 3
+    assert fake_memcache.count('disconnect_all') == len(fake_memcache.clients)
+
+
+def test_batch_reads_the_cache_with_one_get_multi(cached_client, fake_memcache, http_server):
+    for i in range(5):
+        cached_client.add_request(Request(source=http_server.url('/b%d' % i)))
+    cached_client.execute()
+    assert fake_memcache.count('get_multi') == 1
+
+    # Read through to memcache rather than the in-process tier.
+    Memcache.local_cache.clear()
+    del fake_memcache.calls[:]
+    requests = cached_client.execute()
+
+    assert fake_memcache.count('get_multi') == 1
+    assert fake_memcache.count('get') == 0
+    assert all(r.cache_hit for r in requests)
+    assert [r.response_content for r in requests] == ['hello'] * 5
+    assert sum(http_server.hits.values()) == 5
+
+
+def test_local_tier_answers_without_memcache(cached_client, fake_memcache, http_server):
+    cached_client.add_request(Request(source=http_server.url('/local')))
+    cached_client.execute()
+    del fake_memcache.calls[:]
+    request = cached_client.execute()[0]
+
+    assert request.cache_hit
+    assert request.response_content == 'hello'
+    assert fake_memcache.calls == []
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Replaces the Memcache module's clock, returns the list holding the
+    current time.
+    """
+    now = [1300000000.0]
+    monkeypatch.setattr(Memcache, 'time', lambda: now[0])
+    return now
+
+
+def cached(value, now, cache_ttl=60):
+    return (value, cache_ttl, 86400, now)
+
+
+def test_local_cache_evicts_the_least_recently_used(clock):
+    local = LocalCache(max_entries=2)
+    local.put('a', cached('A', clock[0]), 1)
+    local.put('b', cached('B', clock[0]), 1)
+    local.get('a')
+    local.put('c', cached('C', clock[0]), 1)
+
+    assert local.get('b') is None
+    assert local.get('a')[0] == 'A'
+    assert local.get('c')[0] == 'C'
+
+
+def test_local_cache_is_bounded_by_size(clock):
+    local = LocalCache(max_bytes=10)
+    local.put('a', cached('A', clock[0]), 6)
+    local.put('b', cached('B', clock[0]), 6)
+
+    assert local.get('a') is None
+    assert local.get('b')[0] == 'B'
+    assert local.bytes == 6
+
+    local.put('huge', cached('H', clock[0]), 11)
+    assert local.get('huge') is None
+
+
+def test_local_cache_entries_expire_after_max_age(clock):
+    local = LocalCache(max_age=10)
+    local.put('a', cached('A', clock[0], cache_ttl=60), 1)
+    clock[0] += 9
+    assert local.get('a')[0] == 'A'
+    clock[0] += 2
+    assert local.get('a') is None
+
+
+def test_local_cache_entries_expire_with_cache_ttl(clock):
+    local = LocalCache(max_age=10)
+    local.put('a', cached('A', clock[0], cache_ttl=5), 1)
+    clock[0] += 6
+    assert local.get('a') is None
+    assert 'a' not in local.entries
+
+
+def memcache_backend(local=True):
+    request = Request(source='memcache://test', global_nocache=False, global_recache=False,
+                      global_accept_compressed=True)
+    cache = Memcache.Memcache(request)
+    cache.connect(pool=ClientPool(size=1), local=local)
+    return cache
+
+
+def test_write_replaces_the_local_entry(fake_memcache):
+    cache = memcache_backend()
+    cache.write('key', 'old')
+    cache.write('key', 'new')
+    del fake_memcache.calls[:]
+
+    assert cache.read('key')[0] == 'new'
+    assert fake_memcache.calls == []
+
+
+def test_delete_removes_the_local_entry(fake_memcache):
+    cache = memcache_backend()
+    cache.write('key', 'value')
+    cache.delete('key')
+
+    assert cache.read('key') is None
+    assert fake_memcache.count('get') == 1
+
+
+def test_changes_in_memcache_show_up_after_max_age(fake_memcache, clock):
+    cache = memcache_backend()
+    cache.write('key', 'old')
+    memcache_backend(local=False).write('key', 'new')
+
+    assert cache.read('key')[0] == 'old'
+    clock[0] += Memcache.local_cache.max_age
+    assert cache.read('key')[0] == 'new'
+
+
+def test_lock_is_held_until_released_with_its_token(fake_memcache):
+    cache = memcache_backend()
+    token = cache.acquire_lock('key')
+
+    assert token is not None
+    assert cache.acquire_lock('key') is None
+    cache.release_lock('key', token)
+    assert cache.acquire_lock('key') is not None
+
+
+def test_release_leaves_a_lock_taken_by_someone_else(fake_memcache):
+    cache = memcache_backend()
+    token = cache.acquire_lock('key')
+    cache.release_lock('key', token + 'expired')
+
+    assert cache.acquire_lock('key') is None
+
+
+@pytest.fixture
+def chunked(fake_memcache):
+    """
+    A Memcache backend without the local tier that splits values over
+    100 byte chunks.
+    """
+    cache = memcache_backend(local=False)
+    cache.chunk_size = 100
+    return cache
+
+
+def manifest_of(cache, fake_memcache, key):
+    return Memcache.MANIFEST.unpack(fake_memcache.data[cache.versioned_key(key)])
+
+
+def chunk_keys(cache, fake_memcache, key):
+    magic, generation, count, size, checksum = manifest_of(cache, fake_memcache, key)
+    return [cache.chunk_key(cache.versioned_key(key), generation, i) for i in range(count)]
+
+
+def test_large_value_is_stored_as_a_manifest_and_chunks(chunked, fake_memcache):
+    chunked.write('key', 'x' * 1000)
+    magic, generation, count, size, checksum = manifest_of(chunked, fake_memcache, 'key')
+    keys = chunk_keys(chunked, fake_memcache, 'key')
+    data = ''.join(fake_memcache.data[key] for key in keys)
+
+    assert magic == Memcache.MANIFEST_MAGIC
+    assert count == (size + 99) / 100
+    assert len(data) == size
+    assert zlib.crc32(data) & 0xffffffff == checksum
+
+    assert chunked.read('key')[0] == 'x' * 1000
+    assert chunked.read_multi(['key', 'small'])['key'][0] == 'x' * 1000
+
+
+def test_missing_chunk_is_a_miss(chunked, fake_memcache):
+    chunked.write('key', 'x' * 1000)
+    del fake_memcache.data[chunk_keys(chunked, fake_memcache, 'key')[3]]
+
+    assert chunked.read('key') is None
+    assert chunked.read_multi(['key']) == {}
+
+
+def test_corrupt_chunk_fails_the_checksum(chunked, fake_memcache):
+    chunked.write('key', 'x' * 1000)
+    key = chunk_keys(chunked, fake_memcache, 'key')[3]
+    fake_memcache.data[key] = 'y' * len(fake_memcache.data[key])
+
+    assert chunked.read('key') is None
+
+
+def test_chunks_of_an_overwritten_value_are_not_mixed_in(chunked, fake_memcache):
+    chunked.write('key', 'x' * 1000)
+    old_keys = chunk_keys(chunked, fake_memcache, 'key')
+    chunked.write('key', 'y' * 1000)
+    new_keys = chunk_keys(chunked, fake_memcache, 'key')
+
+    assert not set(old_keys) & set(new_keys)
+    assert chunked.read('key')[0] == 'y' * 1000
+
+    # An evicted chunk of the new value is not made up from the old one.
+    del fake_memcache.data[new_keys[3]]
+    assert old_keys[3] in fake_memcache.data
+    assert chunked.read('key') is None
+
+
+def test_deleted_value_is_gone_though_its_chunks_remain(chunked, fake_memcache):
+    chunked.write('key', 'x' * 1000)
+    keys = chunk_keys(chunked, fake_memcache, 'key')
+    chunked.delete('key')
+
+    assert all(key in fake_memcache.data for key in keys)
+    assert chunked.read('key') is None
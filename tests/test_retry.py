@@ -0,0 +1,105 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import httplib
+import socket
+from urllib2 import HTTPError
+
+import pytest
+
+from bullfrog.client import Request
+from bullfrog.retry import RetryBudget, RetryPolicy
+from bullfrog.scheduler import DeadlineExceeded
+
+
+def http_error(code, headers=None):
+    return HTTPError('http://example.com/', code, 'error', headers or {}, None)
+
+
+@pytest.mark.parametrize('error, retryable', [
+    (socket.timeout('timed out'), True),
+    (socket.error(104, 'Connection reset by peer'), True),
+    (httplib.BadStatusLine(''), True),
+    (http_error(503), True),
+    (http_error(429), True),
+    (http_error(404), False),
+    (http_error(400), False),
+    (Exception('Regex Invalidated Response Body'), False),
+    (DeadlineExceeded('Batch deadline exceeded'), False),
+])
+def test_is_retryable(error, retryable):
+    assert RetryPolicy().is_retryable(error) == retryable
+
+
+def test_backoff_grows_and_is_capped():
+    policy = RetryPolicy(max_retries=10, backoff=0.1, max_backoff=0.5, jitter=False,
+                         budget=RetryBudget())
+    delays = [policy.next_delay(socket.timeout(), retries) for retries in range(5)]
+    assert delays == [0.1, 0.2, 0.4, 0.5, 0.5]
+
+
+def test_jitter_stays_below_the_backoff():
+    policy = RetryPolicy(max_retries=10, backoff=0.1, budget=RetryBudget())
+    for i in range(50):
+        assert 0 <= policy.next_delay(socket.timeout(), 2) <= 0.4
+
+
+def test_max_retries_defaults_to_the_requests_retries():
+    policy = RetryPolicy(budget=RetryBudget())
+    assert policy.next_delay(socket.timeout(), 1, default_max_retries=2) is not None
+    assert policy.next_delay(socket.timeout(), 2, default_max_retries=2) is None
+
+
+def test_retry_after_is_honoured_up_to_max_backoff():
+    policy = RetryPolicy(max_retries=3, max_backoff=2.0, budget=RetryBudget())
+    assert policy.next_delay(http_error(503, {'retry-after': '1'}), 0) >= 1
+    assert policy.next_delay(http_error(503, {'retry-after': '5'}), 0) is None
+
+
+def test_budget_runs_out():
+    budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+
+def test_client_errors_are_not_retried(client, http_server):
+    client.add_request(Request(source=http_server.url('/missing', status=404), retries=3))
+    request = client.execute()[0]
+
+    assert isinstance(request.exception, HTTPError)
+    assert request.retry_count == 0
+    assert http_server.hits['/missing'] == 1
+
+
+@pytest.mark.parametrize('engine', ['execute', 'execute_async'])
+def test_server_errors_are_retried_with_backoff(client, http_server, engine):
+    policy = RetryPolicy(max_retries=2, backoff=0.01, budget=RetryBudget())
+    client.add_request(Request(source=http_server.url('/down', status=503), retry_policy=policy))
+    request = getattr(client, engine)()[0]
+
+    assert isinstance(request.exception, HTTPError)
+    assert request.retry_count == 2
+    assert http_server.hits['/down'] == 3
+
+
+def test_empty_budget_stops_retries(client, http_server):
+    policy = RetryPolicy(max_retries=3, backoff=0, budget=RetryBudget(ratio=0, min_per_second=0, max_tokens=1))
+    for i in range(5):
+        client.add_request(Request(source=http_server.url('/outage%d' % i, status=503), retry_policy=policy))
+    requests = client.execute()
+
+    assert sum(r.retry_count for r in requests) == 1
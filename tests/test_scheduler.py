@@ -0,0 +1,79 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from bullfrog.scheduler import WorkerPool
+
+
+def test_runs_every_job_on_a_fixed_number_of_threads():
+    pool = WorkerPool(max_workers=3)
+    threads = set()
+    lock = threading.Lock()
+
+    def job():
+        lock.acquire()
+        threads.add(threading.current_thread().name)
+        lock.release()
+        time.sleep(0.001)
+
+    try:
+        for i in range(50):
+            pool.submit(job)
+        pool.join()
+    finally:
+        pool.shutdown()
+
+    assert pool.outstanding == 0
+    assert 1 <= len(threads) <= 3
+
+
+def test_max_per_host_caps_concurrent_jobs():
+    pool = WorkerPool(max_workers=8, max_per_host=2)
+    state = {'running': 0, 'peak': 0}
+    lock = threading.Lock()
+
+    def job():
+        lock.acquire()
+        state['running'] += 1
+        state['peak'] = max(state['peak'], state['running'])
+        lock.release()
+        time.sleep(0.01)
+        lock.acquire()
+        state['running'] -= 1
+        lock.release()
+
+    try:
+        for i in range(10):
+            pool.submit(job, host='example.com')
+        pool.join()
+    finally:
+        pool.shutdown()
+
+    assert state['peak'] == 2
+
+
+def test_callback_runs_when_the_job_raises():
+    pool = WorkerPool(max_workers=1)
+    called = []
+
+    def job():
+        raise ValueError("boom")
+
+    try:
+        pool.submit(job, callback=lambda: called.append(True))
+        pool.join()
+    finally:
+        pool.shutdown()
+
+    assert called == [True]
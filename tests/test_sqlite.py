@@ -0,0 +1,113 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+import threading
+
+import pytest
+
+from bullfrog.client import ClientManager, Request
+from bullfrog.plugins import Sqlite
+from bullfrog.plugins.Sqlite import Store
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = Store(path=str(tmpdir.join('cache.db')), size=2)
+    yield store
+    store.disconnect_all()
+
+
+def test_set_and_get(store):
+    store.set('key', 'value', 60)
+    assert store.get('key') == 'value'
+    assert store.get('missing') is None
+
+
+def test_expired_entries_are_not_returned(store, monkeypatch):
+    store.set('key', 'value', 60)
+    now = Sqlite.time()
+    monkeypatch.setattr(Sqlite, 'time', lambda: now + 61)
+
+    assert store.get('key') is None
+
+
+def test_least_recently_used_entries_are_evicted_past_max_bytes(tmpdir):
+    store = Store(path=str(tmpdir.join('cache.db')), max_bytes=1000)
+    store.evict_interval = 1
+    try:
+        for i in range(20):
+            store.set('key%d' % i, 'x' * 100, 60)
+
+        values = store.get_multi(['key%d' % i for i in range(20)])
+        assert sum(len(value) for value in values.values()) <= 1000
+        assert 'key19' in values
+        assert 'key0' not in values
+    finally:
+        store.disconnect_all()
+
+
+def test_lock_is_only_released_by_its_holder(store):
+    assert store.add_lock('lock', 'a', 30)
+    assert not store.add_lock('lock', 'b', 30)
+
+    store.delete_lock('lock', 'b')
+    assert not store.add_lock('lock', 'b', 30)
+
+    store.delete_lock('lock', 'a')
+    assert store.add_lock('lock', 'b', 30)
+
+
+def test_connection_in_use_is_closed_not_reused_after_disconnect_all(store):
+    conn = store.acquire()
+    store.disconnect_all()
+    store.release(conn)
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+    for i in range(4):
+        store.set('key%d' % i, 'value', 60)
+        assert store.get('key%d' % i) == 'value'
+
+
+def test_waiter_opens_a_new_connection_when_a_retired_one_is_released(tmpdir):
+    store = Store(path=str(tmpdir.join('cache.db')), size=1)
+    conn = store.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(store.acquire()))
+    waiter.setDaemon(True)
+    waiter.start()
+
+    store.disconnect_all()
+    store.release(conn)
+    waiter.join(2)
+
+    assert got and got[0] is not conn
+    assert got[0].execute("SELECT 1").fetchall() == [(1,)]
+    store.release(got[0])
+    store.disconnect_all()
+
+
+def test_manager_caches_in_sqlite(tmpdir, http_server):
+    client = ClientManager(cache_backend='sqlite',
+                           cache_options={'path': str(tmpdir.join('cache.db'))})
+    url = http_server.url('/sqlite')
+    try:
+        for i in range(2):
+            client.reset()
+            client.add_request(Request(source=url))
+            request = client.execute()[0]
+            assert request.response_content == 'hello'
+    finally:
+        client.close()
+
+    assert http_server.hits['/sqlite'] == 1
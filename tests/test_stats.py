@@ -0,0 +1,85 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bullfrog.client import Request
+from bullfrog.stats import BatchStats, Histogram
+
+
+class Finished(object):
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+def test_percentiles_are_nearest_rank():
+    histogram = Histogram()
+    for value in [5, 1, 4, 2, 3, 10, 9, 8, 7, 6]:
+        histogram.add(value)
+
+    assert histogram.percentile(0) == 1
+    assert histogram.percentile(10) == 1
+    assert histogram.percentile(11) == 2
+    assert histogram.percentile(50) == 5
+    assert histogram.percentile(90) == 9
+    assert histogram.percentile(99) == 10
+    assert histogram.percentile(100) == 10
+
+
+def test_empty_histogram_has_no_percentiles():
+    histogram = Histogram()
+
+    assert histogram.percentile(50) is None
+    assert histogram.summary() == {'count': 0, 'sum': 0}
+
+
+def test_buckets_are_cumulative_and_include_their_upper_bound():
+    histogram = Histogram(bounds=(0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 1.0, 3.0]:
+        histogram.add(value)
+
+    assert histogram.buckets() == [(0.1, 2), (1.0, 4), ('+Inf', 5)]
+
+
+def test_batch_stats_count_hits_errors_and_phases():
+    stats = BatchStats({'total': 1.5})
+    stats.add(Finished(cache_hit=True, response_time=0.01, content_length=10,
+                       timings={'cache_read': 0.001}))
+    stats.add(Finished(exception=Exception('boom'), timed_out=1, response_time=0.2,
+                       content_length=0, timings={'connect': 0.05, 'unknown': 1}))
+    stats.add(Finished(coalesced=True, response_time='n/a', content_length=5))
+    stats.add(Finished(response_time=0.1, content_length=20, timings={'connect': 0.01}))
+
+    summary = stats.as_dict()
+    assert summary['requests'] == 4
+    assert summary['hit_ratio'] == 0.25
+    assert summary['coalesced'] == 1
+    assert summary['errors'] == 1
+    assert summary['timeouts'] == 1
+    assert summary['bytes'] == 35
+    assert summary['timers.total'] == 1.5
+    assert summary['response_time.count'] == 3
+    assert summary['response_time.p50'] == 0.1
+    assert summary['phase.connect.count'] == 2
+    assert summary['phase.connect.max'] == 0.05
+    assert 'phase.unknown.count' not in summary
+
+
+def test_execute_records_timings_and_stats(client, http_server):
+    client.add_request(Request(source=http_server.url('/stats')))
+    request = client.execute()[0]
+
+    assert request.timings['connect'] >= 0
+    assert request.timings['ttfb'] >= 0
+    stats = client.get_stats()
+    assert stats.requests == 1
+    assert stats.bytes == len('hello')
+    assert stats.phases['ttfb'].count == 1
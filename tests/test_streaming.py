@@ -0,0 +1,105 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from urllib2 import HTTPError
+
+from bullfrog.client import Request
+
+BODY = 'x' * 100
+
+
+def fetch(client, request):
+    client.reset()
+    client.add_request(request)
+    return client.execute()[0]
+
+
+def test_stream_iterates_a_chunked_response(client, http_server):
+    request = fetch(client, Request(source=http_server.url('/chunked', body=BODY, chunks=50),
+                                    stream=True, chunk_size=1000))
+
+    assert not isinstance(request.response_content, basestring)
+    chunks = list(request.response_content)
+    assert len(chunks) > 1
+    assert ''.join(chunks) == BODY * 50
+    assert request.streamed_bytes == 5000
+
+    # Read to the end, the connection went back to the pool.
+    assert fetch(client, Request(source=http_server.url('/next'))).response_content == 'hello'
+    assert http_server.connections == 1
+
+
+def test_stream_closed_early_closes_its_connection(client, http_server):
+    request = fetch(client, Request(source=http_server.url('/chunked', body=BODY, chunks=50),
+                                    stream=True, chunk_size=100))
+    content = request.response_content
+    assert next(content) == BODY
+    content.close()
+
+    assert fetch(client, Request(source=http_server.url('/next'))).response_content == 'hello'
+    assert http_server.connections == 2
+
+
+def test_sink_receives_every_chunk(client, http_server):
+    received = []
+    request = fetch(client, Request(source=http_server.url('/chunked', body=BODY, chunks=5),
+                                    sink=received.append, chunk_size=100))
+
+    assert request.response_content is None
+    assert ''.join(received) == BODY * 5
+
+
+def test_streamed_body_over_the_cache_limit_is_not_cached(cached_client, http_server):
+    url = http_server.url('/large', body=BODY, chunks=50)
+    for i in range(2):
+        request = fetch(cached_client, Request(source=url, stream=True, stream_cache_limit=1000))
+        assert ''.join(request.response_content) == BODY * 50
+        assert not request.cache_hit
+
+    assert http_server.hits['/large'] == 2
+
+
+def test_small_streamed_body_is_cached(cached_client, http_server):
+    url = http_server.url('/small', body=BODY, chunks=5)
+    assert ''.join(fetch(cached_client, Request(source=url, stream=True)).response_content) == BODY * 5
+    request = fetch(cached_client, Request(source=url, stream=True))
+
+    assert request.cache_hit
+    assert ''.join(request.response_content) == BODY * 5
+    assert http_server.hits['/small'] == 1
+
+
+def test_iter_completed_yields_requests_in_completion_order(client, http_server):
+    client.add_request(Request(source=http_server.url('/slow', latency=300)))
+    client.add_request(Request(source=http_server.url('/fast')))
+
+    order = []
+    started = time.time()
+    for request in client.iter_completed(callback=lambda request: order.append(request.source)):
+        if request.source == http_server.url('/fast'):
+            # Not held back until the slow fetch is done.
+            assert time.time() - started < 0.2
+
+    assert order == [http_server.url('/fast'), http_server.url('/slow', latency=300)]
+    assert client.get_stats().requests == 2
+
+
+def test_iter_completed_delivers_failures(client, http_server):
+    client.add_request(Request(source=http_server.url('/missing', status=404, latency=100), retries=0))
+    client.add_request(Request(source=http_server.url('/ok')))
+
+    requests = list(client.iter_completed())
+
+    assert requests[0].response_content == 'hello'
+    assert isinstance(requests[1].exception, HTTPError)
+    assert requests[1].exception.code == 404